@@ -0,0 +1,247 @@
+"""
+Synthetic SD-WAN fleets for the benchmarks.
+
+Fleet(count) describes count routers as SDWAN/branch pairs joined by one
+IPsec tunnel each, spread over us-east-1 and eu-central-1; size 4 is the
+workshop topology itself. Fleet.register() adds the routers to a FakeAws,
+and Fleet.installed() rewrites the handlers' topology tables (routers,
+tunnels, ASNs, dummy interfaces) in place so every handler accepts the
+whole fleet its discovery returns.
+
+FakeRouters is the FakeSSM output callable: it prints the verification
+output a router would give, with IPsec/BGP coming up converge_after seconds
+after Phase 2 (and Cloud WAN BGP after Phase 3) was sent to it.
+"""
+
+import contextlib
+import json
+import re
+
+import fake_aws
+import phase2_handler
+import phase3_handler
+import phase4_handler
+import ssm_utils
+
+
+REGIONS = ("us-east-1", "eu-central-1")
+
+# Markers of the commands that configure a router, and the phase they belong to
+CONFIG_MARKERS = (("vyos-vpn.sh", "phase2"), ("vyos-cloudwan-bgp.sh", "phase3"))
+
+IPSEC_HEADER = (
+    "Connection          State    Uptime    Bytes In/Out    Packets In/Out    "
+    "Remote address    Remote ID    Proposal\n"
+    "------------------  -------  --------  --------------  ----------------  "
+    "----------------  -----------  ----------"
+)
+
+
+class Fleet:
+    """Topology of a synthetic fleet.
+
+    Args:
+        count: Number of routers, rounded up to an even number (pairs)
+    """
+
+    def __init__(self, count):
+        self.tunnels = []
+        self.router_config = {}
+        self.dummy_interfaces = {}
+        self.regions = {}
+        self.cloudwan = {}
+        self.sdwan_asn = {}
+        self.private_subnet_gw = {}
+
+        if count <= 4:
+            self._workshop()
+        else:
+            for k in range((count + 1) // 2):
+                self._add_pair(k)
+        self.routers = list(self.router_config)
+        self.sdwan_routers = [r for r, c in self.router_config.items() if c["role"] == "sdwan"]
+
+    def _workshop(self):
+        self.tunnels = [dict(t) for t in phase2_handler.TUNNELS]
+        self.router_config = {r: dict(c) for r, c in phase2_handler.ROUTER_CONFIG.items()}
+        self.dummy_interfaces = {r: list(d) for r, d in phase2_handler.DUMMY_INTERFACES.items()}
+        self.regions = {r: ssm_utils.INSTANCE_REGIONS[r] for r in self.router_config}
+        self.sdwan_asn = dict(phase3_handler.SDWAN_BGP_ASN)
+        self.private_subnet_gw = dict(phase3_handler.PRIVATE_SUBNET_GW)
+        for i, router in enumerate(phase3_handler.SDWAN_BGP_ASN):
+            self.cloudwan[router] = {
+                "cloudwan_peer_ip1": f"10.100.{i}.1",
+                "cloudwan_peer_ip2": f"10.100.{i}.2",
+                "cloudwan_asn": "64512",
+            }
+
+    def _add_pair(self, k):
+        sdwan, branch = f"site{k + 1:04d}-sdwan", f"site{k + 1:04d}-branch1"
+        region = REGIONS[k % len(REGIONS)]
+        base = 4 * k
+        vti = f"169.254.{base // 256}.{base % 256 + 1}", f"169.254.{base // 256}.{base % 256 + 2}"
+        self.tunnels.append({
+            "router_a": sdwan,
+            "router_b": branch,
+            "vti_a": {"name": "vti0", "addr": f"{vti[0]}/30"},
+            "vti_b": {"name": "vti0", "addr": f"{vti[1]}/30"},
+        })
+        for i, (router, role) in enumerate(((sdwan, "sdwan"), (branch, "branch"))):
+            n = 2 * k + i + 1
+            self.router_config[router] = {
+                "loopback": f"10.255.{n // 256}.{n % 256}",
+                "asn": 4200000000 + n,
+                "role": role,
+            }
+            self.regions[router] = region
+        self.dummy_interfaces[branch] = [
+            {"iface": "dum0", "addr": f"10.250.{k // 128}.{k % 128 * 2}/32"},
+            {"iface": "dum1", "addr": f"10.250.{k // 128}.{k % 128 * 2 + 1}/32"},
+        ]
+        self.sdwan_asn[sdwan] = self.router_config[sdwan]["asn"]
+        self.private_subnet_gw[sdwan] = f"10.{k // 256}.{k % 256}.1"
+        self.cloudwan[sdwan] = {
+            "cloudwan_peer_ip1": f"10.100.{k // 64}.{k % 64 * 4 + 1}",
+            "cloudwan_peer_ip2": f"10.100.{k // 64}.{k % 64 * 4 + 2}",
+            "cloudwan_asn": "64512",
+        }
+
+    def register(self, aws):
+        """Register every router and its /sdwan/ parameters with a FakeAws."""
+        for router in self.routers:
+            aws.add_router(router, self.regions[router], **self.cloudwan.get(router, {}))
+
+    def configs(self):
+        """Return the get_instance_configs() result for this fleet."""
+        aws = fake_aws.FakeAws()
+        self.register(aws)
+        with fake_aws.use(aws):
+            return ssm_utils.get_instance_configs()
+
+    @contextlib.contextmanager
+    def installed(self):
+        """Replace the handlers' topology tables with this fleet's, in place.
+
+        The tables are modified rather than rebound because other modules
+        (convergence_handler, benchmark_handler) import them by name.
+        """
+        phase4_tunnels = [{
+            "router_a": t["router_a"],
+            "router_b": t["router_b"],
+            "vti_a_addr": t["vti_a"]["addr"].split("/")[0],
+            "vti_b_addr": t["vti_b"]["addr"].split("/")[0],
+        } for t in self.tunnels]
+        tables = (
+            (phase2_handler.TUNNELS, self.tunnels),
+            (phase2_handler.ROUTER_CONFIG, self.router_config),
+            (phase2_handler.DUMMY_INTERFACES, self.dummy_interfaces),
+            (phase3_handler.SDWAN_BGP_ASN, self.sdwan_asn),
+            (phase3_handler.PRIVATE_SUBNET_GW, self.private_subnet_gw),
+            (phase4_handler.TUNNELS, phase4_tunnels),
+            (ssm_utils.INSTANCE_REGIONS, self.regions),
+        )
+        saved = [(table, table.copy()) for table, _ in tables]
+        try:
+            for table, value in tables:
+                _replace(table, value)
+            yield self
+        finally:
+            for table, value in saved:
+                _replace(table, value)
+
+
+def _replace(table, value):
+    if isinstance(table, dict):
+        table.clear()
+        table.update(value)
+    else:
+        table[:] = value
+
+
+class FakeRouters:
+    """FakeSSM output callable that simulates router state.
+
+    Args:
+        clock: FakeClock of the FakeAws
+        converge_after: Seconds after Phase 2/3 was sent until its sessions are up
+        configured: Treat every router as fully configured from the start
+    """
+
+    def __init__(self, clock, converge_after=30, configured=False):
+        self.clock = clock
+        self.converge_after = converge_after
+        self.configured = configured
+        self.applied = {}
+
+    def _up(self, instance_id, phase):
+        if self.configured:
+            return True
+        at = self.applied.get((instance_id, phase))
+        return at is not None and self.clock.time() >= at + self.converge_after
+
+    def __call__(self, instance_id, commands):
+        text = "\n".join(commands)
+        for marker, phase in CONFIG_MARKERS:
+            if marker in text:
+                self.applied[(instance_id, phase)] = self.clock.time()
+                return ""
+        m = re.search(r"=== Verifying (\S+) ===", text)
+        if not m:
+            return ""
+        return verify_output(m.group(1), text, self._up(instance_id, "phase2"),
+                             self._up(instance_id, "phase3"))
+
+
+def verify_output(router_name, command, vpn_up=True, cloudwan_up=True):
+    """Return the stdout of a verification command on a simulated router.
+
+    Args:
+        router_name: Router the command runs on
+        command: Text of the verification command; the Cloud WAN neighbors
+                 and ping targets it asks for are answered
+        vpn_up: IPsec SAs and VPN BGP sessions are up
+        cloudwan_up: Cloud WAN BGP sessions are Established
+
+    Returns:
+        str: Output in the format phase4_handler.parse_verify_output() reads
+    """
+    peers = phase4_handler.get_ping_targets(router_name)
+    lines = [f"=== Verifying {router_name} ===", "--- IPsec SA Status ---", IPSEC_HEADER]
+    for peer in peers:
+        lines.append(f"peer-{peer}-tunnel-vti  {'up' if vpn_up else 'down':<7}  1h2m3s    "
+                     f"1.2K/3.4K       20/30             198.18.0.1        N/A          "
+                     f"AES_CBC_256/HMAC_SHA1_96/MODP_2048")
+
+    lines.append("--- BGP Summary ---")
+    lines.append(json.dumps({"ipv4Unicast": {"peers": {
+        peer: {"remoteAs": 64501, "state": "Established" if vpn_up else "Active",
+               "peerUptime": "00:10:00" if vpn_up else "never", "pfxRcd": 3 if vpn_up else 0}
+        for peer in peers
+    }}}))
+
+    lines += ["--- Interfaces ---",
+              "Interface    IP Address         S/L  Description",
+              "eth0         10.0.0.10/24       u/u"]
+
+    for peer in re.findall(r'echo "--- Cloud WAN BGP Neighbor (\S+) ---"', command):
+        lines.append(f"--- Cloud WAN BGP Neighbor {peer} ---")
+        lines.append(json.dumps({peer: {
+            "remoteAs": 64512,
+            "bgpState": "Established" if cloudwan_up else "Active",
+            "bgpTimerUpString": "00:10:00",
+            "addressFamilyInfo": {"ipv4Unicast": {"acceptedPrefixCounter": 4}},
+        }}))
+
+    lines.append("--- Ping Tests ---")
+    for target in re.findall(r'echo "--- Ping (\S+) ---"', command):
+        lines += [
+            f"--- Ping {target} ---",
+            f"PING {target} ({target}) 56(84) bytes of data.",
+            "",
+            f"--- {target} ping statistics ---",
+            "5 packets transmitted, 5 received, 0% packet loss, time 804ms",
+            "rtt min/avg/max/mdev = 0.912/1.104/1.398/0.161 ms",
+            f"PING_{'OK' if vpn_up else 'FAIL'} {target}",
+        ]
+    lines.append(f"=== Verification complete for {router_name} ===")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,482 @@
+"""
+Orchestration benchmarks for the SD-WAN Lambda code.
+
+Runs the script generators, each phase handler, the convergence check and
+the whole pipeline (Step Functions order and the DAG orchestrator) against
+synthetic fleets of increasing size, using the in-memory AWS fakes in
+tests/fake_aws.py. Per case and fleet size it records:
+
+- virtual_seconds: simulated wall-clock of the run (AWS time, not CPU time)
+- api_calls: AWS API calls made
+- bytes_sent: SSM command payload bytes (handlers) or generated script bytes
+- seconds: real CPU wall-clock of the Python code (best of --repeat runs)
+- peak_kb: peak memory allocated during the run (tracemalloc)
+
+The cold_start case imports each Lambda handler module in a fresh
+interpreter and creates its first SSM client, recording import_ms,
+first_client_ms and the number of modules loaded (modules).
+
+Results are written as JSON and compared with a stored baseline; any metric
+that got worse by more than the tolerance fails the run:
+
+    python benchmarks/run_benchmarks.py                      # compare with baseline.json
+    python benchmarks/run_benchmarks.py --sizes 4,50,500,5000 --output results.json
+    python benchmarks/run_benchmarks.py --update-baseline    # accept the current numbers
+
+virtual_seconds, api_calls, bytes_sent and modules are deterministic for a
+given Python/botocore version. seconds, peak_kb, import_ms and
+first_client_ms depend on the machine, so the baseline should be
+regenerated on the machine it is compared on (or use --no-timing).
+"""
+
+import argparse
+import contextlib
+import gc
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(HERE, "..", "cloudformation", "lambda")
+TF_LAMBDA_DIR = os.path.join(HERE, "..", "terraform", "lambda")
+sys.path.insert(0, os.path.abspath(LAMBDA_DIR))
+sys.path.insert(0, os.path.abspath(os.path.join(HERE, "..", "tests")))
+
+import convergence_handler  # noqa: E402
+import fake_aws  # noqa: E402
+import phase1_handler  # noqa: E402
+import phase2_handler  # noqa: E402
+import phase3_handler  # noqa: E402
+import phase4_handler  # noqa: E402
+import sdwan_orchestrator  # noqa: E402
+from fleet import Fleet, FakeRouters, verify_output  # noqa: E402
+
+
+DEFAULT_SIZES = (4, 50, 500)
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+# Allowed relative slowdown per metric before a run fails, and the absolute
+# change below which a difference is treated as noise
+DETERMINISTIC_METRICS = {"virtual_seconds": 0.01, "api_calls": 0.01, "bytes_sent": 0.01,
+                         "modules": 0.01}
+TIMING_METRICS = {"seconds": 0.02, "peak_kb": 256, "import_ms": 20, "first_client_ms": 20}
+DEFAULT_TOLERANCE = 0.5
+
+# Entry modules of the Lambda functions, for the cold_start case
+COLD_START_MODULES = (
+    "phase1_handler", "phase2_handler", "phase3_handler", "phase4_handler",
+    "convergence_handler", "benchmark_handler", "cross_region_stack",
+)
+
+# Run in a fresh interpreter: import the handler module, then create the
+# first client the way the handler's first API call does
+COLD_START_CODE = """
+import sys, time
+before = len(sys.modules)
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+import ssm_utils
+ssm_utils.get_client("ssm", "us-east-1")
+done = time.perf_counter()
+print(imported - start, done - imported, len(sys.modules) - before)
+"""
+
+_PROFILE = fake_aws.runtime_profile()
+
+
+def command_runtime(instance_id, commands, rng):
+    """Profile runtime drawn from a per-(instance, command) seed so runs repeat exactly."""
+    return _PROFILE(instance_id, commands, random.Random(f"{instance_id}:{commands[0][:200]}"))
+
+
+def _load_terraform_cloudwan_bgp():
+    """Import the Terraform copy of the Cloud WAN BGP generator by path."""
+    path = os.path.join(TF_LAMBDA_DIR, "phase4_cloudwan_bgp.py")
+    spec = importlib.util.spec_from_file_location("tf_phase4_cloudwan_bgp", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# -- cases -------------------------------------------------------------
+#
+# Each case takes a Fleet and returns a callable that runs the measured work
+# once and returns its deterministic metrics. Setup happens before the
+# callable is returned, so it is not measured.
+
+def bench_build_phase1_commands(fleet):
+    def run():
+        return {"bytes_sent": sum(len(phase1_handler.build_phase1_commands())
+                                  for _ in fleet.routers)}
+    return run
+
+
+def bench_build_vpn_bgp_script(fleet):
+    configs = fleet.configs()
+
+    def run():
+        with fleet.installed():
+            return {"bytes_sent": sum(len(phase2_handler.build_vpn_bgp_script(r, configs))
+                                      for r in fleet.routers)}
+    return run
+
+
+def bench_build_cloudwan_bgp_script(fleet):
+    configs = fleet.configs()
+
+    def run():
+        with fleet.installed():
+            return {"bytes_sent": sum(len(phase3_handler.build_cloudwan_bgp_script(r, configs))
+                                      for r in fleet.sdwan_routers)}
+    return run
+
+
+def bench_build_cloudwan_bgp_script_terraform(fleet):
+    module = _load_terraform_cloudwan_bgp()
+    configs = fleet.configs()
+    # The Terraform generator looks up ASNs by router name
+    module.SDWAN_BGP_ASN.update(fleet.sdwan_asn)
+
+    def run():
+        return {"bytes_sent": sum(
+            len(module.build_cloudwan_bgp_script(
+                r, configs[r]["cloudwan_peer_ip1"], "169.254.200.1",
+                private_subnet_gw=fleet.private_subnet_gw[r],
+            ))
+            for r in fleet.sdwan_routers
+        )}
+    return run
+
+
+def bench_parse_verify_output(fleet):
+    configs = fleet.configs()
+    with fleet.installed():
+        outputs = {
+            r: verify_output(r, phase4_handler.build_verify_command(r, configs=configs))
+            for r in fleet.routers
+        }
+
+    def run():
+        with fleet.installed():
+            details = [phase4_handler.parse_verify_output(out, r, configs=configs)
+                       for r, out in outputs.items()]
+        if any(d["bgp"] != "ok" for d in details):
+            raise AssertionError("synthetic verification output did not parse as healthy")
+        return {"bytes_sent": sum(len(out) for out in outputs.values())}
+    return run
+
+
+def _fake_run(fleet, body, configured=True, threads=False, offline=()):
+    """Return a callable running body() against a fresh fake fleet.
+
+    Routers named in offline have an SSM agent that never connects.
+    """
+    clock = fake_aws.FakeClock(threads=threads)
+    aws = fake_aws.FakeAws(clock=clock, ssm_options={
+        "runtime": command_runtime,
+        "output": FakeRouters(clock, configured=configured),
+    })
+    fleet.register(aws)
+    configs = fleet.configs() if offline else {}
+    for router in offline:
+        aws.ssm(configs[router]["region"]).offline[configs[router]["instance_id"]] = float("inf")
+
+    def run():
+        start, calls = aws.clock.time(), sum(aws.api_counts().values())
+        bytes_sent = sum(c.bytes_sent for (s, _), c in aws.clients.items() if s == "ssm")
+        with fleet.installed(), fake_aws.use(aws), contextlib.redirect_stdout(io.StringIO()):
+            body()
+        return {
+            "virtual_seconds": round(aws.clock.time() - start, 1),
+            "api_calls": sum(aws.api_counts().values()) - calls,
+            "bytes_sent": sum(c.bytes_sent for (s, _), c in aws.clients.items()
+                              if s == "ssm") - bytes_sent,
+        }
+    return run
+
+
+def bench_phase1_handler(fleet):
+    return _fake_run(fleet, lambda: phase1_handler.handler({}, None), configured=False)
+
+
+def bench_phase1_handler_agent_offline(fleet):
+    return _fake_run(fleet, lambda: phase1_handler.handler({}, None), configured=False,
+                     offline=fleet.routers[:1])
+
+
+def bench_phase2_handler(fleet):
+    return _fake_run(fleet, lambda: phase2_handler.handler({}, None))
+
+
+def bench_phase2_handler_only_failed(fleet):
+    # Re-run of the 3 routers that failed in a previous Phase 2 result
+    previous = {
+        "phase": "phase2",
+        "results": {r: {"status": "Failed" if i < 3 else "Success"}
+                    for i, r in enumerate(fleet.routers)},
+        "fail_count": 3,
+    }
+    return _fake_run(fleet, lambda: phase2_handler.handler({"only_failed": previous}, None))
+
+
+def bench_phase2_handler_rollout(fleet):
+    return _fake_run(fleet, lambda: phase2_handler.handler({"rollout": "on"}, None))
+
+
+def bench_phase3_handler(fleet):
+    return _fake_run(fleet, lambda: phase3_handler.handler({}, None))
+
+
+def bench_phase4_handler(fleet):
+    return _fake_run(fleet, lambda: phase4_handler.handler({"run_id": "bench"}, None))
+
+
+def bench_convergence(fleet):
+    return _fake_run(
+        fleet, lambda: convergence_handler.handler({"after_phase": "phase3"}, None)
+    )
+
+
+def bench_pipeline_step_functions(fleet):
+    def body():
+        for module, phase in ((phase1_handler, "phase1"), (phase2_handler, "phase2"),
+                              (phase3_handler, "phase3")):
+            module.handler({}, None)
+            convergence_handler.handler({"after_phase": phase}, None)
+        phase4_handler.handler({"run_id": "bench"}, None)
+    return _fake_run(fleet, body, configured=False)
+
+
+def bench_pipeline_orchestrator(fleet):
+    return _fake_run(fleet, lambda: sdwan_orchestrator.run_pipeline(run_id="bench"),
+                     configured=False, threads=True)
+
+
+# (name, factory, largest fleet size it runs at by default)
+CASES = (
+    ("build_phase1_commands", bench_build_phase1_commands, None),
+    ("build_vpn_bgp_script", bench_build_vpn_bgp_script, None),
+    ("build_cloudwan_bgp_script", bench_build_cloudwan_bgp_script, None),
+    ("build_cloudwan_bgp_script_terraform", bench_build_cloudwan_bgp_script_terraform, None),
+    ("parse_verify_output", bench_parse_verify_output, None),
+    ("phase1_handler", bench_phase1_handler, None),
+    ("phase1_handler_agent_offline", bench_phase1_handler_agent_offline, 50),
+    ("phase2_handler", bench_phase2_handler, None),
+    ("phase2_handler_only_failed", bench_phase2_handler_only_failed, None),
+    ("phase2_handler_rollout", bench_phase2_handler_rollout, None),
+    ("phase3_handler", bench_phase3_handler, None),
+    ("phase4_handler", bench_phase4_handler, None),
+    ("convergence", bench_convergence, None),
+    ("pipeline_step_functions", bench_pipeline_step_functions, None),
+    # Threaded virtual time costs real time per clock step
+    ("pipeline_orchestrator", bench_pipeline_orchestrator, 50),
+)
+
+
+def measure_cold_start(module, repeat=5):
+    """Import a handler module in fresh interpreters and return its cold-start metrics.
+
+    Returns:
+        dict: import_ms and first_client_ms (best of repeat runs), modules
+    """
+    best_import = best_client = None
+    for _ in range(repeat):
+        # -B: no .pyc files are written, as in the deployed zip
+        out = subprocess.run(
+            [sys.executable, "-B", "-c", COLD_START_CODE.format(module=module)],
+            cwd=os.path.abspath(LAMBDA_DIR), capture_output=True, text=True, check=True,
+        ).stdout.split()
+        import_s, client_s, modules = float(out[0]), float(out[1]), int(out[2])
+        best_import = import_s if best_import is None else min(best_import, import_s)
+        best_client = client_s if best_client is None else min(best_client, client_s)
+    return {
+        "modules": modules,
+        "import_ms": round(best_import * 1000, 1),
+        "first_client_ms": round(best_client * 1000, 1),
+    }
+
+
+def measure(factory, fleet, repeat=5):
+    """Run a case and return its metrics.
+
+    Args:
+        factory: Case function
+        fleet: Fleet to run it on
+        repeat: Timed runs; the fastest is reported
+
+    Returns:
+        dict: Deterministic metrics of the case plus seconds and peak_kb
+    """
+    best = None
+    for _ in range(repeat):
+        run = factory(fleet)
+        # Like timeit: no collector pauses inside the timed region
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            metrics = run()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+
+    run = factory(fleet)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {**metrics, "seconds": round(best, 4), "peak_kb": round(peak / 1024, 1)}
+
+
+def run_suite(sizes=DEFAULT_SIZES, cases=None, repeat=5, run_all=False):
+    """Run the selected cases at each fleet size.
+
+    Args:
+        sizes: Fleet sizes
+        cases: Case names (default: all)
+        repeat: Timed runs per case
+        run_all: Ignore the per-case size cap
+
+    Returns:
+        dict: meta plus results[case][size] -> metrics
+    """
+    results = {}
+    for size in sizes:
+        fleet = Fleet(size)
+        for name, factory, max_size in CASES:
+            if cases and name not in cases:
+                continue
+            if max_size and size > max_size and not run_all:
+                continue
+            metrics = measure(factory, fleet, repeat)
+            results.setdefault(name, {})[str(size)] = metrics
+            print(f"{name:<38} {size:>5}  " + "  ".join(
+                f"{k}={v}" for k, v in metrics.items()
+            ), flush=True)
+    if not cases or "cold_start" in cases:
+        for module in COLD_START_MODULES:
+            metrics = measure_cold_start(module, repeat)
+            results.setdefault(f"cold_start:{module}", {})["-"] = metrics
+            print(f"{'cold_start:' + module:<38} {'-':>5}  " + "  ".join(
+                f"{k}={v}" for k, v in metrics.items()
+            ), flush=True)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": list(sizes),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE, timing=True):
+    """Compare results with a baseline.
+
+    Args:
+        current: Dict from run_suite()
+        baseline: Dict from run_suite() stored earlier
+        tolerance: Allowed relative slowdown of seconds and peak_kb
+        timing: Compare seconds and peak_kb at all
+
+    Returns:
+        list[str]: One line per metric that regressed
+    """
+    limits = dict(DETERMINISTIC_METRICS)
+    if timing:
+        limits.update({m: tolerance for m in TIMING_METRICS})
+    regressions = []
+    for case, sizes in current["results"].items():
+        for size, metrics in sizes.items():
+            before = baseline.get("results", {}).get(case, {}).get(size)
+            if not before:
+                continue
+            for metric, value in metrics.items():
+                if metric not in limits or metric not in before:
+                    continue
+                old = before[metric]
+                floor = TIMING_METRICS.get(metric, 0)
+                if value > old * (1 + limits[metric]) and value - old > floor:
+                    regressions.append(
+                        f"{case}[{size}] {metric}: {old} -> {value} "
+                        f"(+{(value - old) / old * 100 if old else float('inf'):.0f}%)"
+                    )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the SD-WAN orchestration benchmarks.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated fleet sizes (default: %(default)s)")
+    parser.add_argument("--cases", help="Comma-separated case names (default: all)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case")
+    parser.add_argument("--all", action="store_true",
+                        help="Run every case at every size, ignoring per-case size caps")
+    parser.add_argument("--output", help="Write results JSON to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Write the results to the baseline file instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative slowdown of seconds/peak_kb (default: %(default)s)")
+    parser.add_argument("--no-timing", action="store_true",
+                        help="Compare only the deterministic metrics")
+    parser.add_argument("--list", action="store_true", help="List the cases and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, _, max_size in CASES:
+            print(name + (f" (up to {max_size} routers)" if max_size else ""))
+        print("cold_start (handler module import and first client, once per run)")
+        return 0
+
+    results = run_suite(
+        sizes=[int(s) for s in args.sizes.split(",")],
+        cases=args.cases.split(",") if args.cases else None,
+        repeat=args.repeat,
+        run_all=args.all,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to create one")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("meta", {}).get("python") != results["meta"]["python"] and not args.no_timing:
+        print(f"Note: baseline was recorded with Python {baseline['meta'].get('python')}; "
+              f"timings may not be comparable")
+    regressions = compare(results, baseline, args.tolerance, timing=not args.no_timing)
+    if regressions:
+        print(f"{len(regressions)} regression(s) against {args.baseline}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+"""
+Convergence Lambda Handler — waits for the routers to settle after a phase.
+
+Replaces the fixed Step Functions Wait states between phases. Polls every
+router with the Phase 4 verification command (without pings) until the state
+expected after the given phase is reached, then returns immediately. Fails
+fast with the list of non-converged routers/peers once the timeout expires.
+
+Expected state per phase:
+- phase1: VyOS container is up and answers op-mode commands
+- phase2: IPsec SAs up and VPN BGP sessions Established
+- phase3: phase2 state plus Cloud WAN BGP sessions Established (SDWAN routers)
+"""
+
+import os
+import time
+
+import metrics
+import output_store
+import tracing
+from instrumentation import instrumented
+from profiling import profiled
+from phase4_handler import (
+    build_verify_command,
+    get_ping_targets,
+    get_routers,
+    parse_verify_output,
+)
+from ssm_utils import get_instance_configs, run_commands, select_routers
+
+
+SSM_PARAM_PREFIX = os.environ.get("SSM_PARAM_PREFIX", "/sdwan/")
+CONVERGENCE_TIMEOUT = int(os.environ.get("CONVERGENCE_TIMEOUT", "600"))
+CONVERGENCE_POLL_INTERVAL = int(os.environ.get("CONVERGENCE_POLL_INTERVAL", "15"))
+
+# Max seconds a single check command may run on a router
+CHECK_TIMEOUT = int(os.environ.get("CHECK_TIMEOUT", "120"))
+
+PHASES = ("phase1", "phase2", "phase3")
+
+
+class ConvergenceError(Exception):
+    """Raised when routers have not converged before the timeout."""
+
+
+def get_pending_checks(router_name, details, after_phase):
+    """Return the checks that have not converged yet for one router.
+
+    Args:
+        router_name: Router the details belong to
+        details: Dict from phase4_handler.parse_verify_output()
+        after_phase: One of phase1, phase2, phase3
+
+    Returns:
+        list[str]: Human-readable pending items, empty when converged
+    """
+    if details.get("interfaces") != "ok":
+        return ["router not answering op-mode commands"]
+    if after_phase == "phase1":
+        return []
+
+    pending = []
+    sas = details.get("ipsec_sas", {})
+    if details.get("ipsec") != "ok":
+        up = sum(1 for sa in sas.values() if sa["state"] == "up")
+        pending.append(f"ipsec {up}/{len(get_ping_targets(router_name))} SAs up")
+
+    neighbors = details.get("bgp_neighbors", {})
+    for peer_ip in get_ping_targets(router_name):
+        state = neighbors.get(peer_ip, {}).get("state", "missing")
+        if state != "Established":
+            pending.append(f"bgp {peer_ip} {state}")
+
+    # Cloud WAN BGP applies to SDWAN routers only (see parse_verify_output)
+    if after_phase == "phase3" and details.get("cloudwan_bgp") != "not_applicable":
+        if details.get("cloudwan_bgp") != "ok":
+            cloudwan = details.get("cloudwan_bgp_neighbors", {})
+            expected = details.get("cloudwan_bgp_peers") or list(cloudwan)
+            checks = [] if expected else ["cloudwan bgp no peers"]
+            for peer_ip in expected:
+                state = cloudwan.get(peer_ip, {}).get("state", "missing")
+                if state != "Established":
+                    checks.append(f"cloudwan bgp {peer_ip} {state}")
+            # e.g. CLOUDWAN_BGP_CHECK_FAILED with every expected peer Established
+            pending.extend(checks or ["cloudwan bgp check failed"])
+
+    return pending
+
+
+def wait_for_convergence(after_phase, configs, routers=None,
+                         timeout=CONVERGENCE_TIMEOUT, interval=CONVERGENCE_POLL_INTERVAL):
+    """Poll routers until they reach the state expected after a phase.
+
+    Routers that have converged are not polled again. All pending routers are
+    checked concurrently on every poll.
+
+    Args:
+        after_phase: One of phase1, phase2, phase3
+        configs: Dict from get_instance_configs()
+        routers: Router names to check (default: all discovered routers,
+                 see phase4_handler.get_routers)
+        timeout: Max seconds to wait
+        interval: Seconds between polls
+
+    Returns:
+        dict: convergence_seconds (float), router_convergence_seconds (dict),
+              polls (int)
+
+    Raises:
+        ConvergenceError: If routers are missing or have not converged in time
+        ValueError: If after_phase is unknown or, by default, a discovered
+                    router has no tunnel (see phase4_handler.get_routers)
+    """
+    if after_phase not in PHASES:
+        raise ValueError(f"Unknown phase: {after_phase}. Expected one of: {list(PHASES)}")
+
+    routers = list(get_routers(configs) if routers is None else routers)
+    missing = [r for r in routers if r not in configs]
+    if missing:
+        raise ConvergenceError(f"Instance config not found for {', '.join(missing)}")
+
+    start = time.time()
+    pending = {r: ["not checked"] for r in routers}
+    router_seconds = {}
+    polls = 0
+
+    while True:
+        polls += 1
+        targets = {
+            r: {
+                "instance_id": configs[r]["instance_id"],
+                "region": configs[r]["region"],
+                "commands": build_verify_command(
+                    r, configs=configs if after_phase == "phase3" else None, ping=False
+                ),
+            }
+            for r in pending
+        }
+        with tracing.span("convergence.check", after_phase=after_phase, poll=polls,
+                          pending=len(targets)):
+            results = run_commands(targets, timeout=CHECK_TIMEOUT)
+
+        elapsed = time.time() - start
+        for router_name, result in results.items():
+            if result["status"] != "Success":
+                pending[router_name] = [f"check command {result['status']}"]
+                continue
+            details = parse_verify_output(result["stdout"], router_name, configs=configs)
+            checks = get_pending_checks(router_name, details, after_phase)
+            if checks:
+                pending[router_name] = checks
+            else:
+                router_seconds[router_name] = round(elapsed, 1)
+                del pending[router_name]
+
+        print(f"{after_phase} convergence poll {polls}: "
+              f"{len(routers) - len(pending)}/{len(routers)} converged after {elapsed:.0f}s")
+
+        if not pending:
+            break
+        if elapsed + interval > timeout:
+            summary = "; ".join(
+                f"{r}: {', '.join(checks)}" for r, checks in sorted(pending.items())
+            )
+            raise ConvergenceError(
+                f"{after_phase} did not converge within {timeout}s: {summary}"
+            )
+        time.sleep(interval)
+
+    metrics.put("ConvergenceSeconds", time.time() - start, "Seconds")
+    metrics.put("ConvergencePolls", polls)
+    for seconds in router_seconds.values():
+        metrics.put("RouterConvergenceSeconds", seconds, "Seconds")
+
+    return {
+        "convergence_seconds": round(time.time() - start, 1),
+        "router_convergence_seconds": router_seconds,
+        "polls": polls,
+    }
+
+
+def scoped_routers(event, configs, after_phase):
+    """Return the routers the convergence check waits on.
+
+    The state machine passes the result of the phase that just ran as
+    phase_result. If that phase ran on a selection, the check waits on the
+    same routers: those matching its routers/role/region selectors and, with
+    only_failed, only the ones the phase dispatched. Otherwise the selectors
+    in the event itself apply (see ssm_utils.select_routers()).
+
+    Returns:
+        list: Router names
+    """
+    phase_result = event.get("phase_result") or {}
+    selection = phase_result.get("selection")
+    if not selection:
+        return select_routers(get_routers(configs), configs, event, after_phase)[0]
+
+    selectors = {k: selection[k] for k in ("routers", "role", "region") if k in selection}
+    names, _ = select_routers(get_routers(configs), configs, selectors, after_phase)
+    if selection.get("only_failed"):
+        if phase_result.get("results_truncated") and "results_ref" not in phase_result:
+            print(f"WARNING: {after_phase} results were truncated without being stored; "
+                  f"waiting on all {len(names)} selected routers")
+        else:
+            dispatched = set(output_store.load_results(phase_result))
+            names = [n for n in names if n in dispatched]
+    print(f"Waiting on the {len(names)} routers {after_phase} ran on")
+    return names
+
+
+@instrumented
+@tracing.traced("convergence")
+@metrics.emits_metrics("convergence")
+@profiled
+def handler(event, context):
+    """Lambda handler for the convergence check between phases.
+
+    Args:
+        event: Lambda event with after_phase (phase1, phase2 or phase3),
+               optional timeout_seconds overriding CONVERGENCE_TIMEOUT,
+               optional phase_result of that phase and optional router
+               selectors (see scoped_routers())
+        context: Lambda context object
+
+    Returns:
+        dict: Structured result:
+            - phase: "convergence"
+            - after_phase: the phase that was waited on
+            - converged: True
+            - convergence_seconds: wall-clock until all routers converged
+            - router_convergence_seconds: per-router convergence time
+            - polls: number of poll rounds
+
+    Raises:
+        ConvergenceError: Lists the non-converged routers and peers
+    """
+    after_phase = event.get("after_phase", "phase2")
+    timeout = int(event.get("timeout_seconds", CONVERGENCE_TIMEOUT))
+    metrics.set_property("AfterPhase", after_phase)
+
+    configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
+    routers = scoped_routers(event, configs, after_phase)
+    result = wait_for_convergence(after_phase, configs, routers=routers, timeout=timeout)
+
+    return {
+        "phase": "convergence",
+        "after_phase": after_phase,
+        "converged": True,
+        **result,
+    }
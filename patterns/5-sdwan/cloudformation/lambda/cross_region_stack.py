@@ -3,19 +3,130 @@ CloudFormation Custom Resource Lambda that deploys/updates/deletes a stack
 in a remote region and returns its outputs.
 
 Uses TemplateBody instead of TemplateURL to avoid cross-region S3 access
-issues with CloudFormation service principal.
+issues with CloudFormation service principal. Templates over the 51,200 byte
+TemplateBody limit are staged in a bucket in the target region
+(STAGING_BUCKET, "{region}" is replaced) under a content-addressed key and
+passed as TemplateURL; a copy that already exists is not uploaded again.
+
+The handler is re-entrant: it starts the stack operation, polls it until the
+invocation is close to its timeout, then re-invokes itself asynchronously
+with the operation state in the event under CrossRegionState. The response
+to CloudFormation is only sent once the stack reaches a terminal status, so
+stack operations may take longer than the Lambda timeout.
+
+Each poll reads only the stack events that are new since the last poll, for
+the stack and any nested stacks it creates. The first failed resource is
+acted on right away: a failed create is deleted and reported, a failing
+update is cancelled so the rollback starts without waiting for the rest of
+the update.
+
+Templates are cached across warm invocations and re-validated with a
+conditional GET on their ETag. An Update whose template, parameters and tags
+hash to the content already deployed returns the stack outputs without
+calling UpdateStack, as long as the stack is stable, not drifted and was not
+updated by anyone else since.
+
+Other updates go through a change set, which is executed only if it
+contains changes. A summary of the changes (adds, modifies, removes and
+resources that will be replaced) and the deploy time are returned in the
+custom resource Data as ChangeSummary and DeploySeconds.
+
+With a Targets list instead of a single Region, the stacks of all targets
+are deployed concurrently and their outputs returned as
+"<name>.<OutputKey>" (name defaults to the region). With FailFast (the
+default), the first failed target stops the others and creates are cleaned
+up in parallel. An Update creates the stacks of added targets and deletes
+those of removed targets (RemovedTargets: Retain leaves them in place).
 """
+import hashlib
 import json
-import boto3
-import urllib.request
+import os
 import re
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import instrumented
+from profiling import profiled
+from ssm_utils import get_client
+
+
+# Seconds between stack event polls
+POLL_INTERVAL = int(os.environ.get("STACK_POLL_INTERVAL", "10"))
+
+# Re-invoke when less than this many milliseconds remain in the invocation
+REINVOKE_MARGIN_MS = int(os.environ.get("REINVOKE_MARGIN_MS", "60000"))
+
+# CloudFormation waits up to one hour for a custom resource response
+MAX_WAIT_SECONDS = int(os.environ.get("MAX_WAIT_SECONDS", "3300"))
+
+# Max targets started or polled at the same time
+MAX_PARALLEL_TARGETS = int(os.environ.get("MAX_PARALLEL_TARGETS", "8"))
+
+# Largest template CloudFormation accepts as TemplateBody (bytes)
+TEMPLATE_BODY_LIMIT = 51200
+
+# Regional bucket for larger templates; "{region}" is replaced by the target region
+STAGING_BUCKET = os.environ.get("STAGING_BUCKET", "")
+STAGING_PREFIX = "templates/"
+BUCKET_NAME_PATTERN = re.compile(r"^[a-z0-9][a-z0-9.-]{1,61}[a-z0-9]$")
+
+# Event key carrying the operation state between invocations
+STATE_KEY = "CrossRegionState"
+
+# Status that ends each operation successfully
+SUCCESS_STATUSES = {
+    "CREATE": "CREATE_COMPLETE",
+    "UPDATE": "UPDATE_COMPLETE",
+    "DELETE": "DELETE_COMPLETE",
+}
+
+# Reasons given to resources CloudFormation stopped because another one failed
+CANCELLED_REASONS = ("Resource creation cancelled", "Resource update cancelled")
+
+# Change set StatusReason fragments meaning there is nothing to deploy
+NO_CHANGE_REASONS = ("didn't contain changes", "No updates are to be performed")
+
+# Statuses in which a stack holds exactly the last deployed template
+STABLE_STATUSES = ("CREATE_COMPLETE", "UPDATE_COMPLETE")
+
+# Templates by S3 URL ({"etag", "body", "sha256"}), kept across warm invocations
+_TEMPLATE_CACHE = {}
+
+# Content hash and stack version (_stack_version()) of the last successful
+# deploy per (region, stack name)
+_DEPLOYED = {}
+
+# (bucket, key) of templates known to be staged
+_STAGED = set()
+
+
+def physical_resource_id(event, data=None):
+    """Return the PhysicalResourceId to report for a request.
+
+    That is the StackId of a single stack, else the ID already reported for
+    the resource. A new multi-target resource (or a failed create) gets an
+    ID built from the stack name and the sorted target regions, so retries
+    and re-invocations report the same ID.
+    """
+    if (data or {}).get("StackId"):
+        return data["StackId"]
+    if event.get("PhysicalResourceId"):
+        return event["PhysicalResourceId"]
+    props = event.get("ResourceProperties", {})
+    try:
+        targets = get_targets(props)
+    except (KeyError, ValueError):
+        return event["LogicalResourceId"]
+    stack_name = props.get("StackName") or targets[0]["stack_name"]
+    return f"{stack_name}-" + "-".join(sorted({t["region"] for t in targets}))
 
 
 def send_response(event, context, status, data=None, reason=None):
     body = json.dumps({
         "Status": status,
         "Reason": reason or f"See CloudWatch Log Stream: {context.log_stream_name}",
-        "PhysicalResourceId": data.get("StackId", context.log_stream_name) if data else context.log_stream_name,
+        "PhysicalResourceId": physical_resource_id(event, data),
         "StackId": event["StackId"],
         "RequestId": event["RequestId"],
         "LogicalResourceId": event["LogicalResourceId"],
@@ -38,102 +149,760 @@ def _parse_s3_url(url):
     raise ValueError(f"Cannot parse S3 URL: {url}")
 
 
-def _fetch_template_body(template_url):
-    """Download template from S3 and return as string."""
+def fetch_template(template_url):
+    """Return a template from S3, re-using the cached copy if it is unchanged.
+
+    Sends the cached ETag as IfNoneMatch, so an unchanged template costs a
+    304 response instead of a download.
+
+    Args:
+        template_url: S3 HTTPS URL of the template
+
+    Returns:
+        dict: etag, body (str) and sha256 (hex digest of the body)
+    """
     bucket, key = _parse_s3_url(template_url)
-    s3 = boto3.client("s3")
-    resp = s3.get_object(Bucket=bucket, Key=key)
-    return resp["Body"].read().decode("utf-8")
+    s3 = get_client("s3")
+    cached = _TEMPLATE_CACHE.get(template_url)
+    kwargs = {"Bucket": bucket, "Key": key}
+    if cached:
+        kwargs["IfNoneMatch"] = cached["etag"]
+    try:
+        resp = s3.get_object(**kwargs)
+    except s3.exceptions.ClientError as e:
+        if cached and e.response["Error"]["Code"] in ("304", "NotModified"):
+            return cached
+        raise
+
+    body = resp["Body"].read()
+    entry = {
+        "etag": resp.get("ETag"),
+        "body": body.decode("utf-8"),
+        "sha256": hashlib.sha256(body).hexdigest(),
+    }
+    _TEMPLATE_CACHE[template_url] = entry
+    return entry
 
 
-def _get_failure_reason(cfn, stack_name):
-    """Get the first CREATE_FAILED resource reason from stack events."""
+def _ensure_bucket(s3, bucket, region):
     try:
-        paginator = cfn.get_paginator("describe_stack_events")
-        for page in paginator.paginate(StackName=stack_name):
-            for event in page["StackEvents"]:
-                if event["ResourceStatus"] == "CREATE_FAILED" and \
-                   event.get("ResourceStatusReason") and \
-                   "Resource creation cancelled" not in event["ResourceStatusReason"]:
-                    return f"{event['LogicalResourceId']}: {event['ResourceStatusReason']}"
+        s3.head_bucket(Bucket=bucket)
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchBucket"):
+            raise
+        kwargs = {"Bucket": bucket}
+        if region != "us-east-1":
+            kwargs["CreateBucketConfiguration"] = {"LocationConstraint": region}
+        s3.create_bucket(**kwargs)
+        print(f"Created staging bucket {bucket} in {region}")
+
+
+def stage_template(template, region, bucket=None):
+    """Copy a template into the regional staging bucket, once per content.
+
+    The key is the template's SHA-256, so unchanged templates are found with
+    a HeadObject (or the in-memory record) and never uploaded twice.
+
+    Args:
+        template: Dict from fetch_template()
+        region: Target region
+        bucket: Bucket name, default STAGING_BUCKET with {region} replaced
+
+    Returns:
+        str: HTTPS URL of the staged template in the target region
+
+    Raises:
+        ValueError: If no staging bucket is configured, or its name is not a
+                    valid bucket name
+    """
+    bucket = (bucket or STAGING_BUCKET).replace("{region}", region)
+    if not bucket:
+        raise ValueError(
+            f"Template is {len(template['body'].encode('utf-8'))} bytes, over the "
+            f"{TEMPLATE_BODY_LIMIT} byte TemplateBody limit; set STAGING_BUCKET"
+        )
+    if not BUCKET_NAME_PATTERN.match(bucket):
+        raise ValueError(
+            f"Invalid staging bucket name {bucket!r}: use 3-63 lowercase letters, "
+            "digits, dots and hyphens"
+        )
+    key = f"{STAGING_PREFIX}{template['sha256']}.template"
+    url = f"https://{bucket}.s3.{region}.amazonaws.com/{key}"
+    if (bucket, key) in _STAGED:
+        return url
+
+    s3 = get_client("s3", region)
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NoSuchBucket"):
+            raise
+        _ensure_bucket(s3, bucket, region)
+        s3.put_object(Bucket=bucket, Key=key, Body=template["body"].encode("utf-8"),
+                      ContentType="text/plain")
+        print(f"Staged template at s3://{bucket}/{key}")
+    _STAGED.add((bucket, key))
+    return url
+
+
+def template_source(template, region, bucket=None):
+    """Return the CreateStack/CreateChangeSet argument carrying the template.
+
+    Args:
+        template: Dict from fetch_template()
+        region: Target region
+        bucket: Optional staging bucket override
+
+    Returns:
+        dict: {"TemplateBody": ...} or, above TEMPLATE_BODY_LIMIT,
+              {"TemplateURL": ...} of the staged copy
+    """
+    if len(template["body"].encode("utf-8")) <= TEMPLATE_BODY_LIMIT:
+        return {"TemplateBody": template["body"]}
+    return {"TemplateURL": stage_template(template, region, bucket)}
+
+
+def content_hash(template_sha256, cfn_params, tags):
+    """Hash the template, parameters and tags that define a deploy."""
+    content = json.dumps({
+        "template": template_sha256,
+        "parameters": sorted((p["ParameterKey"], p["ParameterValue"]) for p in cfn_params),
+        "tags": sorted((t["Key"], t["Value"]) for t in tags),
+    })
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _stack_version(stack):
+    """Identify a stack's last operation: its ID and last update (or creation) time."""
+    return stack["StackId"], str(stack.get("LastUpdatedTime") or stack.get("CreationTime"))
+
+
+def _current_outputs(cfn, region, stack_name, digest, template, cfn_params, tags):
+    """Return the stack outputs if the stack already holds this content.
+
+    The stack is always described first: it must be in a stable status, not
+    reported as drifted, and carry the same parameters and tags. The hash of
+    the last deploy made by this container then stands in for the template,
+    unless the stack was updated since (out of band). Otherwise (cold start)
+    the deployed template is compared, which needs GetTemplate but no
+    UpdateStack.
+
+    Returns:
+        dict or None: Outputs as returned by _deployed_outputs(), or None if the
+        stack has to be updated
+    """
+    stack = cfn.describe_stacks(StackName=stack_name)["Stacks"][0]
+    if stack["StackStatus"] not in STABLE_STATUSES:
+        return None
+    if stack.get("DriftInformation", {}).get("StackDriftStatus") == "DRIFTED":
+        print(f"{stack_name} in {region} has drifted, updating")
+        return None
+    deployed_params = {p["ParameterKey"]: p.get("ParameterValue") for p in stack.get("Parameters", [])}
+    if any(deployed_params.get(p["ParameterKey"]) != p["ParameterValue"] for p in cfn_params):
+        return None
+    deployed_tags = sorted((t["Key"], t["Value"]) for t in stack.get("Tags", []))
+    if deployed_tags != sorted((t["Key"], t["Value"]) for t in tags):
+        return None
+
+    deployed = _DEPLOYED.get((region, stack_name))
+    if not (deployed and deployed["version"] == _stack_version(stack)):
+        body = cfn.get_template(StackName=stack_name, TemplateStage="Original")["TemplateBody"]
+        if not isinstance(body, str):
+            # boto3 returns JSON templates parsed; they are re-deployed to be safe
+            return None
+        if hashlib.sha256(body.encode("utf-8")).hexdigest() != template["sha256"]:
+            return None
+    elif deployed["hash"] != digest:
+        return None
+
+    outputs = {"StackId": stack["StackId"]}
+    for out in stack.get("Outputs", []):
+        outputs[out["OutputKey"]] = out["OutputValue"]
+    _DEPLOYED[(region, stack_name)] = {"hash": digest, "version": _stack_version(stack)}
+    return outputs
+
+
+def _latest_event_id(cfn, stack_name):
+    """Return the ID of the newest event of a stack, or None."""
+    events = cfn.describe_stack_events(StackName=stack_name)["StackEvents"]
+    return events[0]["EventId"] if events else None
+
+
+def tail_stack_events(cfn, stack_id, last_event_id=None):
+    """Return the events of a stack that are newer than last_event_id.
+
+    DescribeStackEvents lists the newest events first, so reading stops at
+    the page containing last_event_id — usually a single call per poll.
+
+    Args:
+        cfn: CloudFormation client for the stack's region
+        stack_id: Stack ID (or name)
+        last_event_id: Newest event already seen, None to read all events
+
+    Returns:
+        list: New events, oldest first
+    """
+    new_events = []
+    kwargs = {"StackName": stack_id}
+    while True:
+        page = cfn.describe_stack_events(**kwargs)
+        for event in page["StackEvents"]:
+            if event["EventId"] == last_event_id:
+                return new_events[::-1]
+            new_events.append(event)
+        if not page.get("NextToken"):
+            return new_events[::-1]
+        kwargs["NextToken"] = page["NextToken"]
+
+
+def watch_stack(cfn, state):
+    """Read the new events of the stack and its nested stacks.
+
+    Updates state in place: status and status_reason of the stack itself,
+    cursors (newest event ID per watched stack, nested stacks are added as
+    they appear) and failure (the first failed resource).
+
+    Args:
+        cfn: CloudFormation client for the stack's region
+        state: Operation state from start_operation()
+
+    Returns:
+        str or None: The first failed resource ("<LogicalId>: <reason>") if
+        it was found in this poll
+    """
+    cursors = state["cursors"]
+    pending = list(cursors)
+    resource_failure = None
+    stack_failure = None
+
+    while pending:
+        stack_id = pending.pop(0)
+        events = tail_stack_events(cfn, stack_id, cursors[stack_id])
+        if not events:
+            continue
+        cursors[stack_id] = events[-1]["EventId"]
+
+        for event in events:
+            status = event["ResourceStatus"]
+            reason = event.get("ResourceStatusReason") or ""
+            physical_id = event.get("PhysicalResourceId") or ""
+            is_stack = event.get("ResourceType") == "AWS::CloudFormation::Stack"
+
+            if is_stack and physical_id == state["stack_id"]:
+                state["status"] = status
+                state["status_reason"] = reason
+                continue
+            if is_stack and physical_id.startswith("arn:") and \
+                    physical_id != event["StackId"] and physical_id not in cursors:
+                cursors[physical_id] = None
+                pending.append(physical_id)
+
+            if status.endswith("_FAILED") and reason and \
+                    not any(c in reason for c in CANCELLED_REASONS):
+                failure = f"{event['LogicalResourceId']}: {reason}"
+                # Prefer the resource itself over the nested stack that reports it
+                if is_stack:
+                    stack_failure = stack_failure or failure
+                else:
+                    resource_failure = resource_failure or failure
+
+    failure = resource_failure or stack_failure
+    if failure and not state.get("failure"):
+        state["failure"] = failure
+        return failure
+    return None
+
+
+def summarize_changes(changes):
+    """Summarize the resource changes of a change set.
+
+    Args:
+        changes: Changes list from DescribeChangeSet
+
+    Returns:
+        dict: add, modify, remove (int), replace (list of
+              "<LogicalId>[?]" for resources that will, or conditionally
+              "?" may, be replaced) and text, a one-line summary
+    """
+    counts = {"Add": 0, "Modify": 0, "Remove": 0}
+    replace = []
+    for change in changes:
+        rc = change.get("ResourceChange", {})
+        action = rc.get("Action", "Modify")
+        counts[action] = counts.get(action, 0) + 1
+        if rc.get("Replacement") == "True":
+            replace.append(rc["LogicalResourceId"])
+        elif rc.get("Replacement") == "Conditional":
+            replace.append(f"{rc['LogicalResourceId']}?")
+
+    text = f"{counts['Add']} to add, {counts['Modify']} to modify, {counts['Remove']} to remove"
+    if replace:
+        text += f"; replaces {', '.join(replace)}"
+    return {
+        "add": counts["Add"],
+        "modify": counts["Modify"],
+        "remove": counts["Remove"],
+        "replace": replace,
+        "text": text,
+    }
+
+
+def _describe_change_set(cfn, change_set_id):
+    """Return DescribeChangeSet with the Changes of all pages."""
+    desc = cfn.describe_change_set(ChangeSetName=change_set_id)
+    changes = list(desc.get("Changes", []))
+    while desc.get("NextToken"):
+        desc = dict(desc, **cfn.describe_change_set(
+            ChangeSetName=change_set_id, NextToken=desc["NextToken"]
+        ))
+        changes.extend(desc.get("Changes", []))
+    desc["Changes"] = changes
+    return desc
+
+
+def check_change_set(cfn, state):
+    """Execute the update change set once it is ready, if it has changes.
+
+    Args:
+        cfn: CloudFormation client for the stack's region
+        state: Operation state with change_set from start_operation()
+
+    Returns:
+        tuple or None: (status, data, reason) if the update ends here
+        (no changes, or the change set failed), None otherwise
+    """
+    change_set = state["change_set"]
+    desc = _describe_change_set(cfn, change_set["id"])
+    if desc["Status"] in ("CREATE_PENDING", "CREATE_IN_PROGRESS"):
+        return None
+
+    if desc["Status"] == "FAILED":
+        reason = desc.get("StatusReason", "")
+        if not any(m in reason for m in NO_CHANGE_REASONS):
+            return ("FAILED", None, f"Change set failed: {reason}"[:256])
+        try:
+            cfn.delete_change_set(ChangeSetName=change_set["id"])
+        except cfn.exceptions.ClientError:
+            pass
+        print(f"{state['stack_name']} change set has no changes, not executing")
+        outputs = _deployed_outputs(cfn, state)
+        return ("SUCCESS", dict(outputs, ChangeSummary="No changes"), None)
+
+    change_set["summary"] = summarize_changes(desc["Changes"])["text"]
+    print(f"Executing change set for {state['stack_name']}: {change_set['summary']}")
+    cfn.execute_change_set(ChangeSetName=change_set["id"])
+    change_set["executed"] = True
+    return None
+
+
+def _delete_failed_stack(cfn, stack_id):
+    try:
+        cfn.delete_stack(StackName=stack_id)
     except Exception:
         pass
-    return "Unknown failure - check CloudWatch logs"
 
 
-def handler(event, context):
+def get_targets(props):
+    """Return the deploy targets described by the custom resource properties.
+
+    Without Targets, the resource deploys one stack (Region, StackName,
+    TemplateURL, Parameters, Tags, StagingBucket). With Targets, each item
+    needs a Region and may override Name (default: the region), StackName,
+    TemplateURL, Tags and StagingBucket; its Parameters are merged over the
+    shared Parameters.
+
+    Args:
+        props: ResourceProperties (or OldResourceProperties)
+
+    Returns:
+        list of dicts with name (None for the single-stack form), region,
+        stack_name, template_url, parameters, tags and staging_bucket
+
+    Raises:
+        ValueError: If two targets share a name
+    """
+    if "Targets" not in props:
+        return [{
+            "name": None,
+            "region": props["Region"],
+            "stack_name": props["StackName"],
+            "template_url": props.get("TemplateURL"),
+            "parameters": props.get("Parameters", {}),
+            "tags": props.get("Tags", []),
+            "staging_bucket": props.get("StagingBucket"),
+        }]
+
+    targets = []
+    for target in props["Targets"]:
+        targets.append({
+            "name": target.get("Name", target["Region"]),
+            "region": target["Region"],
+            "stack_name": target.get("StackName", props.get("StackName")),
+            "template_url": target.get("TemplateURL", props.get("TemplateURL")),
+            "parameters": {**props.get("Parameters", {}), **target.get("Parameters", {})},
+            "tags": target.get("Tags", props.get("Tags", [])),
+            "staging_bucket": target.get("StagingBucket", props.get("StagingBucket")),
+        })
+    names = [t["name"] for t in targets]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate target names: {', '.join(duplicates)}; set Name per target")
+    return targets
+
+
+def _label(state):
+    return state["name"] or state["region"]
+
+
+def _parallel(fn, items):
+    """Apply fn to every item, concurrently when there is more than one."""
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), MAX_PARALLEL_TARGETS)) as pool:
+        return list(pool.map(fn, items))
+
+
+def start_target(operation, target):
+    """Start the stack operation for one target.
+
+    Args:
+        operation: CREATE, UPDATE or DELETE
+        target: Dict from get_targets()
+
+    Returns:
+        dict: Target state with operation, name, region, stack_name,
+              stack_id, started_at and the watch_stack() fields. Contains an
+              outcome of (status, data, reason) if the target finished
+              immediately (no-op update, delete of a missing stack) or could
+              not be started.
+    """
+    region = target["region"]
+    stack_name = target["stack_name"]
+    state = {
+        "operation": operation,
+        "name": target["name"],
+        "region": region,
+        "stack_name": stack_name,
+        "stack_id": None,
+        "started_at": time.time(),
+        "status": f"{operation}_IN_PROGRESS",
+        "status_reason": "",
+        "failure": None,
+        "cursors": {},
+    }
     try:
-        props = event["ResourceProperties"]
-        region = props["Region"]
-        template_url = props["TemplateURL"]
-        stack_name = props["StackName"]
-        params = props.get("Parameters", {})
-        tags = props.get("Tags", [])
-        request_type = event["RequestType"]
-
-        cfn = boto3.client("cloudformation", region_name=region)
-        cfn_params = [{"ParameterKey": k, "ParameterValue": str(v)} for k, v in params.items()]
-
-        if request_type in ("Create", "Update"):
-            template_body = _fetch_template_body(template_url)
-
-            method = cfn.create_stack if request_type == "Create" else cfn.update_stack
-            kwargs = dict(
-                StackName=stack_name,
-                TemplateBody=template_body,
-                Parameters=cfn_params,
-                Tags=tags,
-                Capabilities=["CAPABILITY_NAMED_IAM"],
+        _start_target(state, target)
+    except Exception as e:
+        print(f"Could not start {operation} of {stack_name} in {region}: {e}")
+        state["outcome"] = ("FAILED", None, str(e)[:256])
+    return state
+
+
+def _start_target(state, target):
+    operation = state["operation"]
+    region = state["region"]
+    stack_name = state["stack_name"]
+    cfn = get_client("cloudformation", region)
+    cursor = None
+
+    if operation in ("CREATE", "UPDATE"):
+        template = fetch_template(target["template_url"])
+        cfn_params = [
+            {"ParameterKey": k, "ParameterValue": str(v)}
+            for k, v in target["parameters"].items()
+        ]
+        tags = target["tags"]
+        state["content_hash"] = content_hash(template["sha256"], cfn_params, tags)
+
+        if operation == "UPDATE":
+            outputs = _current_outputs(cfn, region, stack_name, state["content_hash"],
+                                       template, cfn_params, tags)
+            if outputs:
+                print(f"{stack_name} in {region} is up to date, skipping UpdateStack")
+                state["outcome"] = ("SUCCESS", dict(outputs, ChangeSummary="No changes"), None)
+                return
+
+        kwargs = dict(
+            StackName=stack_name,
+            Parameters=cfn_params,
+            Tags=tags,
+            Capabilities=["CAPABILITY_NAMED_IAM"],
+            **template_source(template, region, target.get("staging_bucket")),
+        )
+        if operation == "CREATE":
+            # Disable rollback so we can inspect failures
+            resp = cfn.create_stack(DisableRollback=True, **kwargs)
+        else:
+            # Creating a change set adds no stack events, so the cursor stays valid
+            cursor = _latest_event_id(cfn, stack_name)
+            resp = cfn.create_change_set(
+                ChangeSetName=f"cross-region-{int(time.time())}",
+                ChangeSetType="UPDATE",
+                **kwargs,
             )
-            # On Create, disable rollback so we can inspect failures
-            if request_type == "Create":
-                kwargs["DisableRollback"] = True
+            state["change_set"] = {"id": resp["Id"], "executed": False, "summary": None}
+        state["stack_id"] = resp["StackId"]
 
-            try:
-                method(**kwargs)
-            except cfn.exceptions.ClientError as e:
-                if "No updates are to be performed" in str(e):
-                    outputs = _get_outputs(cfn, stack_name)
-                    send_response(event, context, "SUCCESS", outputs)
-                    return
+    else:
+        try:
+            stack = cfn.describe_stacks(StackName=stack_name)["Stacks"][0]
+        except cfn.exceptions.ClientError as e:
+            if "does not exist" not in str(e):
                 raise
+            state["outcome"] = ("SUCCESS", None, None)
+            return
+        state["stack_id"] = stack["StackId"]
+        cursor = _latest_event_id(cfn, state["stack_id"])
+        cfn.delete_stack(StackName=state["stack_id"])
 
-            waiter_name = "stack_create_complete" if request_type == "Create" else "stack_update_complete"
-            waiter = cfn.get_waiter(waiter_name)
-            try:
-                waiter.wait(StackName=stack_name, WaiterConfig={"Delay": 30, "MaxAttempts": 120})
-            except Exception as wait_err:
-                # Get the actual failure reason from stack events
-                reason = _get_failure_reason(cfn, stack_name)
-                # Clean up the failed stack
-                try:
-                    cfn.delete_stack(StackName=stack_name)
-                except Exception:
-                    pass
-                send_response(event, context, "FAILED", reason=reason[:256])
-                return
+    state["cursors"] = {state["stack_id"]: cursor}
+    print(f"Started {operation} of {stack_name} in {region}: {state['stack_id']}")
+
+
+def start_operation(event):
+    """Start the stack operations for a custom resource request.
 
-            outputs = _get_outputs(cfn, stack_name)
-            send_response(event, context, "SUCCESS", outputs)
+    All targets are started concurrently. On Update, targets that are not
+    in OldResourceProperties are created, and targets that were removed
+    from the Targets list are deleted, or left in place with
+    RemovedTargets: Retain. A renamed or moved single stack is created
+    here and its old stack is left to the Delete that CloudFormation sends
+    when it cleans up the replaced resource.
 
-        elif request_type == "Delete":
+    Args:
+        event: Custom resource event
+
+    Returns:
+        dict: Operation state with targets (list of start_target() states),
+              started_at, invocations, fail_fast and aborted
+    """
+    request_type = event["RequestType"]
+    if request_type not in ("Create", "Update", "Delete"):
+        raise ValueError(f"Unknown RequestType: {request_type}")
+
+    props = event["ResourceProperties"]
+    targets = get_targets(props)
+    operations = [(request_type.upper(), t) for t in targets]
+    if request_type == "Update" and event.get("OldResourceProperties"):
+        old_targets = get_targets(event["OldResourceProperties"])
+        previous = {(t["region"], t["stack_name"]) for t in old_targets}
+        operations = [
+            ("UPDATE" if (t["region"], t["stack_name"]) in previous else "CREATE", t)
+            for t in targets
+        ]
+        # A moved single stack gets a new StackId (physical ID), so the old
+        # one is deleted by CloudFormation's cleanup Delete, not here
+        current = {(t["region"], t["stack_name"]) for t in targets}
+        removed = [
+            t for t in old_targets
+            if "Targets" in props and (t["region"], t["stack_name"]) not in current
+        ]
+        if removed and str(props.get("RemovedTargets", "Delete")).lower() == "retain":
+            print(f"Retaining {len(removed)} removed target(s): "
+                  + ", ".join(f"{t['stack_name']} in {t['region']}" for t in removed))
+        else:
+            operations += [("DELETE", t) for t in removed]
+
+    return {
+        "targets": _parallel(lambda op: start_target(*op), operations),
+        "started_at": time.time(),
+        "invocations": 1,
+        "fail_fast": str(props.get("FailFast", "true")).lower() == "true",
+        "aborted": False,
+    }
+
+
+def check_target(state):
+    """Check a running stack operation of one target once.
+
+    Acts on the first failed resource as soon as it appears: a failed create
+    is deleted and reported at once, a failing update is cancelled so that
+    CloudFormation starts the rollback.
+
+    Args:
+        state: Target state from start_target()
+
+    Returns:
+        tuple or None: (status, data, reason) once the stack reached a
+        terminal status, None while the operation is still in progress
+    """
+    if state.get("outcome"):
+        return state["outcome"]
+
+    cfn = get_client("cloudformation", state["region"])
+    operation = state["operation"]
+    change_set = state.get("change_set")
+    if change_set and not change_set["executed"]:
+        return check_change_set(cfn, state)
+
+    failure = watch_stack(cfn, state)
+    status = state["status"]
+
+    if failure:
+        print(f"{operation} of {state['stack_name']} in {state['region']} "
+              f"failed ({status}): {failure}")
+        if operation == "CREATE":
+            _delete_failed_stack(cfn, state["stack_id"])
+            return ("FAILED", None, f"CREATE_FAILED: {failure}"[:256])
+        if operation == "UPDATE" and status == "UPDATE_IN_PROGRESS":
             try:
-                cfn.delete_stack(StackName=stack_name)
-                waiter = cfn.get_waiter("stack_delete_complete")
-                waiter.wait(StackName=stack_name, WaiterConfig={"Delay": 30, "MaxAttempts": 120})
+                cfn.cancel_update_stack(StackName=state["stack_id"])
             except cfn.exceptions.ClientError as e:
-                if "does not exist" not in str(e):
-                    raise
-            send_response(event, context, "SUCCESS")
+                print(f"Could not cancel update: {e}")
+
+    if status.endswith("_IN_PROGRESS"):
+        return None
+
+    if status == SUCCESS_STATUSES[operation]:
+        key = (state["region"], state["stack_name"])
+        if operation == "DELETE":
+            _DEPLOYED.pop(key, None)
+            return ("SUCCESS", None, None)
+        outputs = _deployed_outputs(cfn, state)
+        data = dict(outputs, DeploySeconds=str(round(time.time() - state["started_at"])))
+        if change_set:
+            data["ChangeSummary"] = change_set["summary"]
+        return ("SUCCESS", data, None)
+
+    # The stack no longer matches any recorded deploy
+    _DEPLOYED.pop((state["region"], state["stack_name"]), None)
+    reason = state.get("failure") or state.get("status_reason") or \
+        "Unknown failure - check CloudWatch logs"
+    print(f"{operation} of {state['stack_name']} in {state['region']} ended in {status}: {reason}")
+    if operation == "CREATE":
+        _delete_failed_stack(cfn, state["stack_id"])
+    return ("FAILED", None, f"{status}: {reason}"[:256])
+
+
+def abort_target(state):
+    """Stop one target after another target failed (fail fast).
+
+    Creates are deleted, including ones that already completed, so no
+    partial deploy is left behind. Updates that have not been executed are
+    dropped; running updates are cancelled and roll back. Deletes continue.
+    """
+    cfn = get_client("cloudformation", state["region"])
+    outcome = state.get("outcome")
+    if state["operation"] == "CREATE" and state["stack_id"] and \
+            (not outcome or outcome[0] == "SUCCESS"):
+        _delete_failed_stack(cfn, state["stack_id"])
+        state["outcome"] = ("FAILED", None, "Deleted after another target failed")
+    elif state["operation"] == "UPDATE" and not outcome:
+        change_set = state.get("change_set")
+        try:
+            if change_set and not change_set["executed"]:
+                cfn.delete_change_set(ChangeSetName=change_set["id"])
+                state["outcome"] = ("FAILED", None, "Not executed, another target failed")
+            else:
+                cfn.cancel_update_stack(StackName=state["stack_id"])
+        except cfn.exceptions.ClientError as e:
+            print(f"Could not stop update of {state['stack_name']} in {state['region']}: {e}")
+
+
+def check_operation(state):
+    """Check all targets once and combine their outcomes.
+
+    With fail_fast, the first failed target stops all others (see
+    abort_target()); rolled-back updates are still waited for so that the
+    response is only sent once every stack is stable.
+
+    Args:
+        state: Operation state from start_operation()
+
+    Returns:
+        tuple or None: (status, data, reason) once every target finished,
+        None while any is still in progress. Data holds the outputs of the
+        single stack, or "<name>.<OutputKey>" for every target.
+    """
+    targets = state["targets"]
+    pending = [t for t in targets if not t.get("outcome")]
+    for target, outcome in zip(pending, _parallel(check_target, pending)):
+        if outcome:
+            target["outcome"] = outcome
+
+    failed = [t for t in targets if t.get("outcome") and t["outcome"][0] == "FAILED"]
+    if failed and state["fail_fast"] and not state["aborted"]:
+        state["aborted"] = True
+        others = [t for t in targets if t not in failed]
+        if others:
+            print(f"{_label(failed[0])} failed, stopping {len(others)} other target(s)")
+            _parallel(abort_target, others)
+
+    if any(not t.get("outcome") for t in targets):
+        return None
+
+    if failed:
+        reasons = [f"{_label(t)}: {t['outcome'][2]}" for t in failed]
+        others = [f"{_label(t)}: {t['outcome'][2]}" for t in targets
+                  if t["outcome"][0] == "FAILED" and t not in failed]
+        return ("FAILED", None, "; ".join(reasons + others)[:256])
+
+    data = {}
+    for target in targets:
+        outputs = target["outcome"][1]
+        if target["operation"] == "DELETE" or not outputs:
+            continue
+        for key, value in outputs.items():
+            data[key if target["name"] is None else f"{target['name']}.{key}"] = value
+    return ("SUCCESS", data or None, None)
+
+
+def reinvoke(event, context, state):
+    """Continue polling in a new asynchronous invocation of this function."""
+    state["invocations"] += 1
+    payload = dict(event, **{STATE_KEY: state})
+    get_client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(payload).encode("utf-8"),
+    )
+    pending = [_label(t) for t in state["targets"] if not t.get("outcome")]
+    print(f"Re-invoked to keep polling {', '.join(pending)} "
+          f"(invocation {state['invocations']})")
+
+
+@instrumented
+@profiled
+def handler(event, context):
+    try:
+        state = event.get(STATE_KEY) or start_operation(event)
+
+        while True:
+            outcome = check_operation(state)
+            if outcome:
+                status, data, reason = outcome
+                send_response(event, context, status, data, reason=reason)
+                return
+
+            if time.time() - state["started_at"] > MAX_WAIT_SECONDS:
+                pending = [
+                    f"{t['stack_name']} in {t['region']}"
+                    for t in state["targets"] if not t.get("outcome")
+                ]
+                send_response(
+                    event, context, "FAILED",
+                    reason=f"Timed out after {MAX_WAIT_SECONDS}s waiting for "
+                           f"{', '.join(pending)}"[:256],
+                )
+                return
+
+            remaining = context.get_remaining_time_in_millis()
+            if remaining < REINVOKE_MARGIN_MS + POLL_INTERVAL * 1000:
+                reinvoke(event, context, state)
+                return
+            time.sleep(POLL_INTERVAL)
 
     except Exception as e:
         print(f"Error: {e}")
         send_response(event, context, "FAILED", reason=str(e)[:256])
 
 
-def _get_outputs(cfn, stack_name):
-    resp = cfn.describe_stacks(StackName=stack_name)
-    stack = resp["Stacks"][0]
+def _deployed_outputs(cfn, state):
+    """Return the outputs of a stack that now holds the target's content, and record the deploy."""
+    stack = cfn.describe_stacks(StackName=state["stack_id"])["Stacks"][0]
+    _DEPLOYED[(state["region"], state["stack_name"])] = {
+        "hash": state["content_hash"], "version": _stack_version(stack),
+    }
     data = {"StackId": stack["StackId"]}
     for out in stack.get("Outputs", []):
         data[out["OutputKey"]] = out["OutputValue"]
@@ -0,0 +1,193 @@
+"""
+Bounded phase results: command output offload for the Step Functions state.
+
+Step Functions state is limited to 256 KB, and every phase result used to
+carry the full stdout/stderr of every router. The handlers now pass each
+router result through offload(), which keeps only the last
+OUTPUT_TAIL_BYTES of each stream in the result, with its size and SHA-256,
+and writes the full text to the output store. Before returning, a handler
+passes its result through bound_results(): if the per-router results are
+still larger than RESULTS_INLINE_LIMIT, they are written to the store as
+one JSON object and the state keeps only a reference plus the first
+MAX_INLINE_FAILURES failed routers. The state then stays the same size
+however many routers there are; load_results() and load_output() follow
+the references.
+
+The store is selected with OUTPUT_STORE:
+
+- none (default): output beyond the tail is dropped (the digest is kept)
+- s3: s3://OUTPUT_S3_BUCKET/OUTPUT_S3_PREFIX/<run_id>/<phase>/<router>/stdout.txt
+  and .../<run_id>/<phase>/results.json
+- local: the same layout under OUTPUT_LOCAL_DIR (for offline runs)
+
+SSM's GetCommandInvocation returns at most 24,000 characters of output, so
+this is also the most a store can hold per stream.
+"""
+
+import hashlib
+import json
+import os
+
+from ssm_utils import get_client
+
+
+OUTPUT_STORE = os.environ.get("OUTPUT_STORE", "none")
+OUTPUT_S3_BUCKET = os.environ.get("OUTPUT_S3_BUCKET", os.environ.get("REPORT_S3_BUCKET", ""))
+OUTPUT_S3_PREFIX = os.environ.get("OUTPUT_S3_PREFIX", "sdwan/outputs")
+OUTPUT_LOCAL_DIR = os.environ.get("OUTPUT_LOCAL_DIR", "/tmp/sdwan-outputs")
+
+# Bytes of stdout/stderr kept in the state per router and stream
+OUTPUT_TAIL_BYTES = int(os.environ.get("OUTPUT_TAIL_BYTES", "1024"))
+
+# Max serialized size of a phase's per-router results kept in the state;
+# five phase results must fit the 256 KB state limit together
+RESULTS_INLINE_LIMIT = int(os.environ.get("RESULTS_INLINE_LIMIT", "32768"))
+
+# Failed routers kept in the state when the results are offloaded
+MAX_INLINE_FAILURES = 10
+
+
+class S3OutputStore:
+    """Store outputs as S3 objects."""
+
+    def __init__(self, bucket, prefix="sdwan/outputs"):
+        if not bucket:
+            raise ValueError("OUTPUT_S3_BUCKET (or REPORT_S3_BUCKET) must be set for OUTPUT_STORE=s3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def put(self, key, data, content_type="text/plain"):
+        key = f"{self.prefix}/{key}"
+        get_client("s3").put_object(Bucket=self.bucket, Key=key, Body=data,
+                                    ContentType=content_type)
+        return f"s3://{self.bucket}/{key}"
+
+
+class LocalOutputStore:
+    """Store outputs as files under a directory."""
+
+    def __init__(self, directory="/tmp/sdwan-outputs"):
+        self.directory = directory
+
+    def put(self, key, data, content_type=None):
+        path = os.path.abspath(os.path.join(self.directory, key))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+
+def get_store(kind=None):
+    """Return the output store selected by OUTPUT_STORE (or kind), None for none."""
+    kind = kind or OUTPUT_STORE
+    if kind == "none":
+        return None
+    if kind == "s3":
+        return S3OutputStore(OUTPUT_S3_BUCKET, OUTPUT_S3_PREFIX)
+    if kind == "local":
+        return LocalOutputStore(OUTPUT_LOCAL_DIR)
+    raise ValueError(f"Unknown OUTPUT_STORE: {kind}. Expected one of: none, s3, local")
+
+
+def read_ref(ref):
+    """Return the bytes behind a reference written by a store."""
+    if ref.startswith("s3://"):
+        bucket, _, key = ref[len("s3://"):].partition("/")
+        return get_client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+    with open(ref, "rb") as f:
+        return f.read()
+
+
+def tail(data, limit=OUTPUT_TAIL_BYTES):
+    """Return the last limit bytes of data as text, marking what was cut."""
+    if len(data) <= limit:
+        return data.decode("utf-8", errors="replace")
+    kept = data[-limit:].decode("utf-8", errors="ignore")
+    return f"[... {len(data) - limit} bytes truncated ...]\n{kept}"
+
+
+def _put(store, key, data, content_type="text/plain"):
+    # Offloading must not fail a phase; the digest still identifies the output
+    try:
+        return store.put(key, data, content_type)
+    except Exception as e:
+        print(f"Failed to store {key} via {OUTPUT_STORE} output store: {e}")
+        return None
+
+
+def offload(result, run_id, phase, name, store=None):
+    """Cap the stdout/stderr of one router result in place.
+
+    Streams longer than OUTPUT_TAIL_BYTES are replaced by their tail, with
+    <stream>_bytes, <stream>_sha256 and (if stored) <stream>_ref added.
+
+    Args:
+        result: Result dict from send_and_wait()/run_commands()
+        run_id: Pipeline run ID
+        phase: Phase name
+        name: Router (or pair) name
+        store: Output store (default: get_store())
+
+    Returns:
+        dict: The same result
+    """
+    store = store if store is not None else get_store()
+    for stream in ("stdout", "stderr"):
+        data = (result.get(stream) or "").encode("utf-8")
+        if len(data) <= OUTPUT_TAIL_BYTES:
+            continue
+        result[stream] = tail(data)
+        result[f"{stream}_bytes"] = len(data)
+        result[f"{stream}_sha256"] = hashlib.sha256(data).hexdigest()
+        if store is not None:
+            ref = _put(store, f"{run_id}/{phase}/{name}/{stream}.txt", data)
+            if ref:
+                result[f"{stream}_ref"] = ref
+    return result
+
+
+def bound_results(phase_result, run_id, store=None):
+    """Move a phase's per-router results out of the state if they are too large.
+
+    Adds results_count, results_sha256, results_truncated and (if stored)
+    results_ref, and keeps only the first MAX_INLINE_FAILURES failed
+    routers under results.
+
+    Returns:
+        dict: The same phase result
+    """
+    results = phase_result.get("results") or {}
+    body = json.dumps(results, separators=(",", ":"), default=str).encode("utf-8")
+    if len(body) <= RESULTS_INLINE_LIMIT:
+        return phase_result
+
+    store = store if store is not None else get_store()
+    failed = sorted(n for n, r in results.items() if r.get("status") not in ("Success", "Skipped"))
+    phase_result["results"] = {n: results[n] for n in failed[:MAX_INLINE_FAILURES]}
+    phase_result["results_count"] = len(results)
+    phase_result["results_sha256"] = hashlib.sha256(body).hexdigest()
+    phase_result["results_truncated"] = True
+    if store is not None:
+        ref = _put(store, f"{run_id}/{phase_result.get('phase', 'results')}/results.json",
+                   body, "application/json")
+        if ref:
+            phase_result["results_ref"] = ref
+    print(f"Results of {len(results)} routers ({len(body)} bytes) moved out of the state"
+          + (f" to {phase_result['results_ref']}" if "results_ref" in phase_result else ""))
+    return phase_result
+
+
+def load_results(phase_result):
+    """Return the full per-router results of a phase result, following results_ref."""
+    ref = phase_result.get("results_ref")
+    if ref:
+        return json.loads(read_ref(ref))
+    return phase_result.get("results", {})
+
+
+def load_output(result, stream="stdout"):
+    """Return the full stdout/stderr of a router result, following <stream>_ref."""
+    ref = result.get(f"{stream}_ref")
+    if ref:
+        return read_ref(ref).decode("utf-8")
+    return result.get(stream, "")
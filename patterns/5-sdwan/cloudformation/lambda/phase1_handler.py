@@ -8,7 +8,20 @@ Replicates the logic from phase1-base-setup.sh as an AWS Lambda function.
 """
 
 import os
-from ssm_utils import get_instance_configs, send_and_wait
+
+import metrics
+import output_store
+import tracing
+from instrumentation import instrumented
+from profiling import profiled
+from report_sinks import get_run_id
+from ssm_utils import (
+    discovered_routers,
+    get_instance_configs,
+    run_phase,
+    seed_agents,
+    select_routers,
+)
 
 
 # Configurable via environment variables (with defaults matching the bash script)
@@ -159,6 +172,20 @@ lxc exec router -- chown -R vyos:vyattacfg /opt/vyatta/etc/quagga || echo "WARNI
 """
 
 
+def build_command(router_name, configs):
+    """Return the Phase 1 SSM command for one router (the same for every router)."""
+    return build_phase1_commands()
+
+
+def get_routers(configs):
+    """Return the routers Phase 1 applies to: every discovered router."""
+    return discovered_routers(configs, "phase1")
+
+
+@instrumented
+@tracing.traced("phase1")
+@metrics.emits_metrics("phase1")
+@profiled
 def handler(event, context):
     """Lambda handler for Phase 1 base setup.
 
@@ -166,7 +193,9 @@ def handler(event, context):
     command payload, and executes it on each instance via SSM RunShellScript.
 
     Args:
-        event: Lambda event (passed from Step Functions, may contain prior phase results)
+        event: Lambda event (passed from Step Functions, may contain prior phase results,
+               fail_fast to override FAIL_FAST, and router selectors
+               such as only_failed, see ssm_utils.select_routers)
         context: Lambda context object
 
     Returns:
@@ -175,38 +204,27 @@ def handler(event, context):
             - results: dict keyed by instance name with status details
             - success_count: number of successful instances
             - fail_count: number of failed instances
+            - agents: SSM agent check reused by the next phase (see ssm_utils.agent_snapshot)
+            - aborted: fail-fast reason, if the phase stopped early (see ssm_utils.run_phase)
+            - selection: the router selectors and selected count, if the event had any
     """
     # Load instance configurations from SSM Parameter Store
     configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
+    seed_agents(event, configs)
+    run_id = get_run_id(event, context)
+
+    names, selection = select_routers(get_routers(configs), configs, event, "phase1")
+
+    phase = run_phase(
+        configs,
+        names,
+        build_command,
+        timeout=SSM_TIMEOUT,
+        fail_fast=event.get("fail_fast"),
+        on_result=lambda name, result: output_store.offload(result, run_id, "phase1", name),
+    )
+
+    if selection:
+        phase["selection"] = selection
 
-    # Build the command payload once (same for all instances)
-    commands = build_phase1_commands()
-
-    results = {}
-    success_count = 0
-    fail_count = 0
-
-    for instance_name, config in configs.items():
-        instance_id = config["instance_id"]
-        region = config["region"]
-
-        result = send_and_wait(
-            instance_id=instance_id,
-            region=region,
-            commands=commands,
-            timeout=SSM_TIMEOUT,
-        )
-
-        results[instance_name] = result
-
-        if result["status"] == "Success":
-            success_count += 1
-        else:
-            fail_count += 1
-
-    return {
-        "phase": "phase1",
-        "results": results,
-        "success_count": success_count,
-        "fail_count": fail_count,
-    }
+    return output_store.bound_results({"phase": "phase1", **phase}, run_id)
@@ -8,7 +8,15 @@ Replicates the logic from phase2-vpn-bgp-config.sh as an AWS Lambda function.
 """
 
 import os
-from ssm_utils import get_instance_configs, send_and_wait
+
+import metrics
+import output_store
+import tracing
+from instrumentation import instrumented
+from profiling import profiled
+from report_sinks import get_run_id
+from rollout import run_rollout
+from ssm_utils import discovered_routers, get_instance_configs, seed_agents, select_routers
 
 
 # Configurable via environment variables
@@ -236,6 +244,32 @@ lxc exec router -- /tmp/vyos-vpn.sh
 """.format(vpn_script=vpn_script)
 
 
+def build_command(router_name, configs):
+    """Return the Phase 2 SSM command for one router.
+
+    Args:
+        router_name: One of the ROUTER_CONFIG routers
+        configs: Dict from get_instance_configs()
+
+    Returns:
+        str: Shell script for SSM RunShellScript
+    """
+    return build_ssm_command(build_vpn_bgp_script(router_name, configs))
+
+
+def get_routers(configs):
+    """Return the routers Phase 2 applies to: every discovered router.
+
+    Raises:
+        ValueError: If a discovered router has no ROUTER_CONFIG entry
+    """
+    return discovered_routers(configs, "phase2", topology=ROUTER_CONFIG)
+
+
+@instrumented
+@tracing.traced("phase2")
+@metrics.emits_metrics("phase2")
+@profiled
 def handler(event, context):
     """Lambda handler for Phase 2 VPN/BGP configuration.
 
@@ -243,7 +277,10 @@ def handler(event, context):
     vbash scripts for IPsec VPN and BGP, and executes them via SSM.
 
     Args:
-        event: Lambda event (passed from Step Functions, may contain Phase1 results)
+        event: Lambda event (passed from Step Functions, may contain Phase1 results,
+               fail_fast to override FAIL_FAST, rollout to override ROLLOUT (see
+               rollout.parse_rollout), and router selectors such as only_failed,
+               see ssm_utils.select_routers)
         context: Lambda context object
 
     Returns:
@@ -252,51 +289,29 @@ def handler(event, context):
             - results: dict keyed by instance name with status details
             - success_count: number of successful instances
             - fail_count: number of failed instances
+            - agents: SSM agent check reused by the next phase (see ssm_utils.agent_snapshot)
+            - aborted: fail-fast or rollout halt reason, if the phase stopped early
+            - waves: per-wave size, failures and health gate, for a rollout
+            - selection: the router selectors and selected count, if the event had any
     """
     configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
-
-    results = {}
-    success_count = 0
-    fail_count = 0
-
-    for router_name in ROUTER_CONFIG:
-        if router_name not in configs:
-            results[router_name] = {
-                "status": "Failed",
-                "command_id": "",
-                "instance_id": "",
-                "stdout": "",
-                "stderr": f"Instance config not found for {router_name}",
-            }
-            fail_count += 1
-            continue
-
-        instance_id = configs[router_name]["instance_id"]
-        region = configs[router_name]["region"]
-
-        # Generate the vbash script for this router
-        vpn_script = build_vpn_bgp_script(router_name, configs)
-
-        # Wrap in SSM command
-        ssm_cmd = build_ssm_command(vpn_script)
-
-        result = send_and_wait(
-            instance_id=instance_id,
-            region=region,
-            commands=ssm_cmd,
-            timeout=SSM_TIMEOUT,
-        )
-
-        results[router_name] = result
-
-        if result["status"] == "Success":
-            success_count += 1
-        else:
-            fail_count += 1
-
-    return {
-        "phase": "phase2",
-        "results": results,
-        "success_count": success_count,
-        "fail_count": fail_count,
-    }
+    seed_agents(event, configs)
+    run_id = get_run_id(event, context)
+
+    names, selection = select_routers(get_routers(configs), configs, event, "phase2")
+
+    phase = run_rollout(
+        configs,
+        names,
+        build_command,
+        "phase2",
+        spec=event.get("rollout"),
+        timeout=SSM_TIMEOUT,
+        fail_fast=event.get("fail_fast"),
+        on_result=lambda name, result: output_store.offload(result, run_id, "phase2", name),
+    )
+
+    if selection:
+        phase["selection"] = selection
+
+    return output_store.bound_results({"phase": "phase2", **phase}, run_id)
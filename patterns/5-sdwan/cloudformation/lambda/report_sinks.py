@@ -0,0 +1,202 @@
+"""
+Report sinks for verification and benchmark results.
+
+Each sink stores a text report and a compact JSON form of the same result so
+dashboards can read results without re-parsing text. The backend is chosen
+with REPORT_SINK:
+
+- ssm (default): /sdwan/<name> (text) and /sdwan/<name>-json. Values over
+  the 4 KB standard tier go to the Advanced tier (8 KB, billed per
+  parameter), zlib-compressed and base64-encoded with a "zlib:" prefix if
+  they are still too large. SSM keeps the last 100 versions of each
+  parameter as history.
+- ssm-sharded: values split into ~4 KB standard-tier shards under
+  /sdwan/reports/<name>/text/<n> and /sdwan/reports/<name>/json/<n>, with a
+  JSON manifest at /sdwan/reports/<name>/manifest. No size limit.
+- s3: s3://REPORT_S3_BUCKET/REPORT_S3_PREFIX/<name>/<run_id>/report.{txt,json}
+  for full history, plus a copy under <name>/latest/.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from ssm_utils import get_client
+
+
+REPORT_SINK = os.environ.get("REPORT_SINK", "ssm")
+REPORT_S3_BUCKET = os.environ.get("REPORT_S3_BUCKET", "")
+REPORT_S3_PREFIX = os.environ.get("REPORT_S3_PREFIX", "sdwan/reports")
+
+STANDARD_TIER_LIMIT = 4096
+ADVANCED_TIER_LIMIT = 8192
+
+# Shard size leaves headroom below the standard tier limit for multi-byte chars
+SHARD_SIZE = 4000
+
+
+class ReportTooLarge(Exception):
+    """Raised when a report does not fit the selected sink."""
+
+
+def get_run_id(event, context=None):
+    """Return the run ID for a pipeline execution.
+
+    Uses the Step Functions execution name set by the state machine in
+    event["run"]["run_id"], then event["run_id"], then the Lambda request ID,
+    and finally a UTC timestamp.
+    """
+    run_id = (event or {}).get("run", {}).get("run_id") or (event or {}).get("run_id")
+    if not run_id and context is not None:
+        run_id = getattr(context, "aws_request_id", None)
+    return run_id or time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+
+
+def encode_value(value):
+    """Fit a value into one SSM parameter, compressing if needed.
+
+    Args:
+        value: Parameter value
+
+    Returns:
+        tuple: (value, tier). Small values use Intelligent-Tiering so a
+        parameter that was once Advanced can be overwritten without a
+        (disallowed) downgrade to Standard.
+
+    Raises:
+        ReportTooLarge: If the value exceeds the Advanced tier even compressed
+    """
+    size = len(value.encode("utf-8"))
+    if size <= STANDARD_TIER_LIMIT:
+        return value, "Intelligent-Tiering"
+    if size <= ADVANCED_TIER_LIMIT:
+        return value, "Advanced"
+    packed = "zlib:" + base64.b64encode(zlib.compress(value.encode("utf-8"), 9)).decode("ascii")
+    if len(packed) <= ADVANCED_TIER_LIMIT:
+        return packed, "Advanced"
+    raise ReportTooLarge(
+        f"Report is {len(value)} bytes ({len(packed)} compressed); "
+        f"use REPORT_SINK=ssm-sharded or s3"
+    )
+
+
+def decode_value(value):
+    """Reverse encode_value() for a value read back from SSM."""
+    if value.startswith("zlib:"):
+        return zlib.decompress(base64.b64decode(value[5:])).decode("utf-8")
+    return value
+
+
+def split_shards(value, size=SHARD_SIZE):
+    """Split a value into chunks of at most size characters."""
+    return [value[i:i + size] for i in range(0, len(value), size)] or [""]
+
+
+class SsmParameterSink:
+    """Write each report to a single SSM parameter (Advanced tier/compressed if needed)."""
+
+    def __init__(self, prefix="/sdwan/"):
+        self.prefix = prefix
+
+    def write(self, name, text, data, run_id):
+        client = get_client("ssm")
+        for param, value in (
+            (f"{self.prefix}{name}", text),
+            (f"{self.prefix}{name}-json", json.dumps(data, separators=(",", ":"))),
+        ):
+            value, tier = encode_value(value)
+            client.put_parameter(
+                Name=param, Value=value, Type="String", Tier=tier, Overwrite=True
+            )
+
+
+class ShardedSsmSink:
+    """Split each report across standard-tier SSM parameters with a manifest."""
+
+    def __init__(self, prefix="/sdwan/reports/"):
+        self.prefix = prefix
+
+    def write(self, name, text, data, run_id):
+        client = get_client("ssm")
+        base = f"{self.prefix}{name}"
+        body = json.dumps(data, separators=(",", ":"))
+        manifest = {"run_id": run_id}
+
+        for kind, value in (("text", text), ("json", body)):
+            shards = split_shards(value)
+            for i, shard in enumerate(shards):
+                client.put_parameter(
+                    Name=f"{base}/{kind}/{i}", Value=shard, Type="String", Overwrite=True
+                )
+            manifest[f"{kind}_shards"] = len(shards)
+            manifest[f"{kind}_sha256"] = hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+        # Written last so readers never see a manifest pointing at missing shards
+        client.put_parameter(
+            Name=f"{base}/manifest",
+            Value=json.dumps(manifest, separators=(",", ":")),
+            Type="String",
+            Overwrite=True,
+        )
+
+
+class S3Sink:
+    """Write each report to S3 keyed by run ID, plus a latest copy."""
+
+    def __init__(self, bucket, prefix="sdwan/reports"):
+        if not bucket:
+            raise ValueError("REPORT_S3_BUCKET must be set for REPORT_SINK=s3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def write(self, name, text, data, run_id):
+        client = get_client("s3")
+        body = json.dumps(data, separators=(",", ":"))
+        for folder in (run_id, "latest"):
+            key = f"{self.prefix}/{name}/{folder}/report"
+            client.put_object(
+                Bucket=self.bucket, Key=f"{key}.txt", Body=text.encode("utf-8"),
+                ContentType="text/plain",
+            )
+            client.put_object(
+                Bucket=self.bucket, Key=f"{key}.json", Body=body.encode("utf-8"),
+                ContentType="application/json",
+            )
+
+
+def get_sink(kind=None):
+    """Return the report sink selected by REPORT_SINK (or kind)."""
+    kind = kind or REPORT_SINK
+    if kind == "ssm":
+        return SsmParameterSink()
+    if kind == "ssm-sharded":
+        return ShardedSsmSink()
+    if kind == "s3":
+        return S3Sink(REPORT_S3_BUCKET, REPORT_S3_PREFIX)
+    raise ValueError(f"Unknown REPORT_SINK: {kind}. Expected one of: ssm, ssm-sharded, s3")
+
+
+def write_report(name, text, data, run_id):
+    """Write a report through the configured sink.
+
+    On failure, logs the error and returns False without raising — a phase
+    should not fail due to a persistence issue.
+
+    Args:
+        name: Report name (e.g. verification-results)
+        text: Human-readable report
+        data: JSON-serializable compact form of the result
+        run_id: Pipeline run ID from get_run_id()
+
+    Returns:
+        bool: True if the report was written
+    """
+    try:
+        get_sink().write(name, text, data, run_id)
+        return True
+    except Exception as e:
+        print(f"Failed to persist {name} via {REPORT_SINK} sink: {e}")
+        return False
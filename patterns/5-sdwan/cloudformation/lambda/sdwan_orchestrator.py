@@ -0,0 +1,447 @@
+"""
+DAG orchestrator for the SD-WAN phase pipeline.
+
+Runs Phase 1 → 4 per router instead of per phase: every (phase, router) step
+starts as soon as the steps it depends on have finished, so a router does
+not wait for unrelated routers at a global phase barrier. For example,
+nv-branch1 starts Phase 2 once it and its tunnel peer nv-sdwan have finished
+Phase 1 (and converged), whatever the state of the Frankfurt routers.
+
+Dependencies per router r (peers are the routers r has a tunnel to):
+- phase1:r
+- converge-phase1:r   <- phase1:r
+- phase2:r            <- converge-phase1 of r and its peers
+- converge-phase2:r   <- phase2 of r and its peers
+- phase3:r (SDWAN)    <- converge-phase2:r
+- converge-phase3:r   <- phase3:r
+- phase4:r            <- converge-phase2:r, converge-phase3:r (SDWAN)
+
+The run reports per-step timings and the critical path (the chain of steps
+that determined the total wall-clock). Usable locally:
+
+    python -m sdwan_orchestrator run [--phases phase2,phase3,phase4] [--routers ...]
+    python -m sdwan_orchestrator plan
+
+or as a single Lambda (handler), bounded by the 15 minute Lambda timeout.
+"""
+
+import argparse
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import convergence_handler
+import metrics
+import output_store
+import phase1_handler
+import phase2_handler
+import phase3_handler
+import phase4_handler
+import tracing
+from instrumentation import instrumented
+from profiling import profiled
+from report_sinks import get_run_id
+from ssm_utils import (
+    FAIL_FAST,
+    cancelled_result,
+    check_agents,
+    fail_fast_reason,
+    get_instance_configs,
+    iter_reachable,
+    parse_fail_fast,
+    send_and_wait,
+    unreachable_result,
+)
+
+
+SSM_PARAM_PREFIX = os.environ.get("SSM_PARAM_PREFIX", "/sdwan/")
+
+# Max steps running at the same time
+MAX_WORKERS = int(os.environ.get("ORCHESTRATOR_MAX_WORKERS", "16"))
+
+# Phase modules and their SSM timeout; each module's get_routers() returns
+# the discovered routers the phase applies to
+PHASES = {
+    "phase1": {"module": phase1_handler, "timeout": phase1_handler.SSM_TIMEOUT},
+    "phase2": {"module": phase2_handler, "timeout": phase2_handler.SSM_TIMEOUT},
+    "phase3": {"module": phase3_handler, "timeout": phase3_handler.SSM_TIMEOUT},
+    "phase4": {"module": phase4_handler, "timeout": phase4_handler.SSM_TIMEOUT},
+}
+
+# Phases followed by a convergence check
+CONVERGED_PHASES = ("phase1", "phase2", "phase3")
+
+
+def get_peers(router_name):
+    """Return the routers that router_name has an IPsec tunnel to."""
+    return [t["peer_name"] for t in phase2_handler.get_tunnel_info(router_name)]
+
+
+def build_dag(configs, phases=None, routers=None, converge=True):
+    """Build the step graph for the selected phases and routers.
+
+    Steps of phases that are not selected are treated as already done, so
+    e.g. phases=["phase4"] re-runs only the verification.
+
+    Args:
+        configs: Dict from get_instance_configs(); each phase applies to the
+                 discovered routers its get_routers() returns
+        phases: Phase names to run (default: all)
+        routers: Router names to run (default: all discovered routers)
+        converge: Insert convergence checks after phase1-3
+
+    Returns:
+        dict: Step name -> {"kind": "phase"|"converge", "phase", "router",
+              "deps": [step names]}
+
+    Raises:
+        ValueError: If a discovered router has no topology entry for a
+                    selected phase
+    """
+    phases = [p for p in PHASES if p in (phases or PHASES)]
+    phase_routers = {p: PHASES[p]["module"].get_routers(configs) for p in phases}
+    routers = set(routers or configs)
+    dag = {}
+
+    def add(name, kind, phase, router, deps):
+        dag[name] = {
+            "kind": kind,
+            "phase": phase,
+            "router": router,
+            "deps": [d for d in deps if d in dag],
+        }
+
+    def last_step(phase, router):
+        # The step that marks `phase` as finished on `router`
+        if converge and phase in CONVERGED_PHASES:
+            return f"converge-{phase}:{router}"
+        return f"{phase}:{router}"
+
+    # Phases are added in order so dependencies always exist before dependents
+    for phase in phases:
+        for router in phase_routers[phase]:
+            if router not in routers:
+                continue
+            if phase == "phase1":
+                deps = []
+            elif phase == "phase2":
+                deps = [last_step("phase1", r) for r in [router] + get_peers(router)]
+            elif phase == "phase3":
+                deps = [last_step("phase2", router)]
+            else:
+                deps = [last_step("phase2", router), last_step("phase3", router)]
+            add(f"{phase}:{router}", "phase", phase, router, deps)
+
+        if converge and phase in CONVERGED_PHASES:
+            for router in phase_routers[phase]:
+                if router not in routers:
+                    continue
+                # IPsec/BGP state depends on both ends of each tunnel
+                ends = [router] + (get_peers(router) if phase == "phase2" else [])
+                add(f"converge-{phase}:{router}", "converge", phase, router,
+                    [f"{phase}:{r}" for r in ends])
+    return dag
+
+
+def run_step(step, configs, cancel=None):
+    """Run one step and return its result dict (status plus step details).
+
+    A set cancel event (see run_pipeline's fail-fast) cancels the step's
+    SSM command at its next poll.
+    """
+    router = step["router"]
+    if router not in configs:
+        return {"status": "Failed", "stderr": f"Instance config not found for {router}"}
+
+    if step["kind"] == "converge":
+        try:
+            result = convergence_handler.wait_for_convergence(
+                step["phase"], configs, routers=[router]
+            )
+        except convergence_handler.ConvergenceError as e:
+            return {"status": "Failed", "stderr": str(e)}
+        return {"status": "Success", **result}
+
+    # Wait (with backoff) for an offline SSM agent instead of sending into it
+    agent_status = dict(iter_reachable(configs, [router]))[router]
+    if agent_status:
+        return unreachable_result(configs[router]["instance_id"], agent_status)
+
+    phase = PHASES[step["phase"]]
+    result = send_and_wait(
+        instance_id=configs[router]["instance_id"],
+        region=configs[router]["region"],
+        commands=phase["module"].build_command(router, configs),
+        timeout=phase["timeout"],
+        cancel=cancel,
+    )
+    if step["phase"] == "phase4":
+        result["details"] = phase4_handler.parse_verify_output(
+            result.get("stdout", ""), router, configs=configs
+        )
+        phase4_handler.record_ping_metrics(result["details"])
+    return result
+
+
+def run_dag(dag, run, max_workers=MAX_WORKERS):
+    """Run the steps of a DAG as soon as their dependencies succeed.
+
+    Steps whose dependencies failed or were skipped are marked Skipped.
+
+    Args:
+        dag: Dict from build_dag()
+        run: Callable(step_name, step) returning a result dict with status
+        max_workers: Max steps running at the same time
+
+    Returns:
+        dict: Step name -> result dict with status, start and end (seconds
+              since the run started; absent for skipped steps)
+    """
+    results = {}
+    running = {}
+    origin = time.time()
+
+    dependents = {name: [] for name in dag}
+    remaining = {}
+    for name, step in dag.items():
+        remaining[name] = len(step["deps"])
+        for dep in step["deps"]:
+            dependents[dep].append(name)
+    ready = [name for name, count in remaining.items() if count == 0]
+
+    def complete(name, result):
+        results[name] = result
+        for dependent in dependents[name]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+
+    def timed(name):
+        start = time.time() - origin
+        with tracing.span(name.split(":")[0], step=name, router=dag[name]["router"]) as step_span:
+            try:
+                result = run(name, dag[name])
+            except Exception as e:
+                result = {"status": "Failed", "stderr": f"{type(e).__name__}: {e}"}
+            tracing.set_attributes(step_span, step_status=result["status"])
+        result["start"] = round(start, 2)
+        result["end"] = round(time.time() - origin, 2)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while ready or running:
+            while ready:
+                name = ready.pop(0)
+                if any(results[d]["status"] != "Success" for d in dag[name]["deps"]):
+                    complete(name, {"status": "Skipped"})
+                    continue
+                print(f"Starting {name}")
+                # Copy the context so the step's spans nest under the current span
+                running[pool.submit(contextvars.copy_context().run, timed, name)] = name
+
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                result = future.result()
+                print(f"Finished {name}: {result['status']} "
+                      f"after {result['end'] - result['start']:.1f}s")
+                complete(name, result)
+    return results
+
+
+def critical_path(dag, results):
+    """Return the chain of steps that determined the run's wall-clock.
+
+    Starts from the step that finished last and repeatedly follows the
+    dependency that finished last.
+
+    Returns:
+        list of dicts: step, seconds (duration) and wait (seconds between
+        the dependency finishing and the step starting, e.g. worker limits)
+    """
+    timed = {n: r for n, r in results.items() if "end" in r}
+    if not timed:
+        return []
+    name = max(timed, key=lambda n: timed[n]["end"])
+    path = []
+    while name:
+        deps = [d for d in dag[name]["deps"] if d in timed]
+        prev = max(deps, key=lambda d: timed[d]["end"]) if deps else None
+        prev_end = timed[prev]["end"] if prev else 0.0
+        path.append({
+            "step": name,
+            "seconds": round(timed[name]["end"] - timed[name]["start"], 2),
+            "wait": round(timed[name]["start"] - prev_end, 2),
+        })
+        name = prev
+    return path[::-1]
+
+
+def run_pipeline(phases=None, routers=None, converge=True, max_workers=MAX_WORKERS,
+                 run_id=None, fail_fast=None):
+    """Run the selected phases through the DAG scheduler.
+
+    Phase 4 results are persisted through the report sink, as the Phase 4
+    handler does. Step output is capped with output_store.offload().
+
+    With a fail-fast policy (see ssm_utils.parse_fail_fast(); default
+    FAIL_FAST), failed steps are counted against the number of steps; once
+    the limit is reached, running SSM commands are cancelled and steps not
+    started yet are Cancelled (their dependents Skipped).
+
+    Returns:
+        dict: Structured result:
+            - phase: "orchestrator"
+            - results: dict keyed by step name with status and timings
+            - success_count, fail_count, skipped_count
+            - wall_seconds: total wall-clock
+            - step_seconds: sum of all step durations (serial time)
+            - critical_path: list from critical_path()
+            - aborted: fail-fast reason, if the run stopped early
+    """
+    configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
+    dag = build_dag(configs, phases, routers, converge)
+    run_id = run_id or get_run_id({})
+    # One batched agent check up front; steps then read the cache
+    check_agents(configs)
+
+    policy = parse_fail_fast(FAIL_FAST if fail_fast is None else fail_fast)
+    cancel = threading.Event()
+    failures = {"count": 0, "reason": None}
+    lock = threading.Lock()
+
+    def run(name, step):
+        if cancel.is_set():
+            return cancelled_result(configs.get(step["router"], {}).get("instance_id", ""),
+                                    failures["reason"])
+        result = output_store.offload(run_step(step, configs, cancel), run_id,
+                                      step["phase"], step["router"])
+        if result["status"] == "Failed":
+            with lock:
+                failures["count"] += 1
+                reason = fail_fast_reason(policy, failures["count"], len(dag))
+                if reason and not cancel.is_set():
+                    print(f"Stopping run after {name}: {reason}")
+                    failures["reason"] = reason
+                    cancel.set()
+        return result
+
+    start = time.time()
+    results = run_dag(dag, run, max_workers)
+    wall = time.time() - start
+
+    statuses = [r["status"] for r in results.values()]
+    final_result = {
+        "phase": "orchestrator",
+        "results": results,
+        "success_count": statuses.count("Success"),
+        "fail_count": len(statuses) - statuses.count("Success") - statuses.count("Skipped"),
+        "skipped_count": statuses.count("Skipped"),
+        "wall_seconds": round(wall, 1),
+        "step_seconds": round(sum(r["end"] - r["start"] for r in results.values()
+                                  if "end" in r), 1),
+        "critical_path": critical_path(dag, results),
+    }
+    if failures["reason"]:
+        final_result["aborted"] = failures["reason"]
+
+    verify = {n.split(":", 1)[1]: r for n, r in results.items() if n.startswith("phase4:")}
+    if verify:
+        ok = sum(1 for r in verify.values() if r["status"] == "Success")
+        phase4_handler.persist_results({
+            "phase": "phase4",
+            "results": verify,
+            "success_count": ok,
+            "fail_count": len(verify) - ok,
+        }, run_id)
+
+    return final_result
+
+
+def format_summary(result):
+    """Format an orchestrator result as a short text report."""
+    lines = [
+        f"Steps: {result['success_count']} succeeded, {result['fail_count']} failed, "
+        f"{result['skipped_count']} skipped",
+        f"Wall-clock: {result['wall_seconds']}s (serial step time {result['step_seconds']}s)",
+        "Critical path:",
+    ]
+    for entry in result["critical_path"]:
+        wait_note = f" (+{entry['wait']:.1f}s queued)" if entry["wait"] > 0.5 else ""
+        lines.append(f"  {entry['step']:<28} {entry['seconds']:>8.1f}s{wait_note}")
+    failed = [n for n, r in result["results"].items() if r["status"] == "Failed"]
+    for name in failed:
+        lines.append(f"FAILED {name}: {result['results'][name].get('stderr', '')[:200]}")
+    if result.get("aborted"):
+        lines.append(f"ABORTED: {result['aborted']}")
+    return "\n".join(lines)
+
+
+@instrumented
+@tracing.traced("orchestrator")
+@metrics.emits_metrics("orchestrator")
+@profiled
+def handler(event, context):
+    """Lambda handler running the pipeline (or part of it) as one invocation.
+
+    Args:
+        event: Optional phases (list), routers (list), converge (bool),
+               max_workers (int) and fail_fast (policy)
+        context: Lambda context object
+
+    Returns:
+        dict: Result of run_pipeline() without raw stdout, bounded for the state
+    """
+    run_id = get_run_id(event, context)
+    result = run_pipeline(
+        phases=event.get("phases"),
+        routers=event.get("routers"),
+        converge=event.get("converge", True),
+        max_workers=int(event.get("max_workers", MAX_WORKERS)),
+        run_id=run_id,
+        fail_fast=event.get("fail_fast"),
+    )
+    for step in result["results"].values():
+        step.pop("stdout", None)
+    return output_store.bound_results(result, run_id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sdwan_orchestrator", description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("run", "plan"):
+        cmd = sub.add_parser(name)
+        cmd.add_argument("--phases", help="Comma-separated phases (default: all)")
+        cmd.add_argument("--routers", help="Comma-separated routers (default: all)")
+        cmd.add_argument("--no-converge", action="store_true",
+                         help="Skip the convergence checks between phases")
+    run_cmd = sub.choices["run"]
+    run_cmd.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    run_cmd.add_argument("--fail-fast", default=None,
+                         help="Stop after failures: first, a count or a percentage of steps "
+                              "(default: FAIL_FAST or off)")
+    run_cmd.add_argument("--json", action="store_true", help="Print the full JSON result")
+    args = parser.parse_args(argv)
+
+    phases = args.phases.split(",") if args.phases else None
+    routers = args.routers.split(",") if args.routers else None
+    if args.command == "plan":
+        configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
+        for name, step in build_dag(configs, phases, routers, not args.no_converge).items():
+            print(f"{name:<28} <- {', '.join(step['deps']) or '-'}")
+        return 0
+
+    result = run_pipeline(phases, routers, not args.no_converge, args.max_workers,
+                          fail_fast=args.fail_fast)
+    print(json.dumps(result, indent=2, default=str) if args.json else format_summary(result))
+    return 0 if result["fail_count"] == 0 and result["skipped_count"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,14 +2,20 @@
 Shared SSM utility module for Lambda functions.
 
 Provides common functions for SSM parameter retrieval and command execution
-used by all 3 phase Lambda handlers (phase1, phase2, phase3).
+used by the phase Lambda handlers (phase1 - phase4) and the convergence checker.
 """
 
+import os
+import threading
 import time
-import boto3
 
+import metrics
+import tracing
+from instrumentation import instrument
 
-# Instance-to-region mapping for the 4 SD-WAN instances
+
+# Instance-to-region mapping for the 4 SD-WAN instances of the workshop,
+# used by get_region_for_instance() for routers not discovered yet
 INSTANCE_REGIONS = {
     "nv-sdwan": "us-east-1",
     "nv-branch1": "us-east-1",
@@ -17,12 +23,123 @@ INSTANCE_REGIONS = {
     "fra-branch1": "eu-central-1",
 }
 
-# Default regions to scan for SSM parameters
-DEFAULT_REGIONS = ["us-east-1", "eu-central-1"]
+# Regions scanned for routers (comma-separated), all in parallel
+DISCOVERY_REGIONS = os.environ.get("DISCOVERY_REGIONS", "us-east-1,eu-central-1")
+DEFAULT_REGIONS = [r.strip() for r in DISCOVERY_REGIONS.split(",") if r.strip()]
+
+# Where routers are discovered: parameters (/sdwan/<router>/...) or tags
+# (EC2 instances tagged ROUTER_TAG)
+DISCOVERY_SOURCE = os.environ.get("DISCOVERY_SOURCE", "parameters")
+
+# Seconds a discovered router registry is reused by warm invocations
+DISCOVERY_TTL = int(os.environ.get("DISCOVERY_TTL", "300"))
+
+# EC2 tags naming a router and its role (sdwan or branch)
+ROUTER_TAG = "sdwan:router"
+ROLE_TAG = "sdwan:role"
+
+# Device index of a router's outside ENI (eth1)
+OUTSIDE_DEVICE_INDEX = 1
 
 # Polling interval for SSM command completion (seconds)
 POLL_INTERVAL = 15
 
+# SSM command statuses that will not change any more
+TERMINAL_STATUSES = ("Success", "Failed", "Cancelled", "TimedOut")
+
+# Seconds an SSM agent check stays valid; the phases of one run share it
+AGENT_CHECK_TTL = int(os.environ.get("AGENT_CHECK_TTL", "120"))
+
+# Seconds between re-checks of routers whose SSM agent is not online
+AGENT_RETRY_DELAYS = (15, 30, 60)
+
+# Instance IDs per DescribeInstanceInformation call (its max page size)
+AGENT_CHECK_BATCH = 50
+
+# Offline agents listed by instance ID in a phase result (see agent_snapshot)
+AGENT_SNAPSHOT_LIMIT = 20
+
+# Default fail-fast policy of run_phase() (see parse_fail_fast())
+FAIL_FAST = os.environ.get("FAIL_FAST", "off")
+
+# instance_id -> (PingStatus, checked_at) from DescribeInstanceInformation
+_AGENTS = {}
+_AGENTS_LOCK = threading.Lock()
+
+# (source, param_prefix, regions) -> (registry, discovered_at) from get_instance_configs()
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+# botocore clients keyed by (service, region), reused across warm invocations
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+# botocore session shared by all clients of the container, created on first use
+_SESSION = None
+
+
+def _create_client(service, region_name=None):
+    """Create a client from the container's shared botocore session.
+
+    botocore is imported here rather than at module load: handler modules
+    then import in a few milliseconds, and code paths that never call AWS
+    (script generation, the orchestrator's plan command, offline runs with
+    fake clients) never load the SDK. botocore is used directly because
+    boto3 also imports s3transfer, which nothing here needs.
+    """
+    global _SESSION
+    if _SESSION is None:
+        import botocore.session
+
+        _SESSION = botocore.session.get_session()
+    return _SESSION.create_client(service, region_name=region_name)
+
+
+# Callable(service, region_name=...) used to create clients; see set_client_factory()
+_CLIENT_FACTORY = _create_client
+
+
+def get_client(service, region=None):
+    """Return a cached client for a service and region.
+
+    New clients are instrumented (see instrumentation.py) so every API call
+    is counted. Creation is serialized because botocore sessions are not
+    thread-safe and the orchestrator asks for clients from worker threads.
+
+    Args:
+        service: AWS service name (e.g. ssm)
+        region: AWS region, or None for the Lambda's own region
+
+    Returns:
+        botocore client
+    """
+    key = (service, region)
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _CLIENTS[key] = instrument(_CLIENT_FACTORY(service, region_name=region))
+    return client
+
+
+def set_client_factory(factory=None):
+    """Replace the function used to create clients and clear the client, agent and router caches.
+
+    Lets offline runs inject fake clients (see tests/fake_aws.py).
+
+    Args:
+        factory: Callable(service, region_name=...) returning a client, or
+                 None to restore the default botocore factory
+    """
+    global _CLIENT_FACTORY
+    _CLIENT_FACTORY = factory or _create_client
+    _CLIENTS.clear()
+    with _AGENTS_LOCK:
+        _AGENTS.clear()
+    with _REGISTRY_LOCK:
+        _REGISTRY.clear()
+
 
 def get_ssm_parameter_path(instance_name, param_type):
     """Return the SSM parameter path for a given instance and parameter type.
@@ -40,15 +157,22 @@ def get_ssm_parameter_path(instance_name, param_type):
 def get_region_for_instance(instance_name):
     """Return the AWS region for a given instance name.
 
+    Routers discovered by get_instance_configs() are looked up in its
+    cache, the workshop routers in INSTANCE_REGIONS.
+
     Args:
-        instance_name: One of nv-sdwan, nv-branch1, fra-sdwan, fra-branch1
+        instance_name: Router name, e.g. nv-sdwan
 
     Returns:
-        str: AWS region (us-east-1 or eu-central-1)
+        str: AWS region
 
     Raises:
         ValueError: If instance_name is not recognized
     """
+    with _REGISTRY_LOCK:
+        for registry, _ in _REGISTRY.values():
+            if instance_name in registry:
+                return registry[instance_name]["region"]
     if instance_name not in INSTANCE_REGIONS:
         raise ValueError(
             f"Unknown instance name: {instance_name}. "
@@ -58,15 +182,23 @@ def get_region_for_instance(instance_name):
 
 
 
-def get_instance_configs(param_prefix="/sdwan/", regions=None):
-    """Read SSM parameters by path prefix and return instance configurations.
+def get_instance_configs(param_prefix="/sdwan/", regions=None, source=None, refresh=False):
+    """Discover the routers and return their configurations (the router registry).
 
-    Creates regional boto3 SSM clients, calls GetParametersByPath in each
-    region, and assembles a dict keyed by instance name.
+    Every region is scanned in parallel, either from the SSM parameters
+    under param_prefix (/sdwan/<router>/<param-type>) or, with source
+    "tags", from the running EC2 instances tagged ROUTER_TAG=<router>. For
+    tagged routers, the outside addresses come from the ENI at
+    OUTSIDE_DEVICE_INDEX, and their parameters add what EC2 does not know
+    (Cloud WAN peers and ASN). The registry is cached for DISCOVERY_TTL
+    seconds, so the phases and convergence checks of a run that land on a
+    warm container do not scan again.
 
     Args:
         param_prefix: SSM parameter path prefix (default: /sdwan/)
-        regions: List of AWS regions to scan (default: us-east-1, eu-central-1)
+        regions: List of AWS regions to scan (default: DISCOVERY_REGIONS)
+        source: "parameters" or "tags" (default: DISCOVERY_SOURCE)
+        refresh: Ignore the cached registry
 
     Returns:
         dict: Keyed by instance name, each value contains:
@@ -74,54 +206,608 @@ def get_instance_configs(param_prefix="/sdwan/", regions=None):
             - outside_eip (str)
             - outside_private_ip (str)
             - region (str)
+            - role (str): sdwan or branch (see router_role())
+            - cloudwan_peer_ip1, cloudwan_peer_ip2, cloudwan_asn (if set)
+
+    Raises:
+        ValueError: If source is not parameters or tags
     """
     if regions is None:
         regions = DEFAULT_REGIONS
+    source = source or DISCOVERY_SOURCE
+    if source not in ("parameters", "tags"):
+        raise ValueError(f"Unknown DISCOVERY_SOURCE: {source}. Expected one of: parameters, tags")
 
+    key = (source, param_prefix, tuple(regions))
+    with _REGISTRY_LOCK:
+        cached = _REGISTRY.get(key)
+    if cached and not refresh and time.time() - cached[1] < DISCOVERY_TTL:
+        return {name: dict(config) for name, config in cached[0].items()}
+
+    def scan(region):
+        found = _discover_parameters(region, param_prefix)
+        if source == "tags":
+            found = _discover_tagged(region, found)
+        return found
+
+    with tracing.span("discovery", source=source, regions=len(regions)) as span:
+        if len(regions) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=len(regions)) as pool:
+                found = list(pool.map(scan, regions))
+        else:
+            found = [scan(region) for region in regions]
+
+        configs = {}
+        for routers in found:
+            configs.update(routers)
+        for name, config in configs.items():
+            config["role"] = router_role(name, configs)
+        tracing.set_attributes(span, routers=len(configs))
+
+    with _REGISTRY_LOCK:
+        _REGISTRY[key] = (configs, time.time())
+    return {name: dict(config) for name, config in configs.items()}
+
+
+def _discover_parameters(region, param_prefix):
+    # Routers of one region from GetParametersByPath under param_prefix
+    client = get_client("ssm", region)
+
+    key_map = {
+        "instance-id": "instance_id",
+        "outside-eip": "outside_eip",
+        "outside-private-ip": "outside_private_ip",
+        "cloudwan-peer-ip1": "cloudwan_peer_ip1",
+        "cloudwan-peer-ip2": "cloudwan_peer_ip2",
+        "cloudwan-asn": "cloudwan_asn",
+        "role": "role",
+    }
     configs = {}
 
-    for region in regions:
-        client = boto3.client("ssm", region_name=region)
+    # Paginate through all parameters under the prefix
+    paginator = client.get_paginator("get_parameters_by_path")
+    pages = paginator.paginate(
+        Path=param_prefix,
+        Recursive=True,
+        WithDecryption=False,
+    )
+
+    for page in pages:
+        for param in page.get("Parameters", []):
+            # Parse path: /sdwan/{instance-name}/{param-type}
+            parts = param["Name"].strip("/").split("/")
+            if len(parts) != 3:
+                continue
+
+            _, instance_name, param_type = parts
+            if instance_name not in configs:
+                configs[instance_name] = {"region": region}
+            if param_type in key_map:
+                configs[instance_name][key_map[param_type]] = param["Value"]
 
-        # Paginate through all parameters under the prefix
-        paginator = client.get_paginator("get_parameters_by_path")
-        pages = paginator.paginate(
-            Path=param_prefix,
-            Recursive=True,
-            WithDecryption=False,
+    return configs
+
+
+def _discover_tagged(region, parameters):
+    # Routers of one region from the EC2 instances tagged ROUTER_TAG
+    client = get_client("ec2", region)
+    configs = {}
+    pages = client.get_paginator("describe_instances").paginate(Filters=[
+        {"Name": "tag-key", "Values": [ROUTER_TAG]},
+        {"Name": "instance-state-name", "Values": ["running"]},
+    ])
+    for page in pages:
+        for reservation in page.get("Reservations", []):
+            for instance in reservation.get("Instances", []):
+                tags = {t["Key"]: t["Value"] for t in instance.get("Tags", [])}
+                name = tags[ROUTER_TAG]
+                config = dict(parameters.get(name, {}), region=region,
+                              instance_id=instance["InstanceId"])
+                if tags.get(ROLE_TAG):
+                    config["role"] = tags[ROLE_TAG]
+                for eni in instance.get("NetworkInterfaces", []):
+                    if eni.get("Attachment", {}).get("DeviceIndex") == OUTSIDE_DEVICE_INDEX:
+                        config["outside_private_ip"] = eni.get("PrivateIpAddress", "")
+                        config["outside_eip"] = eni.get("Association", {}).get("PublicIp", "")
+                configs[name] = config
+    return configs
+
+
+def router_role(router_name, configs=None):
+    """Return the role of a router: "sdwan" or "branch".
+
+    Taken from the router's config when it has a role, else from the name
+    (SDWAN routers are named <site>-sdwan, branch routers <site>-branch<N>).
+    """
+    role = ((configs or {}).get(router_name) or {}).get("role")
+    if role:
+        return role
+    return "sdwan" if router_name.endswith("-sdwan") else "branch"
+
+
+def discovered_routers(configs, phase, role=None, topology=None):
+    """Return the discovered routers a phase applies to, in discovery order.
+
+    Args:
+        configs: Instance configs from get_instance_configs()
+        phase: Phase name, for the error message
+        role: Keep only routers with this role (see router_role())
+        topology: Router names the phase has topology for (tunnels, ASNs);
+                  every selected router must be one of them
+
+    Returns:
+        list[str]: Router names
+
+    Raises:
+        ValueError: If a discovered router has no entry in topology
+    """
+    names = [n for n in configs if role is None or router_role(n, configs) == role]
+    if topology is not None:
+        missing = [n for n in names if n not in topology]
+        if missing:
+            raise ValueError(
+                f"{phase}: no topology for discovered router(s): {', '.join(sorted(missing))}"
+            )
+    return names
+
+
+def failed_routers(phase_result):
+    """Return the names of the routers that did not succeed in a phase result.
+
+    Follows results_ref when the results were moved out of the state (see
+    output_store.bound_results()).
+
+    Raises:
+        ValueError: If the results were truncated without being stored and
+                    not every failed router was kept in the state
+    """
+    import output_store
+
+    results = output_store.load_results(phase_result)
+    failed = [n for n, r in results.items() if r.get("status") != "Success"]
+    if (phase_result.get("results_truncated") and "results_ref" not in phase_result
+            and len(failed) < phase_result.get("fail_count", 0)):
+        raise ValueError(
+            f"Only {len(failed)} of {phase_result['fail_count']} failed routers are in the "
+            f"previous {phase_result.get('phase', 'phase')} result; set OUTPUT_STORE to keep them all"
         )
+    return failed
 
-        for page in pages:
-            for param in page.get("Parameters", []):
-                name = param["Name"]
-                value = param["Value"]
 
-                # Parse path: /sdwan/{instance-name}/{param-type}
-                parts = name.strip("/").split("/")
-                if len(parts) != 3:
-                    continue
+def select_routers(names, configs, event, phase):
+    """Narrow a phase's routers to the subset requested in the event.
+
+    The selectors are optional top-level event keys; routers must match all
+    of them given:
+
+    - routers: router names (list or comma-separated string)
+    - role: "sdwan" or "branch" (see router_role())
+    - region: AWS region (or list of regions)
+    - only_failed: true to keep the routers that failed in the previous
+      result of this phase (event["<phase>_result"], as the state machine
+      passes it), or that phase result itself. If the event holds results
+      of other phases but not this one, the phase never ran, and all
+      routers are kept with a warning. An event without any phase result
+      (a new execution) is rejected.
+
+    Routers the phase does not apply to are ignored, so one event can scope
+    every phase of a run.
+
+    Args:
+        names: The phase's router names in dispatch order
+        configs: Instance configs from get_instance_configs()
+        event: Lambda event
+        phase: Phase name (phase1 - phase4)
+
+    Returns:
+        tuple: (selected names in dispatch order, selection dict for the
+        phase result or None if the event has no selectors)
+
+    Raises:
+        ValueError: If role is not sdwan/branch, only_failed is set without
+                    any previous result, or the failed routers of the
+                    previous result cannot be determined
+    """
+    names = list(names)
+    event = event or {}
+    selection = {}
+
+    if event.get("routers"):
+        wanted = event["routers"]
+        if isinstance(wanted, str):
+            wanted = wanted.split(",")
+        wanted = {n.strip() for n in wanted}
+        names = [n for n in names if n in wanted]
+        selection["routers"] = sorted(wanted)
+
+    if event.get("role"):
+        if event["role"] not in ("sdwan", "branch"):
+            raise ValueError(f"Unknown role: {event['role']}. Expected one of: sdwan, branch")
+        names = [n for n in names if router_role(n, configs) == event["role"]]
+        selection["role"] = event["role"]
+
+    if event.get("region"):
+        regions = event["region"]
+        regions = [regions] if isinstance(regions, str) else list(regions)
+        names = [n for n in names if n in configs and configs[n]["region"] in regions]
+        selection["region"] = regions
+
+    if event.get("only_failed"):
+        previous = event["only_failed"]
+        if not isinstance(previous, dict):
+            previous = event.get(f"{phase}_result")
+        if previous:
+            failed = set(failed_routers(previous))
+            names = [n for n in names if n in failed]
+        elif not any(f"phase{n}_result" in event for n in range(1, 5)):
+            raise ValueError(
+                "only_failed needs the output of a previous execution as input "
+                f"(no {phase}_result in the event); start without only_failed to run all routers"
+            )
+        else:
+            print(f"WARNING: no previous {phase} result in the event; "
+                  "only_failed keeps all routers")
+        selection["only_failed"] = True
+
+    if not selection:
+        return names, None
+    selection["count"] = len(names)
+    print(f"Selected {len(names)} routers for {phase}: "
+          + ", ".join(f"{k}={v}" for k, v in selection.items() if k != "count"))
+    return names, selection
+
+
+def describe_agents(instances, refresh=False):
+    """Return the SSM agent PingStatus of instances, batched per region.
+
+    Results are cached for AGENT_CHECK_TTL seconds. Instances SSM does not
+    know are reported as NotRegistered. If the check itself fails (e.g. the
+    role lacks ssm:DescribeInstanceInformation), the instances are assumed
+    online so dispatch goes ahead as before.
+
+    Args:
+        instances: Dict of instance_id -> region
+        refresh: Ignore cached results
+
+    Returns:
+        dict: instance_id -> "Online", "ConnectionLost", "Inactive" or "NotRegistered"
+    """
+    now = time.time()
+    statuses = {}
+    stale = {}
+    with _AGENTS_LOCK:
+        for instance_id, region in instances.items():
+            cached = _AGENTS.get(instance_id)
+            if cached and not refresh and now - cached[1] < AGENT_CHECK_TTL:
+                statuses[instance_id] = cached[0]
+            else:
+                stale.setdefault(region, []).append(instance_id)
+
+    for region, instance_ids in stale.items():
+        client = get_client("ssm", region)
+        for i in range(0, len(instance_ids), AGENT_CHECK_BATCH):
+            batch = instance_ids[i:i + AGENT_CHECK_BATCH]
+            found = {}
+            try:
+                pages = client.get_paginator("describe_instance_information").paginate(
+                    Filters=[{"Key": "InstanceIds", "Values": batch}],
+                    MaxResults=AGENT_CHECK_BATCH,
+                )
+                for page in pages:
+                    for info in page.get("InstanceInformationList", []):
+                        found[info["InstanceId"]] = info.get("PingStatus", "Online")
+            except Exception as e:
+                print(f"SSM agent check failed in {region}, assuming agents online: {e}")
+                statuses.update((instance_id, "Online") for instance_id in batch)
+                continue
+            with _AGENTS_LOCK:
+                for instance_id in batch:
+                    statuses[instance_id] = found.get(instance_id, "NotRegistered")
+                    _AGENTS[instance_id] = (statuses[instance_id], now)
+    return statuses
 
-                _, instance_name, param_type = parts
 
-                if instance_name not in configs:
-                    configs[instance_name] = {"region": region}
+def _agent_seen(instance_id):
+    """Record that an agent just ran a command, which proves it is online."""
+    with _AGENTS_LOCK:
+        _AGENTS[instance_id] = ("Online", time.time())
 
-                # Map param-type to dict key
-                key_map = {
-                    "instance-id": "instance_id",
-                    "outside-eip": "outside_eip",
-                    "outside-private-ip": "outside_private_ip",
-                    "cloudwan-peer-ip1": "cloudwan_peer_ip1",
-                    "cloudwan-peer-ip2": "cloudwan_peer_ip2",
-                    "cloudwan-asn": "cloudwan_asn",
+
+def check_agents(configs, names=None, refresh=False):
+    """Return the SSM agent PingStatus of routers (see describe_agents()).
+
+    Args:
+        configs: Instance configs from get_instance_configs()
+        names: Router names (default: all in configs); unknown names are skipped
+        refresh: Ignore cached results
+
+    Returns:
+        dict: Router name -> PingStatus
+    """
+    names = [n for n in (configs if names is None else names) if n in configs]
+    statuses = describe_agents(
+        {configs[n]["instance_id"]: configs[n]["region"] for n in names}, refresh=refresh
+    )
+    return {n: statuses[configs[n]["instance_id"]] for n in names}
+
+
+def reachable_waves(configs, names):
+    """Yield routers in dispatch waves, those with an online SSM agent first.
+
+    A command sent to an instance whose agent is offline stays Pending until
+    its timeout, so such routers are held back instead: after the wave of
+    online routers, they are re-checked after each of AGENT_RETRY_DELAYS
+    (counted from the previous check, i.e. from when the caller asks for the
+    next wave) and those that came back form the next wave. Routers not in
+    configs are in the first wave, for the caller to report. Only the given
+    routers are checked.
+
+    Args:
+        configs: Instance configs from get_instance_configs()
+        names: Router names
+
+    Yields:
+        list of tuples: (router name, None) for routers to run, or (router
+        name, PingStatus) for routers whose agent never came back (last wave)
+    """
+    names = list(names)
+    statuses = check_agents(configs, names)
+    deferred = [n for n in names if statuses.get(n, "Online") != "Online"]
+    first = [(name, None) for name in names if name not in deferred]
+    if deferred:
+        print(f"Holding back {len(deferred)} routers whose SSM agent is not online: "
+              + ", ".join(f"{n} ({statuses[n]})" for n in deferred))
+    if first:
+        yield first
+
+    checked = time.time()
+    for delay in AGENT_RETRY_DELAYS:
+        if not deferred:
+            return
+        time.sleep(max(0, delay - (time.time() - checked)))
+        statuses = check_agents(configs, deferred, refresh=True)
+        checked = time.time()
+        back = [n for n in deferred if statuses[n] == "Online"]
+        if back:
+            deferred = [n for n in deferred if n not in back]
+            yield [(name, None) for name in back]
+    if deferred:
+        yield [(name, statuses[name]) for name in deferred]
+
+
+def iter_reachable(configs, names):
+    """Yield the routers of reachable_waves() one at a time.
+
+    Yields:
+        tuple: (router name, None) for routers to run, or (router name,
+        PingStatus) for routers whose agent never came back
+    """
+    for wave in reachable_waves(configs, names):
+        yield from wave
+
+
+def unreachable_result(instance_id, ping_status):
+    """Return the failed send_and_wait()-style result for an offline SSM agent."""
+    return {
+        "status": "Failed",
+        "command_id": "",
+        "instance_id": instance_id,
+        "stdout": "",
+        "stderr": f"SSM agent not online ({ping_status}); command not sent",
+    }
+
+
+def agent_snapshot(instance_ids=None):
+    """Return the cached agent checks in a compact form for a phase result.
+
+    Only the number of checked and non-online agents and the first
+    AGENT_SNAPSHOT_LIMIT non-online ones are listed, so the size does not
+    grow with the fleet. The next phase passes it to seed_agents().
+
+    Args:
+        instance_ids: Instances the phase checked (default: every cached check)
+
+    Returns:
+        dict: checked_at (oldest check), checked, offline_count and offline
+        (instance_id -> PingStatus), or None if nothing was checked
+    """
+    with _AGENTS_LOCK:
+        if instance_ids is None:
+            checks = dict(_AGENTS)
+        else:
+            checks = {i: _AGENTS[i] for i in instance_ids if i in _AGENTS}
+    if not checks:
+        return None
+    offline = sorted((i, status) for i, (status, _) in checks.items() if status != "Online")
+    return {
+        "checked_at": min(checked_at for _, checked_at in checks.values()),
+        "checked": len(checks),
+        "offline_count": len(offline),
+        "offline": dict(offline[:AGENT_SNAPSHOT_LIMIT]),
+    }
+
+
+def seed_agents(event, configs):
+    """Fill the agent cache from the snapshot of an earlier phase in the event.
+
+    Step Functions passes the earlier phase results (phase1_result, ...) to
+    each phase; the newest snapshot younger than AGENT_CHECK_TTL is used, so
+    the phases of one run do not repeat the check. The listed offline agents
+    are always seeded; the other instances are seeded as online only if the
+    snapshot checked every router in configs and lists every offline agent.
+    Anything else is checked again.
+    """
+    snapshots = [r["agents"] for r in (event or {}).values()
+                 if isinstance(r, dict) and isinstance(r.get("agents"), dict)]
+    if not snapshots:
+        return
+    snapshot = max(snapshots, key=lambda s: s["checked_at"])
+    if time.time() - snapshot["checked_at"] >= AGENT_CHECK_TTL:
+        return
+    offline = snapshot["offline"]
+    complete = (snapshot.get("checked", 0) >= len(configs)
+                and snapshot.get("offline_count", len(offline)) == len(offline))
+    with _AGENTS_LOCK:
+        for config in configs.values():
+            instance_id = config.get("instance_id")
+            if not instance_id or instance_id in _AGENTS:
+                continue
+            if instance_id in offline:
+                _AGENTS[instance_id] = (offline[instance_id], snapshot["checked_at"])
+            elif complete:
+                _AGENTS[instance_id] = ("Online", snapshot["checked_at"])
+
+
+def parse_fail_fast(spec):
+    """Parse a fail-fast policy.
+
+    Args:
+        spec: "off" (default), "first", a number of failures (e.g. "3") or
+              a percentage of the routers (e.g. "10%")
+
+    Returns:
+        dict: {"failures": int} or {"ratio": float}, or None for off
+
+    Raises:
+        ValueError: If spec is not one of the above
+    """
+    spec = str(spec or "off").strip().lower()
+    if spec in ("off", "none", "false", "0"):
+        return None
+    if spec == "first":
+        return {"failures": 1}
+    try:
+        if spec.endswith("%"):
+            return {"ratio": float(spec[:-1]) / 100}
+        return {"failures": int(spec)}
+    except ValueError:
+        raise ValueError(f"Unknown fail-fast policy: {spec}. "
+                         "Expected off, first, a count (3) or a percentage (10%)") from None
+
+
+def fail_fast_reason(policy, failed, total):
+    """Return why a run must stop, or None while failures are within the policy."""
+    if not policy or not failed:
+        return None
+    if "failures" in policy and failed >= policy["failures"]:
+        return f"fail-fast: {failed} of {total} failed (limit {policy['failures']})"
+    if "ratio" in policy and failed >= policy["ratio"] * total:
+        return f"fail-fast: {failed} of {total} failed (limit {policy['ratio']:.0%})"
+    return None
+
+
+def cancelled_result(instance_id, reason, command_id=""):
+    """Return the send_and_wait()-style result of a command stopped by fail-fast."""
+    return {
+        "status": "Cancelled",
+        "command_id": command_id,
+        "instance_id": instance_id,
+        "stdout": "",
+        "stderr": f"Cancelled: {reason}",
+    }
+
+
+def _cancel(client, command_id, instance_id):
+    # Best effort: the command may have finished in the meantime
+    try:
+        client.cancel_command(CommandId=command_id, InstanceIds=[instance_id])
+    except Exception as e:
+        print(f"Failed to cancel {command_id} on {instance_id}: {e}")
+
+
+def run_phase(configs, names, build_command, timeout=600, fail_fast=None, on_result=None):
+    """Run a phase's command on routers concurrently.
+
+    The loop shared by the phase handlers: routers are taken in
+    reachable_waves() order and each wave runs build_command(name, configs)
+    on its routers through run_commands(). Routers missing from configs, or
+    whose SSM agent stays offline, fail without a command.
+
+    With a fail-fast policy (see parse_fail_fast()), the phase stops once
+    its failures reach the limit, e.g. when a VyOS image download fails
+    and every other router would fail the same way: the commands still
+    running are cancelled (CancelCommand) and routers not started yet are
+    Cancelled with the reason instead of running to their timeout.
+
+    Args:
+        configs: Instance configs from get_instance_configs()
+        names: Router names in dispatch order
+        build_command: Callable(router_name, configs) returning the commands
+        timeout: SSM timeout per command (default: 600)
+        fail_fast: Fail-fast policy (default: FAIL_FAST)
+        on_result: Callable(router_name, result) called with every result,
+                   to add details or trim output
+
+    Returns:
+        dict: results (keyed by router name), success_count, fail_count,
+        agents (see agent_snapshot()) and, if the phase stopped early,
+        aborted (the reason)
+    """
+    policy = parse_fail_fast(FAIL_FAST if fail_fast is None else fail_fast)
+    names = list(names)
+    results = {}
+    aborted = None
+
+    def fail_fast_check(finished):
+        # Failures of earlier waves count towards the limit of the phase;
+        # commands cancelled by the check itself do not
+        failed = sum(1 for r in {**results, **finished}.values()
+                     if r["status"] not in ("Success", "Cancelled"))
+        return fail_fast_reason(policy, failed, len(names))
+
+    # Routers whose SSM agent is offline are retried last (see reachable_waves)
+    for wave in reachable_waves(configs, names):
+        targets = {}
+        for name, agent_status in wave:
+            if name not in configs:
+                results[name] = {
+                    "status": "Failed",
+                    "command_id": "",
+                    "instance_id": "",
+                    "stdout": "",
+                    "stderr": f"Instance config not found for {name}",
+                }
+            elif agent_status:
+                results[name] = unreachable_result(configs[name]["instance_id"], agent_status)
+            else:
+                targets[name] = {
+                    "instance_id": configs[name]["instance_id"],
+                    "region": configs[name]["region"],
+                    "commands": build_command(name, configs),
                 }
-                if param_type in key_map:
-                    configs[instance_name][key_map[param_type]] = value
+        aborted = fail_fast_check({})
+        if targets and not aborted:
+            results.update(run_commands(targets, timeout=timeout, cancel=fail_fast_check))
+            aborted = fail_fast_check({})
+        if aborted:
+            print(f"Stopping phase: {aborted}")
+            break
 
-    return configs
+    for name in names:
+        if name not in results:
+            results[name] = cancelled_result(
+                configs.get(name, {}).get("instance_id", ""), aborted)
+    if on_result:
+        for name in names:
+            on_result(name, results[name])
 
+    success_count = sum(1 for r in results.values() if r["status"] == "Success")
+    phase = {
+        "results": {name: results[name] for name in names},
+        "success_count": success_count,
+        "fail_count": len(results) - success_count,
+        "agents": agent_snapshot(
+            [configs[n]["instance_id"] for n in names if n in configs]
+        ),
+    }
+    if aborted:
+        phase["aborted"] = aborted
+    return phase
 
-def send_and_wait(instance_id, region, commands, timeout=600):
+
+def send_and_wait(instance_id, region, commands, timeout=600, cancel=None):
     """Send an SSM RunShellScript command and poll until completion.
 
     Args:
@@ -129,22 +815,33 @@ def send_and_wait(instance_id, region, commands, timeout=600):
         region: AWS region of the instance
         commands: Shell command string or list of command strings
         timeout: Max seconds to wait for completion (default: 600)
+        cancel: Optional threading.Event; once set, the command is cancelled
+                at the next poll (used by the orchestrator's fail-fast)
 
     Returns:
         dict: Result with keys:
-            - status: "Success", "Failed", or "TimedOut"
+            - status: "Success", "Failed", "TimedOut" or "Cancelled"
             - command_id: SSM command ID
             - instance_id: Target instance ID
             - stdout: Standard output content
             - stderr: Standard error content
     """
-    client = boto3.client("ssm", region_name=region)
+    with tracing.span("ssm.command", instance_id=instance_id, region=region) as command_span:
+        result = _send_and_wait(instance_id, region, commands, timeout, cancel)
+        tracing.set_attributes(command_span, command_id=result["command_id"],
+                               ssm_status=result["status"])
+    return result
+
+
+def _send_and_wait(instance_id, region, commands, timeout, cancel=None):
+    client = get_client("ssm", region)
 
     # Normalize commands to a list
     if isinstance(commands, str):
         commands = [commands]
 
     # Send the command
+    started = time.time()
     response = client.send_command(
         InstanceIds=[instance_id],
         DocumentName="AWS-RunShellScript",
@@ -165,33 +862,171 @@ def send_and_wait(instance_id, region, commands, timeout=600):
     # Poll for completion
     elapsed = 0
     while elapsed < timeout:
-        time.sleep(POLL_INTERVAL)
-        elapsed += POLL_INTERVAL
+        with tracing.span("ssm.poll", command_id=command_id) as poll:
+            time.sleep(POLL_INTERVAL)
+            elapsed += POLL_INTERVAL
 
-        try:
-            invocation = client.get_command_invocation(
-                CommandId=command_id,
-                InstanceId=instance_id,
-            )
-        except client.exceptions.InvocationDoesNotExist:
-            continue
+            try:
+                invocation = client.get_command_invocation(
+                    CommandId=command_id,
+                    InstanceId=instance_id,
+                )
+            except client.exceptions.InvocationDoesNotExist:
+                invocation = {}
 
-        status = invocation.get("Status", "Pending")
+            status = invocation.get("Status", "Pending")
+            tracing.set_attributes(poll, status=status)
+
+        if status in ("Success", "Failed"):
+            _agent_seen(instance_id)
 
         if status == "Success":
             result["status"] = "Success"
             result["stdout"] = invocation.get("StandardOutputContent", "")
             result["stderr"] = invocation.get("StandardErrorContent", "")
-            return result
+            break
 
         if status in ("Failed", "Cancelled", "TimedOut"):
             result["status"] = "Failed"
             result["stdout"] = invocation.get("StandardOutputContent", "")
             result["stderr"] = invocation.get("StandardErrorContent", "")
-            return result
+            break
+
+        if cancel is not None and cancel.is_set():
+            _cancel(client, command_id, instance_id)
+            result.update(cancelled_result(instance_id, "another step failed", command_id))
+            break
 
         # InProgress, Pending, Delayed — keep polling
+    else:
+        # Timed out waiting
+        result["status"] = "TimedOut"
+
+    _record_command(commands, time.time() - started, elapsed // POLL_INTERVAL)
+    return result
+
+
+def _record_command(commands, seconds, polls):
+    """Add the EMF metrics of one SSM command (see metrics.py)."""
+    metrics.put("CommandSeconds", seconds, "Seconds")
+    metrics.put("CommandPolls", polls)
+    metrics.put("CommandBytes", sum(len(c.encode("utf-8")) for c in commands), "Bytes")
+
 
-    # Timed out waiting
-    result["status"] = "TimedOut"
+def _result_from_invocation(result, invocation):
+    """Copy a terminal get_command_invocation response into a result dict."""
+    status = invocation.get("Status", "Pending")
+    result["status"] = "Success" if status == "Success" else "Failed"
+    result["stdout"] = invocation.get("StandardOutputContent", "")
+    result["stderr"] = invocation.get("StandardErrorContent", "")
     return result
+
+
+def run_commands(targets, timeout=600, fail_fast=None, cancel=None):
+    """Send RunShellScript commands to many instances and poll them together.
+
+    All commands are sent up front, then every pending invocation is polled
+    once per POLL_INTERVAL, so total wall-clock is bounded by the slowest
+    instance instead of the sum of all of them. Targets whose SSM agent is
+    not online (see describe_agents()) fail at once without a command.
+
+    With a fail-fast policy, the commands still running are cancelled as
+    soon as the failures reach its limit (off by default: the convergence
+    checks expect single failures). A cancel callable can stop them for
+    other reasons, such as a policy over more routers than these targets.
+
+    Args:
+        targets: Dict keyed by name, each value containing:
+            - instance_id (str)
+            - region (str)
+            - commands (str or list of str)
+        timeout: Max seconds to wait for all commands (default: 600)
+        fail_fast: Fail-fast policy (see parse_fail_fast(); default: off)
+        cancel: Optional Callable(finished) called after every poll with the
+                results of the finished commands; returns why the commands
+                still running must be cancelled, or None
+
+    Returns:
+        dict: Keyed by name, each value in the same format as send_and_wait()
+    """
+    policy = parse_fail_fast(fail_fast)
+    results = {}
+    pending = {}
+    spans = {}
+    sent = {}
+
+    agents = describe_agents({t["instance_id"]: t["region"] for t in targets.values()})
+    for name, target in targets.items():
+        if agents[target["instance_id"]] != "Online":
+            results[name] = unreachable_result(target["instance_id"], agents[target["instance_id"]])
+            continue
+        client = get_client("ssm", target["region"])
+        commands = target["commands"]
+        if isinstance(commands, str):
+            commands = [commands]
+
+        spans[name] = tracing.start_span("ssm.command", target=name,
+                                         instance_id=target["instance_id"],
+                                         region=target["region"])
+        sent[name] = (time.time(), commands)
+        response = client.send_command(
+            InstanceIds=[target["instance_id"]],
+            DocumentName="AWS-RunShellScript",
+            Parameters={"commands": commands},
+            TimeoutSeconds=timeout,
+        )
+        results[name] = {
+            "status": "TimedOut",
+            "command_id": response["Command"]["CommandId"],
+            "instance_id": target["instance_id"],
+            "stdout": "",
+            "stderr": "",
+        }
+        pending[name] = client
+        tracing.set_attributes(spans[name], command_id=results[name]["command_id"])
+
+    elapsed = 0
+    while pending and elapsed < timeout:
+        with tracing.span("ssm.poll", pending=len(pending)):
+            time.sleep(POLL_INTERVAL)
+            elapsed += POLL_INTERVAL
+
+            for name, client in list(pending.items()):
+                result = results[name]
+                try:
+                    invocation = client.get_command_invocation(
+                        CommandId=result["command_id"],
+                        InstanceId=result["instance_id"],
+                    )
+                except client.exceptions.InvocationDoesNotExist:
+                    continue
+
+                if invocation.get("Status", "Pending") in TERMINAL_STATUSES:
+                    if invocation["Status"] in ("Success", "Failed"):
+                        _agent_seen(result["instance_id"])
+                    _result_from_invocation(result, invocation)
+                    tracing.end_span(spans[name], ssm_status=invocation["Status"])
+                    _record_command(sent[name][1], time.time() - sent[name][0],
+                                    elapsed // POLL_INTERVAL)
+                    del pending[name]
+
+            finished = {n: r for n, r in results.items() if n not in pending}
+            failed = sum(1 for r in finished.values() if r["status"] != "Success")
+            aborted = fail_fast_reason(policy, failed, len(targets))
+            if not aborted and cancel and pending:
+                aborted = cancel(finished)
+            if aborted and pending:
+                print(f"Cancelling {len(pending)} commands: {aborted}")
+                for name, client in pending.items():
+                    result = results[name]
+                    _cancel(client, result["command_id"], result["instance_id"])
+                    results[name] = cancelled_result(result["instance_id"], aborted,
+                                                     result["command_id"])
+                    tracing.end_span(spans[name], ssm_status="Cancelled")
+                pending.clear()
+
+    # Anything still pending keeps status TimedOut
+    for name in pending:
+        tracing.end_span(spans[name], ssm_status="TimedOut")
+        _record_command(sent[name][1], time.time() - sent[name][0], elapsed // POLL_INTERVAL)
+    return results
@@ -591,7 +591,9 @@ resource "aws_instance" "fra_branch1_sdwan_instance" {
   associate_public_ip_address = true
 
   tags = {
-    Name = "fra-branch1-vpc-sdwan-instance"
+    Name           = "fra-branch1-vpc-sdwan-instance"
+    "sdwan:router" = "fra-branch1"
+    "sdwan:role"   = "branch"
   }
 }
 
@@ -666,7 +668,9 @@ resource "aws_instance" "fra_sdwan_sdwan_instance" {
   associate_public_ip_address = true
 
   tags = {
-    Name = "fra-sdwan-vpc-sdwan-instance"
+    Name           = "fra-sdwan-vpc-sdwan-instance"
+    "sdwan:router" = "fra-sdwan"
+    "sdwan:role"   = "sdwan"
   }
 }
 
@@ -745,7 +749,9 @@ resource "aws_instance" "nv_branch1_sdwan_instance" {
   associate_public_ip_address = true
 
   tags = {
-    Name = "nv-branch1-vpc-sdwan-instance"
+    Name           = "nv-branch1-vpc-sdwan-instance"
+    "sdwan:router" = "nv-branch1"
+    "sdwan:role"   = "branch"
   }
 }
 
@@ -895,7 +901,9 @@ resource "aws_instance" "nv_sdwan_sdwan_instance" {
   associate_public_ip_address = true
 
   tags = {
-    Name = "nv-sdwan-vpc-sdwan-instance"
+    Name           = "nv-sdwan-vpc-sdwan-instance"
+    "sdwan:router" = "nv-sdwan"
+    "sdwan:role"   = "sdwan"
   }
 }
 
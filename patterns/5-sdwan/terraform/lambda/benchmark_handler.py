@@ -0,0 +1,263 @@
+"""
+Benchmark Lambda Handler — data-plane throughput tests via SSM Run Command.
+
+Optional phase that runs iperf3 TCP and UDP tests between router pairs from
+the SD-WAN topology: across each intra-region VTI/IPsec tunnel and across
+Cloud WAN between the branch routers. Results (Gbps, retransmits, pps, loss,
+jitter) are stored next to the verification report through the report sink.
+"""
+
+import os
+
+import metrics
+import output_store
+import tracing
+from instrumentation import instrumented
+from profiling import profiled
+from phase2_handler import DUMMY_INTERFACES
+from phase4_handler import TUNNELS
+from report_sinks import get_run_id, write_report
+from ssm_utils import get_instance_configs, run_commands
+from verify_parsers import parse_iperf3, split_sections
+
+
+SSM_PARAM_PREFIX = os.environ.get("SSM_PARAM_PREFIX", "/sdwan/")
+SSM_TIMEOUT = int(os.environ.get("SSM_TIMEOUT", "300"))
+
+# iperf3 test settings
+BENCHMARK_DURATION = int(os.environ.get("BENCHMARK_DURATION", "10"))
+BENCHMARK_STREAMS = int(os.environ.get("BENCHMARK_STREAMS", "4"))
+BENCHMARK_UDP_RATE = os.environ.get("BENCHMARK_UDP_RATE", "500M")
+IPERF3_PORT = 5201
+
+# Cross-region pairs over Cloud WAN, tested between the branch Prod dummy addresses
+CROSS_REGION_PAIRS = [("nv-branch1", "fra-branch1")]
+
+
+def get_benchmark_pairs():
+    """Return the router pairs to benchmark.
+
+    Each intra-region tunnel is tested between its VTI addresses; each
+    cross-region pair is tested between the branches' dum0 (Prod) addresses
+    so traffic crosses Cloud WAN.
+
+    Returns:
+        list of dicts, each with keys:
+            - name: pair label (e.g. nv-sdwan->nv-branch1)
+            - client, server: router names
+            - bind_ip: client source address
+            - server_ip: address the client connects to
+            - path: "tunnel" or "cloudwan"
+    """
+    pairs = []
+    for tunnel in TUNNELS:
+        pairs.append({
+            "name": f"{tunnel['router_a']}->{tunnel['router_b']}",
+            "client": tunnel["router_a"],
+            "server": tunnel["router_b"],
+            "bind_ip": tunnel["vti_a_addr"],
+            "server_ip": tunnel["vti_b_addr"],
+            "path": "tunnel",
+        })
+    for client, server in CROSS_REGION_PAIRS:
+        pairs.append({
+            "name": f"{client}->{server}",
+            "client": client,
+            "server": server,
+            "bind_ip": DUMMY_INTERFACES[client][0]["addr"].split("/")[0],
+            "server_ip": DUMMY_INTERFACES[server][0]["addr"].split("/")[0],
+            "path": "cloudwan",
+        })
+    return pairs
+
+
+def build_server_command(start=True):
+    """Build an SSM command that starts (or stops) an iperf3 server in the router."""
+    if not start:
+        return "#!/bin/bash\nlxc exec router -- pkill -x iperf3 || true\n"
+    return f"""#!/bin/bash
+lxc exec router -- pkill -x iperf3 || true
+lxc exec router -- iperf3 -s -D -p {IPERF3_PORT}
+"""
+
+
+def build_client_command(pair):
+    """Build an SSM command that runs the TCP then UDP iperf3 test for a pair.
+
+    Args:
+        pair: Dict from get_benchmark_pairs()
+
+    Returns:
+        str: Shell script for SSM RunShellScript
+    """
+    base = f"iperf3 -c {pair['server_ip']} -B {pair['bind_ip']} -p {IPERF3_PORT} -t {BENCHMARK_DURATION} -J"
+    return f"""#!/bin/bash
+echo "=== Benchmark {pair['name']} ==="
+
+echo "--- iperf3 TCP ---"
+lxc exec router -- {base} -P {BENCHMARK_STREAMS}
+
+echo "--- iperf3 UDP ---"
+lxc exec router -- {base} -u -b {BENCHMARK_UDP_RATE}
+"""
+
+
+def _target(router_name, configs, commands):
+    return {
+        "instance_id": configs[router_name]["instance_id"],
+        "region": configs[router_name]["region"],
+        "commands": commands,
+    }
+
+
+def persist_benchmark_results(result, run_id):
+    """Persist the benchmark report through the configured report sink.
+
+    Writes a text table and the per-pair JSON (without raw output) under the
+    name benchmark-results, next to the verification report. On failure, logs
+    the error and returns without raising.
+
+    Args:
+        result: The full benchmark result dict
+        run_id: Pipeline run ID
+    """
+    pairs = {
+        name: {k: v for k, v in pair.items() if k in ("path", "status", "tcp", "udp")}
+        for name, pair in result.get("results", {}).items()
+    }
+    write_report(
+        "benchmark-results",
+        _format_report(result),
+        {
+            "run_id": run_id,
+            "success_count": result.get("success_count", 0),
+            "fail_count": result.get("fail_count", 0),
+            "pairs": pairs,
+        },
+        run_id,
+    )
+
+
+def _format_report(result):
+    """Format benchmark results as a human-readable text report.
+
+    Args:
+        result: The full benchmark result dict
+
+    Returns:
+        str: Formatted text report
+    """
+    lines = [
+        "SD-WAN Benchmark Report",
+        "=" * 50,
+        "",
+    ]
+    for name, pair in result.get("results", {}).items():
+        tcp = pair.get("tcp") or {}
+        udp = pair.get("udp") or {}
+        if pair.get("status") != "Success":
+            error = tcp.get("error") or udp.get("error") or pair.get("stderr", "")
+            lines.append(f"  {name:<26} FAIL - {error[:60]}")
+            continue
+        lines.append(
+            f"  {name:<26} [{pair['path']}] "
+            f"TCP={tcp['gbps_sent']:.2f}Gbps retr={tcp['retransmits']}  "
+            f"UDP={udp['gbps']:.2f}Gbps {udp['pps']}pps loss={udp['loss_pct']:g}% "
+            f"jitter={udp['jitter_ms']:.3f}ms"
+        )
+    lines.append("")
+    total = result.get("success_count", 0) + result.get("fail_count", 0)
+    lines.append(f"Result: {result.get('success_count', 0)}/{total} pairs passed")
+    return "\n".join(lines)
+
+
+@instrumented
+@tracing.traced("benchmark")
+@metrics.emits_metrics("benchmark")
+@profiled
+def handler(event, context):
+    """Lambda handler for the optional benchmark phase.
+
+    Starts an iperf3 server on every router that acts as a server, runs the
+    pair tests one at a time (so pairs sharing a router don't skew each
+    other), then stops the servers.
+
+    Args:
+        event: Lambda event (passed from Step Functions)
+        context: Lambda context object
+
+    Returns:
+        dict: Structured result:
+            - phase: "benchmark"
+            - results: dict keyed by pair name with status, path, tcp, udp
+            - success_count: number of pairs with both tests successful
+            - fail_count: number of failed pairs
+    """
+    configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
+
+    results = {}
+    success_count = 0
+    fail_count = 0
+
+    pairs = []
+    for pair in get_benchmark_pairs():
+        missing = [r for r in (pair["client"], pair["server"]) if r not in configs]
+        if missing:
+            results[pair["name"]] = {
+                "status": "Failed",
+                "path": pair["path"],
+                "stderr": f"Instance config not found for {', '.join(missing)}",
+            }
+            fail_count += 1
+        else:
+            pairs.append(pair)
+
+    servers = sorted({pair["server"] for pair in pairs})
+    run_commands(
+        {r: _target(r, configs, build_server_command()) for r in servers},
+        timeout=SSM_TIMEOUT,
+    )
+
+    for pair in pairs:
+        run = run_commands(
+            {pair["name"]: _target(pair["client"], configs, build_client_command(pair))},
+            timeout=SSM_TIMEOUT,
+        )[pair["name"]]
+
+        sections = split_sections(run.get("stdout", ""))
+        tcp = parse_iperf3(sections.get("iperf3 TCP", ""))
+        udp = parse_iperf3(sections.get("iperf3 UDP", ""))
+        ok = run["status"] == "Success" and "error" not in tcp and "error" not in udp
+
+        results[pair["name"]] = {
+            "status": "Success" if ok else "Failed",
+            "path": pair["path"],
+            "command_id": run["command_id"],
+            "tcp": tcp,
+            "udp": udp,
+            "stderr": run.get("stderr", ""),
+        }
+        if ok:
+            success_count += 1
+            metrics.put("TcpGbps", tcp.get("gbps_received"), "Gigabits/Second")
+            metrics.put("UdpLossPercent", udp.get("loss_pct"), "Percent")
+            metrics.put("UdpJitterMs", udp.get("jitter_ms"), "Milliseconds")
+        else:
+            fail_count += 1
+
+    run_commands(
+        {r: _target(r, configs, build_server_command(start=False)) for r in servers},
+        timeout=SSM_TIMEOUT,
+    )
+
+    final_result = {
+        "phase": "benchmark",
+        "results": results,
+        "success_count": success_count,
+        "fail_count": fail_count,
+    }
+
+    run_id = get_run_id(event, context)
+    persist_benchmark_results(final_result, run_id)
+
+    return output_store.bound_results(final_result, run_id)
@@ -0,0 +1,212 @@
+"""
+AWS API call instrumentation for the Lambda handlers.
+
+ssm_utils.get_client() registers botocore event hooks on every client it
+creates, so all SSM, CloudFormation, S3 and Lambda calls made by the phase
+handlers and cross_region_stack are counted per operation with their
+latency (histogram and percentiles), retries, throttles and errors. The
+clients of fake_aws report their simulated calls the same way.
+
+Wrap a handler with @instrumented to reset the counters at the start of each
+invocation, log a one-line summary at the end and add the summary to the
+handler's result under "api_stats". The hooks only read a timer and update a
+few counters, so the overhead is a few microseconds per API call. Set
+API_INSTRUMENTATION=off to disable them.
+"""
+
+import bisect
+import functools
+import os
+import threading
+import time
+
+
+ENABLED = os.environ.get("API_INSTRUMENTATION", "on").lower() not in ("off", "false", "0")
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is open
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Error codes counted as throttling
+THROTTLING_CODES = {
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottledException",
+    "TooManyRequestsException", "RequestLimitExceeded", "SlowDown",
+}
+
+# (service, operation) -> counters; shared by all threads of an invocation
+_STATS = {}
+_LOCK = threading.Lock()
+
+_START_KEY = "sdwan_instrumentation_start"
+
+
+def record(service, operation, elapsed_ms=None, retries=0, throttled=0, error=None):
+    """Count one API call (elapsed_ms given) and/or retries, throttles, an error.
+
+    Called by the botocore hooks, and by fake_aws for its simulated calls.
+    """
+    with _LOCK:
+        stats = _STATS.get((service, operation))
+        if stats is None:
+            stats = _STATS[(service, operation)] = {
+                "count": 0, "errors": 0, "retries": 0, "throttled": 0,
+                "total_ms": 0.0, "max_ms": 0.0,
+                "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            }
+        if elapsed_ms is not None:
+            stats["count"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["histogram"][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        stats["retries"] += retries
+        stats["throttled"] += throttled
+        if error:
+            stats["errors"] += 1
+
+
+def _service(model):
+    return model.service_model.endpoint_prefix
+
+
+def _before_call(model, context, **kwargs):
+    context[_START_KEY] = (_service(model), model.name, time.perf_counter())
+
+
+def _after_call(http_response, parsed, context, **kwargs):
+    # Also emitted for service errors (HTTP status >= 300), before they are raised
+    started = context.pop(_START_KEY, None)
+    if started is None:
+        return
+    service, operation, start = started
+    error = None
+    if http_response.status_code >= 300:
+        error = parsed.get("Error", {}).get("Code", str(http_response.status_code))
+    record(service, operation, (time.perf_counter() - start) * 1000,
+           retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0), error=error)
+
+
+def _after_call_error(exception, context, **kwargs):
+    # Connection errors and timeouts that exhausted the retries
+    started = context.pop(_START_KEY, None)
+    if started is None:
+        return
+    service, operation, start = started
+    record(service, operation, (time.perf_counter() - start) * 1000,
+           error=type(exception).__name__)
+
+
+def _needs_retry(response=None, operation=None, attempts=None, **kwargs):
+    # Called after every attempt; count throttled attempts, including the
+    # ones botocore retried transparently. Must return None.
+    if not response or operation is None:
+        return None
+    code = (response[1] or {}).get("Error", {}).get("Code")
+    if code in THROTTLING_CODES:
+        record(_service(operation), operation.name, throttled=1)
+    return None
+
+
+def instrument(client):
+    """Register the counting hooks on a botocore client (once per client).
+
+    Clients without a botocore event system (e.g. the fakes) are returned
+    unchanged.
+
+    Returns:
+        The same client
+    """
+    events = getattr(getattr(client, "meta", None), "events", None)
+    if not ENABLED or events is None or getattr(client, "_sdwan_instrumented", False):
+        return client
+    events.register("before-call.*.*", _before_call)
+    events.register("after-call.*.*", _after_call)
+    events.register("after-call-error.*.*", _after_call_error)
+    events.register("needs-retry.*.*", _needs_retry)
+    client._sdwan_instrumented = True
+    return client
+
+
+def reset():
+    """Clear all counters (called at the start of each invocation)."""
+    with _LOCK:
+        _STATS.clear()
+
+
+def _percentile(histogram, total, pct):
+    """Upper bound (ms) of the bucket holding the pct-th percentile."""
+    rank = total * pct / 100
+    seen = 0
+    for i, n in enumerate(histogram):
+        seen += n
+        if n and seen >= rank:
+            return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else None
+    return None
+
+
+def summary():
+    """Return the counters as a JSON-serializable summary.
+
+    Returns:
+        dict: calls, retries, throttled, errors (totals) and operations keyed
+              by "<service>.<Operation>" with count, errors, retries,
+              throttled, avg_ms, max_ms, p50_ms/p90_ms/p99_ms (bucket upper
+              bounds, None above the last bucket) and the non-empty
+              histogram buckets keyed by upper bound ("inf" for the last)
+    """
+    with _LOCK:
+        stats = {k: dict(v, histogram=list(v["histogram"])) for k, v in _STATS.items()}
+
+    operations = {}
+    for (service, operation), s in sorted(stats.items()):
+        count = s["count"]
+        operations[f"{service}.{operation}"] = {
+            "count": count,
+            "errors": s["errors"],
+            "retries": s["retries"],
+            "throttled": s["throttled"],
+            "avg_ms": round(s["total_ms"] / count, 1) if count else 0.0,
+            "max_ms": round(s["max_ms"], 1),
+            "p50_ms": _percentile(s["histogram"], count, 50),
+            "p90_ms": _percentile(s["histogram"], count, 90),
+            "p99_ms": _percentile(s["histogram"], count, 99),
+            "histogram": {
+                str(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else "inf": n
+                for i, n in enumerate(s["histogram"]) if n
+            },
+        }
+    return {
+        "calls": sum(op["count"] for op in operations.values()),
+        "retries": sum(op["retries"] for op in operations.values()),
+        "throttled": sum(op["throttled"] for op in operations.values()),
+        "errors": sum(op["errors"] for op in operations.values()),
+        "operations": operations,
+    }
+
+
+def format_summary(stats):
+    """Format a summary() result as one log line."""
+    ops = ", ".join(
+        f"{name} {op['count']} (avg {op['avg_ms']}ms, max {op['max_ms']}ms)"
+        for name, op in stats["operations"].items()
+    )
+    return (f"API calls: {stats['calls']}, retries: {stats['retries']}, "
+            f"throttled: {stats['throttled']}, errors: {stats['errors']}"
+            + (f" [{ops}]" if ops else ""))
+
+
+def instrumented(handler):
+    """Decorator for Lambda handlers: reset, log and attach the API summary.
+
+    If the handler returns a dict, the summary is added as result["api_stats"].
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        reset()
+        try:
+            result = handler(event, context)
+        finally:
+            stats = summary()
+            print(format_summary(stats))
+        if isinstance(result, dict) and ENABLED:
+            result["api_stats"] = stats
+        return result
+    return wrapper
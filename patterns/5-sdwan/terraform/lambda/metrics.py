@@ -0,0 +1,185 @@
+"""
+CloudWatch Embedded Metric Format (EMF) output for the phase handlers.
+
+Handlers and ssm_utils add values with put() while they run, for example
+the duration, poll count and script size of every SSM command, the ping
+RTT/loss of every verification target and the convergence time of every
+router. Wrap a handler with @emits_metrics(phase) to write them to stdout
+when it returns; CloudWatch Logs turns the records into metrics in the
+METRICS_NAMESPACE namespace with a Phase dimension, no PutMetricData calls
+needed.
+
+Values are batched: each record carries all metrics, with up to
+MAX_VALUES values per metric (the EMF limit), so a run over N routers
+writes about N / 100 log lines instead of one per router. Set
+EMF_METRICS=off to disable the output.
+
+To check the output offline, feed the log to parse_log() or run:
+
+    python metrics.py handler.log
+"""
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SDWAN")
+ENABLED = os.environ.get("EMF_METRICS", "on").lower() not in ("off", "false", "0")
+
+# Max values per metric in one EMF record
+MAX_VALUES = 100
+
+# metric name -> {"unit": str, "values": [float]}; shared by all threads
+_METRICS = {}
+_PROPERTIES = {}
+_LOCK = threading.Lock()
+
+
+def put(name, value, unit="Count"):
+    """Add one value to a metric (ignored if value is None)."""
+    if value is None:
+        return
+    with _LOCK:
+        metric = _METRICS.setdefault(name, {"unit": unit, "values": []})
+        metric["values"].append(round(float(value), 3))
+
+
+def set_property(key, value):
+    """Add a searchable (non-metric) field to every record of this invocation."""
+    with _LOCK:
+        _PROPERTIES[key] = value
+
+
+def reset():
+    """Drop all values and properties (called at the start of each invocation)."""
+    with _LOCK:
+        _METRICS.clear()
+        _PROPERTIES.clear()
+
+
+def records(dimensions, timestamp=None):
+    """Build the EMF records for the values collected so far.
+
+    Args:
+        dimensions: Dict of dimension name -> value (e.g. {"Phase": "phase2"})
+        timestamp: Epoch seconds (default: now)
+
+    Returns:
+        list of dict: One EMF record per batch of MAX_VALUES values
+    """
+    with _LOCK:
+        metrics = {name: dict(m, values=list(m["values"])) for name, m in _METRICS.items()}
+        properties = dict(_PROPERTIES)
+    if not metrics:
+        return []
+
+    batches = max((len(m["values"]) + MAX_VALUES - 1) // MAX_VALUES for m in metrics.values())
+    timestamp_ms = int((timestamp if timestamp is not None else time.time()) * 1000)
+    result = []
+    for batch in range(batches):
+        record = {}
+        definitions = []
+        for name, metric in sorted(metrics.items()):
+            values = metric["values"][batch * MAX_VALUES:(batch + 1) * MAX_VALUES]
+            if not values:
+                continue
+            definitions.append({"Name": name, "Unit": metric["unit"]})
+            record[name] = values if len(values) > 1 else values[0]
+        record["_aws"] = {
+            "Timestamp": timestamp_ms,
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [sorted(dimensions)],
+                "Metrics": definitions,
+            }],
+        }
+        record.update(properties)
+        record.update(dimensions)
+        result.append(record)
+    return result
+
+
+def flush(dimensions):
+    """Print the EMF records (one JSON line each) and reset.
+
+    Returns:
+        int: Number of records written
+    """
+    lines = records(dimensions)
+    for record in lines:
+        print(json.dumps(record, separators=(",", ":")))
+    reset()
+    return len(lines)
+
+
+def emits_metrics(phase):
+    """Decorator for Lambda handlers: emit the collected values as EMF.
+
+    The success_count and fail_count of dict results (routers, benchmark
+    pairs or orchestrator steps) are added as Succeeded and Failed.
+    """
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not ENABLED:
+                return handler(event, context)
+            reset()
+            try:
+                result = handler(event, context)
+                if isinstance(result, dict):
+                    put("Succeeded", result.get("success_count"))
+                    put("Failed", result.get("fail_count"))
+                return result
+            finally:
+                flush({"Phase": phase})
+        return wrapper
+    return decorate
+
+
+def parse_log(text):
+    """Collect the metric values from the EMF records in a log.
+
+    Non-JSON lines and JSON lines without an _aws key are skipped.
+
+    Returns:
+        dict: (phase dimension or "", metric name) -> list of values
+    """
+    values = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith("{"):
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(record, dict) or "_aws" not in record:
+            continue
+        for directive in record["_aws"].get("CloudWatchMetrics", []):
+            for metric in directive.get("Metrics", []):
+                value = record.get(metric["Name"])
+                value = value if isinstance(value, list) else [value]
+                values.setdefault((record.get("Phase", ""), metric["Name"]), []).extend(value)
+    return values
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize the EMF metrics in a log file.")
+    parser.add_argument("log", nargs="?", type=argparse.FileType(), default=sys.stdin)
+    args = parser.parse_args(argv)
+
+    for (phase, name), values in sorted(parse_log(args.log.read()).items()):
+        values = sorted(values)
+        print(f"{phase:<14} {name:<26} n={len(values):<6} min={values[0]:<10g} "
+              f"p50={values[len(values) // 2]:<10g} max={values[-1]:g}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
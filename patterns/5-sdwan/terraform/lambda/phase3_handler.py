@@ -7,7 +7,15 @@ Additive-only: does NOT modify or delete existing VPN/BGP configuration.
 """
 
 import os
-from ssm_utils import get_instance_configs, send_and_wait
+
+import metrics
+import output_store
+import tracing
+from instrumentation import instrumented
+from profiling import profiled
+from report_sinks import get_run_id
+from rollout import run_rollout
+from ssm_utils import discovered_routers, get_instance_configs, seed_agents, select_routers
 
 
 SSM_PARAM_PREFIX = os.environ.get("SSM_PARAM_PREFIX", "/sdwan/")
@@ -23,9 +31,6 @@ PRIVATE_SUBNET_GW = {
     "fra-sdwan": "10.200.1.1",
 }
 
-# Only SDWAN routers get Cloud WAN BGP config
-SDWAN_ROUTERS = ["nv-sdwan", "fra-sdwan"]
-
 
 def build_cloudwan_bgp_script(router_name, configs):
     """Generate a vbash script for Cloud WAN BGP on a single SDWAN router.
@@ -128,53 +133,64 @@ lxc exec router -- /tmp/vyos-cloudwan-bgp.sh
 """.format(bgp_script=bgp_script)
 
 
-def handler(event, context):
-    """Lambda handler for Phase 3 Cloud WAN BGP configuration.
+def build_command(router_name, configs):
+    """Return the Phase 3 SSM command for one SDWAN router.
 
-    Reads instance configs and Cloud WAN Connect Peer params from SSM,
-    generates per-router vbash scripts, and executes via SSM.
+    Args:
+        router_name: One of the SDWAN routers (see get_routers)
+        configs: Dict from get_instance_configs(), including Cloud WAN peer params
+
+    Returns:
+        str: Shell script for SSM RunShellScript
     """
-    configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
+    return build_ssm_command(build_cloudwan_bgp_script(router_name, configs))
 
-    results = {}
-    success_count = 0
-    fail_count = 0
-
-    for router_name in SDWAN_ROUTERS:
-        if router_name not in configs:
-            results[router_name] = {
-                "status": "Failed",
-                "command_id": "",
-                "instance_id": "",
-                "stdout": "",
-                "stderr": f"Instance config not found for {router_name}",
-            }
-            fail_count += 1
-            continue
-
-        instance_id = configs[router_name]["instance_id"]
-        region = configs[router_name]["region"]
-
-        bgp_script = build_cloudwan_bgp_script(router_name, configs)
-        ssm_cmd = build_ssm_command(bgp_script)
-
-        result = send_and_wait(
-            instance_id=instance_id,
-            region=region,
-            commands=ssm_cmd,
-            timeout=SSM_TIMEOUT,
-        )
 
-        results[router_name] = result
+def get_routers(configs):
+    """Return the routers Phase 3 applies to: the discovered SDWAN routers.
 
-        if result["status"] == "Success":
-            success_count += 1
-        else:
-            fail_count += 1
+    Only SDWAN routers get Cloud WAN BGP config.
 
-    return {
-        "phase": "phase3",
-        "results": results,
-        "success_count": success_count,
-        "fail_count": fail_count,
-    }
+    Raises:
+        ValueError: If a discovered SDWAN router has no SDWAN_BGP_ASN or
+                    PRIVATE_SUBNET_GW entry
+    """
+    topology = SDWAN_BGP_ASN.keys() & PRIVATE_SUBNET_GW.keys()
+    return discovered_routers(configs, "phase3", role="sdwan", topology=topology)
+
+
+@instrumented
+@tracing.traced("phase3")
+@metrics.emits_metrics("phase3")
+@profiled
+def handler(event, context):
+    """Lambda handler for Phase 3 Cloud WAN BGP configuration.
+
+    Reads instance configs and Cloud WAN Connect Peer params from SSM,
+    generates per-router vbash scripts, and executes via SSM. Router
+    selectors in the event (see ssm_utils.select_routers) limit the run to a
+    subset of the SDWAN routers (see get_routers); with ROLLOUT (or rollout
+    in the event) the routers are configured in health-gated waves (see
+    rollout).
+    """
+    configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
+    seed_agents(event, configs)
+    run_id = get_run_id(event, context)
+
+    names, selection = select_routers(get_routers(configs), configs, event, "phase3")
+
+    phase = run_rollout(
+        configs,
+        names,
+        build_command,
+        "phase3",
+        spec=event.get("rollout"),
+        timeout=SSM_TIMEOUT,
+        fail_fast=event.get("fail_fast"),
+        on_result=lambda name, result: output_store.offload(result, run_id, "phase3", name),
+    )
+
+    if selection:
+        phase["selection"] = selection
+
+    return output_store.bound_results({"phase": "phase3", **phase}, run_id)
@@ -7,21 +7,40 @@ on all 4 SD-WAN Ubuntu instances via SSM.
 Replicates the logic from phase3-verify.sh as an AWS Lambda function.
 """
 
-import json
 import os
 
-import boto3
-
-from ssm_utils import get_instance_configs, send_and_wait
+import metrics
+import output_store
+import tracing
+from instrumentation import instrumented
+from profiling import profiled
+from report_sinks import get_run_id, write_report
+from ssm_utils import (
+    discovered_routers,
+    get_instance_configs,
+    router_role,
+    run_phase,
+    seed_agents,
+    select_routers,
+)
+from verify_parsers import (
+    bgp_status,
+    ipsec_status,
+    parse_bgp_neighbors,
+    parse_bgp_summary,
+    parse_ipsec_sa,
+    parse_ping,
+    split_sections,
+)
 
 
 # Configurable via environment variables
 SSM_PARAM_PREFIX = os.environ.get("SSM_PARAM_PREFIX", "/sdwan/")
 SSM_TIMEOUT = int(os.environ.get("SSM_TIMEOUT", "300"))
 
-# SDWAN routers that peer with Cloud WAN (need Cloud WAN BGP verification)
-SDWAN_ROUTERS = ["nv-sdwan", "fra-sdwan"]
-
+# Probe settings: every target is probed concurrently with this many pings
+PING_COUNT = int(os.environ.get("PING_COUNT", "5"))
+PING_INTERVAL = os.environ.get("PING_INTERVAL", "0.2")
 
 # VPN tunnel topology — used to derive ping targets per router
 TUNNELS = [
@@ -60,41 +79,81 @@ def get_ping_targets(router_name):
     return targets
 
 
-# All routers to verify
-ROUTERS = ["nv-sdwan", "nv-branch1", "fra-sdwan", "fra-branch1"]
+def get_routers(configs):
+    """Return the routers Phase 4 verifies: every discovered router.
+
+    Raises:
+        ValueError: If a discovered router is not an end of any TUNNELS entry
+    """
+    topology = {t[end] for t in TUNNELS for end in ("router_a", "router_b")}
+    return discovered_routers(configs, "phase4", topology=topology)
+
 
 # VyOS op-mode command wrapper path
 VYOS_OP_WRAPPER = "/opt/vyatta/bin/vyatta-op-cmd-wrapper"
 
+# FRR shell inside the VyOS container, used for JSON BGP output
+VTYSH = "vtysh"
+
+
+def build_ping_commands(targets):
+    """Build a shell fragment that probes all targets concurrently.
+
+    Each target gets a backgrounded quiet ping whose summary is written to a
+    temp file; after a single `wait` the summaries are printed under
+    per-target markers followed by PING_OK/PING_FAIL. Total probe time is one
+    ping run regardless of how many targets there are.
+
+    Args:
+        targets: List of IP addresses to probe
+
+    Returns:
+        str: Shell fragment for the verification script ("" if no targets)
+    """
+    if not targets:
+        return ""
+
+    cmds = ""
+    for target in targets:
+        cmds += (
+            f"(lxc exec router -- ping -q -n -c {PING_COUNT} -i {PING_INTERVAL} -W 2 {target} "
+            f"> /tmp/sdwan-ping-{target}.out 2>&1; echo $? > /tmp/sdwan-ping-{target}.rc) &\n"
+        )
+    cmds += "wait\n"
+    for target in targets:
+        cmds += f"""
+echo "--- Ping {target} ---"
+cat /tmp/sdwan-ping-{target}.out
+[ "$(cat /tmp/sdwan-ping-{target}.rc)" = "0" ] && echo "PING_OK {target}" || echo "PING_FAIL {target}"
+rm -f /tmp/sdwan-ping-{target}.out /tmp/sdwan-ping-{target}.rc
+"""
+    return cmds
 
-def build_verify_command(router_name, configs=None):
+
+def build_verify_command(router_name, configs=None, ping=True):
     """Build an SSM command that runs VyOS show commands and ping tests.
 
     Executes inside the LXC router container via lxc exec:
     - show vpn ipsec sa
-    - show ip bgp summary
+    - show ip bgp summary (FRR JSON, falling back to op-mode text)
     - show interfaces
-    - show ip bgp neighbors (Cloud WAN peers, SDWAN routers only)
-    - ping tests to VTI peer addresses
+    - show ip bgp neighbors (Cloud WAN peers, SDWAN routers only; JSON
+      with text fallback)
+    - ping tests to VTI peer addresses, all targets probed concurrently
 
     Args:
         router_name: One of nv-sdwan, nv-branch1, fra-sdwan, fra-branch1
         configs: Optional dict from get_instance_configs() for Cloud WAN peer IPs
+        ping: Include the ping tests (default: True). The convergence checker
+              turns them off since it only needs IPsec/BGP state.
 
     Returns:
         str: Shell script for SSM RunShellScript
     """
-    ping_targets = get_ping_targets(router_name)
-
-    ping_cmds = ""
-    for target in ping_targets:
-        ping_cmds += f"""
-echo "--- Ping {target} ---"
-lxc exec router -- ping -c 3 -W 2 {target} && echo "PING_OK {target}" || echo "PING_FAIL {target}"
-"""
+    ping_cmds = build_ping_commands(get_ping_targets(router_name)) if ping else ""
 
     cloudwan_bgp_cmd = ""
-    if router_name in SDWAN_ROUTERS and configs and router_name in configs:
+    if router_role(router_name, configs) == "sdwan" and configs and router_name in configs:
         peer_ip1 = configs[router_name].get("cloudwan_peer_ip1", "")
         peer_ip2 = configs[router_name].get("cloudwan_peer_ip2", "")
         peer_filter_parts = []
@@ -106,7 +165,7 @@ lxc exec router -- ping -c 3 -W 2 {target} && echo "PING_OK {target}" || echo "P
             for peer_ip in peer_filter_parts:
                 cloudwan_bgp_cmd += f"""
 echo "--- Cloud WAN BGP Neighbor {peer_ip} ---"
-lxc exec router -- {VYOS_OP_WRAPPER} show ip bgp neighbors {peer_ip} || echo "CLOUDWAN_BGP_CHECK_FAILED"
+lxc exec router -- {VTYSH} -c 'show ip bgp neighbors {peer_ip} json' 2>/dev/null || lxc exec router -- {VYOS_OP_WRAPPER} show ip bgp neighbors {peer_ip} || echo "CLOUDWAN_BGP_CHECK_FAILED"
 """
 
     return f"""#!/bin/bash
@@ -116,7 +175,7 @@ echo "--- IPsec SA Status ---"
 lxc exec router -- {VYOS_OP_WRAPPER} show vpn ipsec sa || echo "IPSEC_CHECK_FAILED"
 
 echo "--- BGP Summary ---"
-lxc exec router -- {VYOS_OP_WRAPPER} show ip bgp summary || echo "BGP_CHECK_FAILED"
+lxc exec router -- {VTYSH} -c 'show ip bgp summary json' 2>/dev/null || lxc exec router -- {VYOS_OP_WRAPPER} show ip bgp summary || echo "BGP_CHECK_FAILED"
 
 echo "--- Interfaces ---"
 lxc exec router -- {VYOS_OP_WRAPPER} show interfaces || echo "INTERFACES_CHECK_FAILED"
@@ -127,20 +186,35 @@ echo "=== Verification complete for {router_name} ==="
 """
 
 
-def parse_verify_output(stdout, router_name):
+def build_command(router_name, configs):
+    """Return the Phase 4 verification SSM command for one router."""
+    return build_verify_command(router_name, configs=configs)
+
+
+def parse_verify_output(stdout, router_name, configs=None):
     """Parse the verification command output into structured results.
 
+    The IPsec SA table, BGP summary and Cloud WAN neighbor sections are parsed
+    into per-SA and per-neighbor state. VPN BGP is "ok" only when every VTI
+    peer is Established; Cloud WAN BGP is "ok" only when every Cloud WAN peer
+    is Established.
+
     Args:
         stdout: Raw stdout from the SSM command
         router_name: Router name for ping target lookup
+        configs: Optional dict from get_instance_configs() for Cloud WAN peer IPs
 
     Returns:
         dict: Verification details with ipsec, bgp, interfaces, cloudwan_bgp,
-              and ping results
+              and ping results, plus the parsed ipsec_sas, bgp_neighbors,
+              cloudwan_bgp_neighbors, the expected cloudwan_bgp_peers and
+              per-target ping_stats (RTT, jitter, loss)
     """
     ping_targets = get_ping_targets(router_name)
+    sections = split_sections(stdout)
 
     ping_results = {}
+    ping_stats = {}
     for target in ping_targets:
         if f"PING_OK {target}" in stdout:
             ping_results[target] = "ok"
@@ -148,27 +222,70 @@ def parse_verify_output(stdout, router_name):
             ping_results[target] = "fail"
         else:
             ping_results[target] = "unknown"
+        ping_stats[target] = parse_ping(sections.get(f"Ping {target}", ""))
+
+    ipsec_sas = parse_ipsec_sa(sections.get("IPsec SA Status", ""))
+    if "IPSEC_CHECK_FAILED" in stdout:
+        ipsec = "fail"
+    else:
+        ipsec = ipsec_status(ipsec_sas, expected_count=len(ping_targets))
+
+    # VTI peer addresses are also the VPN BGP neighbor addresses
+    bgp_neighbors = parse_bgp_summary(sections.get("BGP Summary", ""))
+    if "BGP_CHECK_FAILED" in stdout:
+        bgp = "fail"
+    else:
+        bgp = bgp_status(bgp_neighbors, expected=ping_targets)
 
     # Cloud WAN BGP status: only applicable to SDWAN routers
-    if router_name in SDWAN_ROUTERS:
-        cloudwan_bgp = "fail" if "CLOUDWAN_BGP_CHECK_FAILED" in stdout else "ok"
+    cloudwan_neighbors = {}
+    expected_peers = []
+    if router_role(router_name, configs) == "sdwan":
+        for title, body in sections.items():
+            if title.startswith("Cloud WAN BGP Neighbor "):
+                expected_peers.append(title.rsplit(" ", 1)[1])
+                cloudwan_neighbors.update(parse_bgp_neighbors(body))
+        if configs and router_name in configs:
+            expected_peers = [
+                configs[router_name].get(key)
+                for key in ("cloudwan_peer_ip1", "cloudwan_peer_ip2")
+                if configs[router_name].get(key)
+            ]
+        if "CLOUDWAN_BGP_CHECK_FAILED" in stdout:
+            cloudwan_bgp = "fail"
+        else:
+            cloudwan_bgp = bgp_status(cloudwan_neighbors, expected=expected_peers)
     else:
         cloudwan_bgp = "not_applicable"
 
     return {
-        "ipsec": "fail" if "IPSEC_CHECK_FAILED" in stdout else "ok",
-        "bgp": "fail" if "BGP_CHECK_FAILED" in stdout else "ok",
+        "ipsec": ipsec,
+        "bgp": bgp,
         "interfaces": "fail" if "INTERFACES_CHECK_FAILED" in stdout else "ok",
         "cloudwan_bgp": cloudwan_bgp,
         "ping": ping_results,
+        "ping_stats": ping_stats,
+        "ipsec_sas": ipsec_sas,
+        "bgp_neighbors": bgp_neighbors,
+        "cloudwan_bgp_neighbors": cloudwan_neighbors,
+        "cloudwan_bgp_peers": expected_peers,
     }
 
 
-def persist_results_to_ssm(result):
-    """Write a human-readable verification report to SSM Parameter Store.
+def record_ping_metrics(details):
+    """Add the ping RTT and loss of every verification target to the EMF metrics."""
+    for stats in details.get("ping_stats", {}).values():
+        metrics.put("PingRttMs", stats["rtt_avg"], "Milliseconds")
+        metrics.put("PingLossPercent", stats["loss_pct"], "Percent")
 
-    Formats the verification results as a text summary and persists it to
-    /sdwan/verification-results for easy retrieval via AWS CLI or console.
+
+def persist_results(result, run_id):
+    """Persist the verification report through the configured report sink.
+
+    Writes the human-readable text report and a compact JSON form (per-router
+    check status, BGP/SA state and ping stats, without raw stdout) under the
+    name verification-results. See report_sinks for the available backends;
+    the default keeps the text at /sdwan/verification-results.
 
     On failure, logs the error and returns without raising — the phase
     should not fail due to a persistence issue.
@@ -176,18 +293,54 @@ def persist_results_to_ssm(result):
     Args:
         result: The full verification result dict (phase, results,
                 success_count, fail_count)
+        run_id: Pipeline run ID
     """
-    try:
-        report = _format_report(result)
-        client = boto3.client("ssm")
-        client.put_parameter(
-            Name="/sdwan/verification-results",
-            Value=report,
-            Type="String",
-            Overwrite=True,
-        )
-    except Exception as e:
-        print(f"Failed to persist verification results to SSM: {e}")
+    write_report("verification-results", _format_report(result),
+                 _summarize_results(result, run_id), run_id)
+
+
+def _summarize_results(result, run_id):
+    """Build the compact JSON form of the verification results.
+
+    Args:
+        result: The full verification result dict
+        run_id: Pipeline run ID
+
+    Returns:
+        dict: run_id, counts, and per-router status and check results
+    """
+    routers = {}
+    for router_name, router_result in result.get("results", {}).items():
+        details = router_result.get("details", {})
+        routers[router_name] = {
+            "status": router_result.get("status", "Unknown"),
+            "ipsec": details.get("ipsec"),
+            "bgp": details.get("bgp"),
+            "interfaces": details.get("interfaces"),
+            "cloudwan_bgp": details.get("cloudwan_bgp"),
+            "ping": details.get("ping", {}),
+            "ping_stats": details.get("ping_stats", {}),
+            "bgp_neighbors": {
+                ip: n["state"] for ip, n in details.get("bgp_neighbors", {}).items()
+            },
+            "cloudwan_bgp_neighbors": {
+                ip: n["state"] for ip, n in details.get("cloudwan_bgp_neighbors", {}).items()
+            },
+            "ipsec_sas": {
+                name: sa["state"] for name, sa in details.get("ipsec_sas", {}).items()
+            },
+        }
+    summary = {
+        "run_id": run_id,
+        "success_count": result.get("success_count", 0),
+        "fail_count": result.get("fail_count", 0),
+        "routers": routers,
+    }
+    if result.get("selection"):
+        summary["selection"] = result["selection"]
+    return summary
+
+
 def _format_report(result):
     """Format verification results as a human-readable text report.
 
@@ -219,8 +372,13 @@ def _format_report(result):
             continue
 
         ping_parts = []
+        ping_stats = details.get("ping_stats", {})
         for ip, val in details.get("ping", {}).items():
-            ping_parts.append(f"Ping({ip})={icon(val)}")
+            part = f"Ping({ip})={icon(val)}"
+            stats = ping_stats.get(ip) or {}
+            if stats.get("rtt_avg") is not None:
+                part += f"[{stats['rtt_avg']:.1f}ms/{stats['loss_pct']:g}%]"
+            ping_parts.append(part)
 
         checks = (
             f"IPsec={icon(details.get('ipsec', 'fail'))}  "
@@ -236,13 +394,16 @@ def _format_report(result):
     lines.append(
         f"Result: {result.get('success_count', 0)}/{total} routers passed"
     )
+    if result.get("selection"):
+        lines.append(f"Partial run: {result['selection']['count']} selected routers only")
 
     return "\n".join(lines)
 
 
-
-
-
+@instrumented
+@tracing.traced("phase4")
+@metrics.emits_metrics("phase4")
+@profiled
 def handler(event, context):
     """Lambda handler for Phase 4 verification.
 
@@ -250,7 +411,9 @@ def handler(event, context):
     and ping tests on each router via SSM, and returns structured results.
 
     Args:
-        event: Lambda event (passed from Step Functions, may contain prior phase results)
+        event: Lambda event (passed from Step Functions, may contain prior phase results,
+               fail_fast to override FAIL_FAST, and router selectors
+               such as only_failed, see ssm_utils.select_routers)
         context: Lambda context object
 
     Returns:
@@ -259,56 +422,40 @@ def handler(event, context):
             - results: dict keyed by instance name with status and verification details
             - success_count: number of successful instances
             - fail_count: number of failed instances
+            - agents: SSM agent check reused by the next phase (see ssm_utils.agent_snapshot)
+            - aborted: fail-fast reason, if the phase stopped early (see ssm_utils.run_phase)
+            - selection: the router selectors and selected count, if the event had any
     """
     configs = get_instance_configs(param_prefix=SSM_PARAM_PREFIX)
+    seed_agents(event, configs)
+    run_id = get_run_id(event, context)
 
-    results = {}
-    success_count = 0
-    fail_count = 0
-
-    for router_name in ROUTERS:
-        if router_name not in configs:
-            results[router_name] = {
-                "status": "Failed",
-                "command_id": "",
-                "instance_id": "",
-                "stdout": "",
-                "stderr": f"Instance config not found for {router_name}",
-                "details": {},
-            }
-            fail_count += 1
-            continue
-
-        instance_id = configs[router_name]["instance_id"]
-        region = configs[router_name]["region"]
-
-        verify_cmd = build_verify_command(router_name, configs=configs)
-
-        result = send_and_wait(
-            instance_id=instance_id,
-            region=region,
-            commands=verify_cmd,
-            timeout=SSM_TIMEOUT,
-        )
-
+    def verify(router_name, result):
         # Parse verification output into structured details
-        details = parse_verify_output(result.get("stdout", ""), router_name)
-        result["details"] = details
-
-        results[router_name] = result
-
-        if result["status"] == "Success":
-            success_count += 1
+        if result["command_id"]:
+            result["details"] = parse_verify_output(
+                result.get("stdout", ""), router_name, configs=configs
+            )
+            record_ping_metrics(result["details"])
         else:
-            fail_count += 1
-
-    final_result = {
-        "phase": "phase4",
-        "results": results,
-        "success_count": success_count,
-        "fail_count": fail_count,
-    }
+            result["details"] = {}
+        output_store.offload(result, run_id, "phase4", router_name)
+
+    names, selection = select_routers(get_routers(configs), configs, event, "phase4")
+
+    phase = run_phase(
+        configs,
+        names,
+        build_command,
+        timeout=SSM_TIMEOUT,
+        fail_fast=event.get("fail_fast"),
+        on_result=verify,
+    )
+    final_result = {"phase": "phase4", **phase}
+    if selection:
+        final_result["selection"] = selection
 
-    persist_results_to_ssm(final_result)
+    # Persist the full results before they are bounded for the state
+    persist_results(final_result, run_id)
 
-    return final_result
+    return output_store.bound_results(final_result, run_id)
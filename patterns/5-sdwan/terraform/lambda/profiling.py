@@ -0,0 +1,129 @@
+"""
+Opt-in profiling of Lambda handler invocations.
+
+Wrap a handler with @profiled and set HANDLER_PROFILE on the function to
+profile its invocations without other code changes:
+
+- cpu: cProfile; logs the HANDLER_PROFILE_TOP functions with the highest
+  cumulative time and writes the full stats (<module>-<request id>.prof,
+  readable with pstats or snakeviz)
+- memory: tracemalloc; logs the peak traced size and the allocation sites
+  holding the most memory when the handler returns, and writes all sites
+  (<module>-<request id>.mem.txt)
+- all: both
+
+Files go to HANDLER_PROFILE_OUTPUT: a directory (default /tmp) or an
+s3://bucket/prefix the function can write to. The first invocation of a
+container is flagged as a cold start, with the time since this module was
+imported (module loading plus anything else the runtime did before the
+first invocation).
+"""
+
+import functools
+import os
+import time
+
+
+PROFILE = os.environ.get("HANDLER_PROFILE", "off").lower()
+PROFILE_TOP = int(os.environ.get("HANDLER_PROFILE_TOP", "25"))
+PROFILE_OUTPUT = os.environ.get("HANDLER_PROFILE_OUTPUT", "/tmp")
+
+# Stack frames kept per allocation by tracemalloc
+TRACEMALLOC_FRAMES = 10
+
+_LOADED_AT = time.time()
+_INVOCATIONS = {"count": 0}
+
+
+def _cpu_report(profile, top):
+    import io
+    import pstats
+
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats("cumulative").print_stats(top)
+    return out.getvalue()
+
+
+def _memory_report(snapshot, top=None):
+    stats = snapshot.statistics("lineno")
+    lines = [f"{s.size / 1024:10.1f} KiB {s.count:8d} blocks  {s.traceback}"
+             for s in stats[:top]]
+    return "\n".join(lines)
+
+
+def _write(name, data):
+    """Write a profile file to PROFILE_OUTPUT and return where it went."""
+    if PROFILE_OUTPUT.startswith("s3://"):
+        from ssm_utils import get_client
+
+        bucket, _, prefix = PROFILE_OUTPUT[len("s3://"):].partition("/")
+        key = f"{prefix.strip('/')}/{name}".lstrip("/")
+        get_client("s3").put_object(Bucket=bucket, Key=key, Body=data)
+        return f"s3://{bucket}/{key}"
+    os.makedirs(PROFILE_OUTPUT, exist_ok=True)
+    path = os.path.join(PROFILE_OUTPUT, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def profiled(handler):
+    """Decorator for Lambda handlers: profile invocations when HANDLER_PROFILE is set."""
+    module = handler.__module__
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        cpu = PROFILE in ("cpu", "all")
+        memory = PROFILE in ("memory", "all")
+        if not cpu and not memory:
+            return handler(event, context)
+
+        # Imported only when profiling, to keep them out of normal cold starts
+        import cProfile
+        import marshal
+        import tracemalloc
+
+        _INVOCATIONS["count"] += 1
+        cold = _INVOCATIONS["count"] == 1
+        request_id = getattr(context, "aws_request_id", None) or f"{int(time.time())}"
+        profile = cProfile.Profile() if cpu else None
+        # Leave tracemalloc alone if someone else (e.g. the benchmarks) started it
+        own_tracemalloc = memory and not tracemalloc.is_tracing()
+        if own_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            if profile:
+                profile.enable()
+            return handler(event, context)
+        finally:
+            if profile:
+                profile.disable()
+            elapsed = time.perf_counter() - start
+            snapshot = peak = None
+            if memory:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                if own_tracemalloc:
+                    tracemalloc.stop()
+
+            print(f"Profile of {module}.handler: {elapsed:.3f}s"
+                  + (f", cold start ({started_at - _LOADED_AT:.3f}s after module load)" if cold else "")
+                  + (f", peak traced memory {peak / 1024:.1f} KiB" if memory else ""))
+            try:
+                if profile:
+                    print(_cpu_report(profile, PROFILE_TOP))
+                    # Same format as Profile.dump_stats(), without a local file
+                    profile.create_stats()
+                    where = _write(f"{module}-{request_id}.prof", marshal.dumps(profile.stats))
+                    print(f"CPU profile written to {where}")
+                if snapshot:
+                    print(f"Top allocation sites:\n{_memory_report(snapshot, PROFILE_TOP)}")
+                    where = _write(f"{module}-{request_id}.mem.txt",
+                                   _memory_report(snapshot).encode("utf-8"))
+                    print(f"Memory profile written to {where}")
+            except Exception as e:
+                print(f"Failed to write profile of {module}.handler: {e}")
+    return wrapper
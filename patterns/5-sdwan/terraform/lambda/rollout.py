@@ -0,0 +1,277 @@
+"""
+Wave rollout of a phase's configuration, with a health gate between waves.
+
+By default Phase 2 and Phase 3 configure all their routers at once
+(ssm_utils.run_phase()), so a bad change reaches every router before
+anyone looks at the result. With a rollout, they push
+to a canary wave of ROLLOUT_CANARY routers first, then to waves growing
+ROLLOUT_GROWTH times, up to ROLLOUT_MAX_WAVE routers. The commands of a
+wave run concurrently (ssm_utils.run_commands()).
+
+After each wave, the health gate runs the convergence check (the Phase 4
+verification command without pings) on the wave and on the wave before
+it. The wave must reach the state expected after the phase within
+ROLLOUT_GATE_TIMEOUT, and the previous wave, which passed its own gate,
+must still pass. The rollout halts when a command of the wave fails or the
+gate fails. Routers not started yet are then Cancelled with the reason.
+
+Routers joined by a tunnel are kept in the same wave, since a tunnel only
+comes up once both ends are configured.
+
+The rollout is selected with ROLLOUT (or rollout in the event):
+
+- off (default): all routers at once
+- on: waves with the defaults above
+- canary=2,growth=4,max_wave=50,gate_timeout=600: waves with other settings
+"""
+
+import os
+import time
+
+import tracing
+from ssm_utils import (
+    FAIL_FAST,
+    agent_snapshot,
+    cancelled_result,
+    fail_fast_reason,
+    parse_fail_fast,
+    run_commands,
+    run_phase,
+)
+
+
+ROLLOUT = os.environ.get("ROLLOUT", "off")
+ROLLOUT_CANARY = int(os.environ.get("ROLLOUT_CANARY", "1"))
+ROLLOUT_GROWTH = int(os.environ.get("ROLLOUT_GROWTH", "2"))
+ROLLOUT_MAX_WAVE = int(os.environ.get("ROLLOUT_MAX_WAVE", "100"))
+ROLLOUT_GATE_TIMEOUT = int(os.environ.get("ROLLOUT_GATE_TIMEOUT", "300"))
+
+
+def parse_rollout(spec):
+    """Parse a rollout setting.
+
+    Args:
+        spec: off, on, a dict or "key=value,..." string with canary, growth,
+              max_wave and gate_timeout, or a bool
+
+    Returns:
+        dict: canary, growth, max_wave and gate_timeout, or None for off
+
+    Raises:
+        ValueError: If spec has unknown keys or values that are not positive integers
+    """
+    if isinstance(spec, bool):
+        spec = "on" if spec else "off"
+    if isinstance(spec, str):
+        text = spec.strip().lower()
+        if text in ("", "off", "none", "false", "0"):
+            return None
+        spec = {} if text in ("on", "true", "1") else dict(
+            item.split("=", 1) if "=" in item else (item, "")
+            for item in text.replace(" ", "").split(",")
+        )
+
+    settings = {
+        "canary": ROLLOUT_CANARY,
+        "growth": ROLLOUT_GROWTH,
+        "max_wave": ROLLOUT_MAX_WAVE,
+        "gate_timeout": ROLLOUT_GATE_TIMEOUT,
+    }
+    for key, value in dict(spec or {}).items():
+        if key not in settings:
+            raise ValueError(f"Unknown rollout setting: {key}. Expected one of: {list(settings)}")
+        try:
+            settings[key] = int(value)
+        except (TypeError, ValueError):
+            settings[key] = 0
+        if settings[key] < 1:
+            raise ValueError(f"Rollout setting {key} must be a positive integer, got {value!r}")
+    return settings
+
+
+def peer_groups(names):
+    """Group routers joined by a tunnel (phase4_handler.TUNNELS), in dispatch order.
+
+    Only tunnels between two of the given routers count, so Phase 3's SDWAN
+    routers each form a group of their own.
+
+    Returns:
+        list of list: Router names; each router is in exactly one group
+    """
+    from phase4_handler import TUNNELS
+
+    names = list(names)
+    group_of = {n: [n] for n in names}
+    for tunnel in TUNNELS:
+        a = group_of.get(tunnel["router_a"])
+        b = group_of.get(tunnel["router_b"])
+        if a is None or b is None or a is b:
+            continue
+        a.extend(b)
+        for n in b:
+            group_of[n] = a
+
+    order = {n: i for i, n in enumerate(names)}
+    groups = []
+    seen = set()
+    for name in names:
+        group = group_of[name]
+        if id(group) not in seen:
+            seen.add(id(group))
+            groups.append(sorted(group, key=order.get))
+    return groups
+
+
+def plan_waves(names, canary=1, growth=2, max_wave=100):
+    """Split routers into waves of growing size.
+
+    The first wave has canary routers, each next wave growth times as many,
+    capped at max_wave. Groups from peer_groups() are not split, so a wave
+    can be larger than planned.
+
+    Returns:
+        list of list: Router names per wave
+    """
+    waves = []
+    wave = []
+    size = canary
+    for group in peer_groups(names):
+        wave.extend(group)
+        if len(wave) >= size:
+            waves.append(wave)
+            wave = []
+            size = min(size * growth, max_wave)
+    if wave:
+        waves.append(wave)
+    return waves
+
+
+def health_gate(after_phase, configs, routers, timeout):
+    """Run the convergence check on routers.
+
+    Returns:
+        str: Why the gate failed, or None if every router converged
+    """
+    from convergence_handler import ConvergenceError, wait_for_convergence
+
+    try:
+        wait_for_convergence(after_phase, configs, routers=routers, timeout=timeout)
+    except ConvergenceError as e:
+        return str(e)
+    return None
+
+
+def run_rollout(configs, names, build_command, after_phase, spec=None, timeout=600,
+                fail_fast=None, on_result=None):
+    """Run a phase's command as a wave rollout (see the module docstring).
+
+    Falls back to ssm_utils.run_phase() when the rollout is off. Routers
+    that got no command fail without halting the rollout, but count against
+    the fail-fast policy: those without an instance config, and those whose
+    SSM agent run_commands() finds offline. Unlike run_phase(), offline
+    routers are not held back and re-checked (see ssm_utils.reachable_waves()).
+
+    Args:
+        configs: Instance configs from get_instance_configs()
+        names: Router names in dispatch order
+        build_command: Callable(router_name, configs) returning the commands
+        after_phase: Phase whose expected state the health gate checks
+        spec: Rollout setting (default: ROLLOUT, see parse_rollout())
+        timeout: SSM timeout per command (default: 600)
+        fail_fast: Fail-fast policy (default: FAIL_FAST)
+        on_result: Callable(router_name, result) called with every result
+
+    Returns:
+        dict: Like run_phase(), plus waves: size, failed and gate
+        ("passed", "failed" or "skipped") and gate_seconds per wave run
+    """
+    settings = parse_rollout(ROLLOUT if spec is None else spec)
+    if not settings:
+        return run_phase(configs, names, build_command, timeout=timeout,
+                         fail_fast=fail_fast, on_result=on_result)
+
+    policy = parse_fail_fast(FAIL_FAST if fail_fast is None else fail_fast)
+    names = list(names)
+    waves = plan_waves(names, settings["canary"], settings["growth"], settings["max_wave"])
+    print(f"Rolling out {after_phase} to {len(names)} routers in {len(waves)} waves: "
+          + ", ".join(str(len(w)) for w in waves))
+
+    results = {}
+    summary = []
+    previous = []
+    aborted = None
+
+    for index, wave in enumerate(waves, 1):
+        with tracing.span("rollout.wave", wave=index, size=len(wave)):
+            for name in wave:
+                if name not in configs:
+                    results[name] = {
+                        "status": "Failed",
+                        "command_id": "",
+                        "instance_id": "",
+                        "stdout": "",
+                        "stderr": f"Instance config not found for {name}",
+                    }
+            targets = {
+                name: {
+                    "instance_id": configs[name]["instance_id"],
+                    "region": configs[name]["region"],
+                    "commands": build_command(name, configs),
+                }
+                for name in wave if name in configs
+            }
+            results.update(run_commands(targets, timeout=timeout))
+            for name in wave:
+                if on_result:
+                    on_result(name, results[name])
+
+            failed = [n for n in wave if results[n]["status"] != "Success"]
+            applied = [n for n in wave if results[n]["status"] == "Success"]
+            entry = {"size": len(wave), "failed": len(failed), "gate": "skipped"}
+            summary.append(entry)
+
+            # A failed command halts; routers that got no command do not
+            broken = [n for n in failed if results[n]["command_id"]]
+            if broken:
+                aborted = (f"rollout halted after wave {index}: "
+                           f"{len(broken)} commands failed ({', '.join(broken[:5])})")
+            elif previous or applied:
+                start = time.time()
+                with tracing.span("rollout.gate", wave=index, routers=len(previous) + len(applied)):
+                    gate = health_gate(after_phase, configs, previous + applied,
+                                       settings["gate_timeout"])
+                entry["gate"] = "failed" if gate else "passed"
+                entry["gate_seconds"] = round(time.time() - start, 1)
+                if gate:
+                    aborted = f"rollout halted after wave {index}: health gate failed: {gate}"
+            previous = applied
+
+            total_failed = sum(1 for r in results.values() if r["status"] != "Success")
+            aborted = aborted or fail_fast_reason(policy, total_failed, len(names))
+        print(f"Wave {index}/{len(waves)}: {len(wave)} routers, {len(failed)} failed, "
+              f"health gate {entry['gate']}")
+        if aborted:
+            print(f"Stopping rollout: {aborted}")
+            break
+
+    if aborted:
+        for name in names:
+            if name not in results:
+                result = cancelled_result(configs.get(name, {}).get("instance_id", ""), aborted)
+                if on_result:
+                    on_result(name, result)
+                results[name] = result
+
+    success_count = sum(1 for r in results.values() if r["status"] == "Success")
+    phase = {
+        "results": results,
+        "success_count": success_count,
+        "fail_count": len(results) - success_count,
+        "agents": agent_snapshot(
+            [configs[n]["instance_id"] for n in names if n in configs]
+        ),
+        "waves": summary,
+    }
+    if aborted:
+        phase["aborted"] = aborted
+    return phase
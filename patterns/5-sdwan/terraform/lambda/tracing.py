@@ -0,0 +1,293 @@
+"""
+Tracing spans for the phase pipeline.
+
+Every handler opens a span for its phase, with child spans per router, per
+SSM command and per poll iteration. The trace ID is taken from
+event["run"]["trace_id"] (the state machine sets it to the execution name),
+so the spans written by all phase Lambdas of one execution form one trace;
+phase spans share a root span ID derived from the trace ID.
+
+Tracing is off unless TRACE_EXPORT is set (default: off). Spans are kept in
+memory and exported as JSON lines when the handler returns:
+
+- stdout: one JSON object per line in the function's log
+- s3://bucket/prefix: one object per invocation at
+  <prefix>/<trace_id>/<phase>-<span_id>.jsonl
+- anything else: a local file path the lines are appended to
+
+To look at a trace, collect the lines and convert them for Perfetto
+(https://ui.perfetto.dev) or chrome://tracing, or print a text summary:
+
+    python tracing.py chrome spans.jsonl > trace.json
+    python tracing.py summary spans.jsonl
+"""
+
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "off")
+ENABLED = TRACE_EXPORT.lower() not in ("", "off", "false", "0")
+
+# Span the code is currently running in; copied into worker threads explicitly
+_CURRENT = contextvars.ContextVar("sdwan_trace_span", default=None)
+
+_STATE = {"trace_id": None, "root_id": None, "spans": []}
+_LOCK = threading.Lock()
+
+
+def _new_id():
+    return os.urandom(8).hex()
+
+
+def root_span_id(trace_id):
+    """Return the span ID all phase spans of a trace hang off."""
+    return hashlib.sha256(trace_id.encode("utf-8")).hexdigest()[:16]
+
+
+def start_trace(event, context=None):
+    """Start collecting spans for the trace the event belongs to.
+
+    Returns:
+        str: The trace ID (event run.trace_id, else the run ID, else random)
+    """
+    event = event or {}
+    run = event.get("run") or {}
+    trace_id = (run.get("trace_id") or run.get("run_id") or event.get("run_id")
+                or getattr(context, "aws_request_id", None) or os.urandom(16).hex())
+    with _LOCK:
+        _STATE.update(trace_id=trace_id, root_id=root_span_id(trace_id), spans=[])
+    return trace_id
+
+
+def start_span(name, parent=None, **attributes):
+    """Open a span without making it current (for overlapping work).
+
+    Returns:
+        dict: The span, or None when no trace is active
+    """
+    if not _STATE["trace_id"]:
+        return None
+    parent = parent or _CURRENT.get()
+    return {
+        "trace_id": _STATE["trace_id"],
+        "span_id": _new_id(),
+        "parent_id": parent["span_id"] if parent else _STATE["root_id"],
+        "name": name,
+        "start": time.time(),
+        "thread": threading.current_thread().name,
+        "attributes": attributes,
+    }
+
+
+def end_span(span, status="ok", **attributes):
+    """Close a span from start_span() and queue it for export."""
+    if span is None:
+        return
+    span["end"] = time.time()
+    span["duration_ms"] = round((span["end"] - span["start"]) * 1000, 3)
+    span["status"] = status
+    span["attributes"].update(attributes)
+    with _LOCK:
+        _STATE["spans"].append(span)
+
+
+def set_attributes(span, **attributes):
+    """Add attributes to a span (no-op when tracing is off)."""
+    if span is not None:
+        span["attributes"].update(attributes)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Run a block in a child span of the current span.
+
+    Yields the span dict (None when tracing is off). An exception marks the
+    span as an error and is re-raised.
+    """
+    current = start_span(name, **attributes)
+    if current is None:
+        yield None
+        return
+    token = _CURRENT.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        end_span(current, status="error", error=f"{type(e).__name__}: {e}")
+        raise
+    else:
+        end_span(current)
+    finally:
+        _CURRENT.reset(token)
+
+
+def flush():
+    """Return the finished spans and stop the trace."""
+    with _LOCK:
+        spans = _STATE["spans"]
+        _STATE.update(trace_id=None, root_id=None, spans=[])
+    return spans
+
+
+def export(spans, target=None, name="spans"):
+    """Write spans as JSON lines to stdout, S3 or a file (see module docstring).
+
+    Errors are logged, never raised: tracing must not fail a phase.
+    """
+    target = target or TRACE_EXPORT
+    if not spans:
+        return
+    lines = "\n".join(json.dumps(s, separators=(",", ":"), default=str) for s in spans) + "\n"
+    try:
+        if target == "stdout":
+            sys.stdout.write(lines)
+        elif target.startswith("s3://"):
+            from ssm_utils import get_client
+
+            bucket, _, prefix = target[len("s3://"):].partition("/")
+            key = f"{prefix.strip('/')}/{spans[0]['trace_id']}/{name}-{spans[-1]['span_id']}.jsonl"
+            get_client("s3").put_object(
+                Bucket=bucket, Key=key.lstrip("/"), Body=lines.encode("utf-8"),
+                ContentType="application/x-ndjson",
+            )
+        else:
+            with open(target, "a") as f:
+                f.write(lines)
+    except Exception as e:
+        print(f"Failed to export {len(spans)} trace spans to {target}: {e}")
+
+
+def traced(name):
+    """Decorator for Lambda handlers: trace the invocation as span `name`.
+
+    Does nothing unless tracing is enabled (TRACE_EXPORT). Counts from dict
+    results (success_count, fail_count) are added to the span.
+    """
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not ENABLED:
+                return handler(event, context)
+            start_trace(event, context)
+            try:
+                with span(name, request_id=getattr(context, "aws_request_id", None)) as s:
+                    result = handler(event, context)
+                    if isinstance(result, dict):
+                        set_attributes(s, **{k: result[k] for k in ("success_count", "fail_count")
+                                             if k in result})
+                return result
+            finally:
+                export(flush(), name=name)
+        return wrapper
+    return decorate
+
+
+# -- offline tools -----------------------------------------------------
+
+def load_spans(paths):
+    """Read spans from JSON lines files, skipping lines that are not spans."""
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line.startswith("{"):
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "span_id" in record and "trace_id" in record:
+                    spans.append(record)
+    return spans
+
+
+def to_chrome_trace(spans):
+    """Convert spans to the Chrome trace event format (Perfetto, chrome://tracing).
+
+    Each phase becomes a process and each router (or thread) a track.
+    """
+    by_id = {s["span_id"]: s for s in spans}
+
+    def phase_of(s):
+        while s["parent_id"] in by_id:
+            s = by_id[s["parent_id"]]
+        return s["name"]
+
+    def track_of(s):
+        # Nearest router/target attribute on the span or its ancestors
+        while s is not None:
+            attrs = s.get("attributes", {})
+            if attrs.get("router") or attrs.get("target"):
+                return attrs.get("router") or attrs.get("target")
+            s = by_id.get(s["parent_id"])
+        return None
+
+    events = []
+    for s in sorted(spans, key=lambda s: s["start"]):
+        attrs = s.get("attributes", {})
+        events.append({
+            "name": s["name"],
+            "cat": s.get("status", "ok"),
+            "ph": "X",
+            "ts": int(s["start"] * 1_000_000),
+            "dur": int(s.get("duration_ms", 0) * 1000),
+            "pid": phase_of(s),
+            "tid": track_of(s) or s.get("thread", "main"),
+            "args": dict(attrs, span_id=s["span_id"], parent_id=s["parent_id"]),
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def summarize(spans, top=10):
+    """Return a text summary: wall-clock per phase and the longest spans."""
+    lines = []
+    for trace_id in sorted({s["trace_id"] for s in spans}):
+        trace = [s for s in spans if s["trace_id"] == trace_id]
+        root = root_span_id(trace_id)
+        phases = sorted((s for s in trace if s["parent_id"] == root), key=lambda s: s["start"])
+        start = min(s["start"] for s in trace)
+        end = max(s["end"] for s in trace)
+        lines.append(f"Trace {trace_id}: {len(trace)} spans, {end - start:.1f}s")
+        for p in phases:
+            lines.append(f"  {p['name']:<20} +{p['start'] - start:>8.1f}s  "
+                         f"{p['duration_ms'] / 1000:>8.1f}s  {p.get('status', 'ok')}")
+        totals = {}
+        for s in trace:
+            totals[s["name"]] = totals.get(s["name"], 0) + s["duration_ms"] / 1000
+        lines.append("  Time by span name: " + ", ".join(
+            f"{name} {seconds:.1f}s" for name, seconds in sorted(totals.items(), key=lambda x: -x[1])
+        ))
+        lines.append("  Longest spans:")
+        for s in sorted(trace, key=lambda s: -s["duration_ms"])[:top]:
+            attrs = s.get("attributes", {})
+            where = attrs.get("router") or attrs.get("target") or attrs.get("instance_id") or ""
+            lines.append(f"    {s['duration_ms'] / 1000:>8.1f}s  {s['name']} {where}".rstrip())
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert or summarize exported trace spans.")
+    parser.add_argument("command", choices=("chrome", "summary"))
+    parser.add_argument("files", nargs="+", help="JSON lines files (exported spans or logs)")
+    args = parser.parse_args(argv)
+
+    spans = load_spans(args.files)
+    if args.command == "chrome":
+        json.dump(to_chrome_trace(spans), sys.stdout)
+    else:
+        print(summarize(spans))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,377 @@
+"""
+Parsers for VyOS/FRR verification output.
+
+Turns the output of `show ip bgp summary`, `show ip bgp neighbors <ip>`,
+`show vpn ipsec sa`, ping summaries and iperf3 reports into per-neighbor,
+per-SA and per-target dicts. The BGP parsers accept either FRR JSON (vtysh
+`... json`) or the plain-text op-mode output. Every parser makes a single
+pass over its input so large fleets with thousands of neighbors parse in
+linear time.
+"""
+
+import json
+import re
+
+
+# Marker lines emitted by phase4_handler.build_verify_command()
+SECTION_RE = re.compile(r"^--- (.+?) ---$")
+
+# Size suffixes used by `show vpn ipsec sa` (e.g. 1.2K, 552B, 3M)
+_SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def split_sections(stdout):
+    """Split verification stdout into sections keyed by their marker title.
+
+    Lines between `--- <title> ---` markers are collected under that title.
+    Lines before the first marker are ignored. Ping's own
+    `--- <ip> ping statistics ---` line is kept as body text.
+
+    Args:
+        stdout: Raw stdout from the verification SSM command
+
+    Returns:
+        dict: Section title -> section body (str)
+    """
+    sections = {}
+    current = None
+    buf = []
+    for line in stdout.splitlines():
+        m = SECTION_RE.match(line.strip())
+        if m and not m.group(1).endswith(" ping statistics"):
+            if current is not None:
+                sections[current] = "\n".join(buf)
+            current = m.group(1)
+            buf = []
+        elif current is not None:
+            buf.append(line)
+    if current is not None:
+        sections[current] = "\n".join(buf)
+    return sections
+
+
+def _load_json(text):
+    """Return the decoded JSON object in text, or None if it is not JSON."""
+    stripped = text.strip()
+    if not stripped.startswith("{"):
+        return None
+    try:
+        return json.loads(stripped)
+    except ValueError:
+        return None
+
+
+def _to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_size(value):
+    """Convert a VyOS size string like 1.2K or 552B into a byte count."""
+    m = re.match(r"^([\d.]+)\s*([BKMGT]?)i?B?$", value.strip(), re.IGNORECASE)
+    if not m:
+        return 0
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2).upper()])
+
+
+def parse_bgp_summary(text):
+    """Parse `show ip bgp summary` output (JSON or text).
+
+    Args:
+        text: Output of `vtysh -c 'show ip bgp summary json'` or the op-mode
+              `show ip bgp summary` table
+
+    Returns:
+        dict: Keyed by neighbor IP, each value contains:
+            - remote_as (int)
+            - state (str): BGP FSM state, "Established" when up
+            - uptime (str): Up/Down column (e.g. 00:25:13, never)
+            - prefixes_received (int): 0 unless Established
+    """
+    data = _load_json(text)
+    if data is not None:
+        return _parse_bgp_summary_json(data)
+
+    neighbors = {}
+    in_table = False
+    for line in text.splitlines():
+        if not in_table:
+            if line.startswith("Neighbor"):
+                in_table = True
+            continue
+        fields = line.split()
+        if not fields or fields[0].startswith("Total"):
+            in_table = False
+            continue
+        # Neighbor V AS MsgRcvd MsgSent TblVer InQ OutQ Up/Down State/PfxRcd [Desc]
+        if len(fields) < 10:
+            continue
+        state_or_pfx = fields[9]
+        if state_or_pfx.isdigit():
+            state = "Established"
+            prefixes = int(state_or_pfx)
+        else:
+            # Strip admin/policy suffixes such as "Idle (Admin)" or "(Policy)"
+            state = state_or_pfx.split("(")[0] or "Idle"
+            prefixes = 0
+        neighbors[fields[0]] = {
+            "remote_as": _to_int(fields[2]),
+            "state": state,
+            "uptime": fields[8],
+            "prefixes_received": prefixes,
+        }
+    return neighbors
+
+
+def _parse_bgp_summary_json(data):
+    # FRR nests peers under the address family; older releases put them at top level
+    peers = {}
+    for af in ("ipv4Unicast", "ipv4"):
+        if isinstance(data.get(af), dict):
+            peers = data[af].get("peers", {})
+            break
+    else:
+        peers = data.get("peers", {})
+
+    neighbors = {}
+    for ip, peer in peers.items():
+        neighbors[ip] = {
+            "remote_as": _to_int(peer.get("remoteAs")),
+            "state": peer.get("state", "Idle"),
+            "uptime": peer.get("peerUptime", "never"),
+            "prefixes_received": _to_int(
+                peer.get("pfxRcd", peer.get("prefixReceivedCount", 0))
+            ),
+        }
+    return neighbors
+
+
+def parse_bgp_neighbors(text):
+    """Parse `show ip bgp neighbors [<ip>]` output (JSON or text).
+
+    Args:
+        text: Output of `vtysh -c 'show ip bgp neighbors <ip> json'` or the
+              op-mode text output; may cover one or many neighbors
+
+    Returns:
+        dict: Keyed by neighbor IP, each value contains:
+            - remote_as (int)
+            - state (str)
+            - uptime (str): time since the session came up, "" if down
+            - prefixes_accepted (int)
+    """
+    data = _load_json(text)
+    if data is not None:
+        return _parse_bgp_neighbors_json(data)
+
+    neighbors = {}
+    current = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("BGP neighbor is "):
+            m = re.match(r"BGP neighbor is ([^,\s]+),\s+remote AS (\d+)", line)
+            if not m:
+                current = None
+                continue
+            current = {
+                "remote_as": int(m.group(2)),
+                "state": "Idle",
+                "uptime": "",
+                "prefixes_accepted": 0,
+            }
+            neighbors[m.group(1)] = current
+        elif current is None:
+            continue
+        elif line.startswith("BGP state = "):
+            m = re.match(r"BGP state = (\w+)(?:, up for (\S+))?", line)
+            if m:
+                current["state"] = m.group(1)
+                current["uptime"] = m.group(2) or ""
+        elif line.endswith("accepted prefixes"):
+            current["prefixes_accepted"] += _to_int(line.split()[0])
+    return neighbors
+
+
+def _parse_bgp_neighbors_json(data):
+    neighbors = {}
+    for ip, peer in data.items():
+        if not isinstance(peer, dict):
+            continue
+        accepted = 0
+        for af in peer.get("addressFamilyInfo", {}).values():
+            accepted += _to_int(af.get("acceptedPrefixCounter", 0))
+        state = peer.get("bgpState", "Idle")
+        neighbors[ip] = {
+            "remote_as": _to_int(peer.get("remoteAs")),
+            "state": state,
+            "uptime": peer.get("bgpTimerUpString", "") if state == "Established" else "",
+            "prefixes_accepted": accepted,
+        }
+    return neighbors
+
+
+def parse_ipsec_sa(text):
+    """Parse the `show vpn ipsec sa` table.
+
+    SAs that are down or still connecting show N/A in the counter columns;
+    they are kept with zero counters so ipsec_status() can see them.
+
+    Args:
+        text: Op-mode output with Connection/State/Uptime/Bytes/Packets columns
+
+    Returns:
+        dict: Keyed by connection name, each value contains:
+            - state (str): "up", "down", "connecting", ...
+            - uptime (str): "N/A" if not up
+            - bytes_in, bytes_out, packets_in, packets_out (int): 0 if N/A
+            - remote_address (str): "N/A" if not reported
+    """
+    sas = {}
+    in_table = False
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if not in_table:
+            in_table = fields[0] == "Connection"
+            continue
+        if set(fields[0]) <= {"-"}:
+            continue
+        # Connection State Uptime Bytes-In/Out Packets-In/Out Remote-address [Remote-ID] [Proposal]
+        if len(fields) < 2:
+            continue
+        fields += ["N/A"] * (6 - len(fields))
+        bytes_in, _, bytes_out = fields[3].partition("/")
+        packets_in, _, packets_out = fields[4].partition("/")
+        sas[fields[0]] = {
+            "state": fields[1].lower(),
+            "uptime": fields[2],
+            "bytes_in": parse_size(bytes_in),
+            "bytes_out": parse_size(bytes_out),
+            "packets_in": _to_int(packets_in),
+            "packets_out": _to_int(packets_out),
+            "remote_address": fields[5],
+        }
+    return sas
+
+
+def bgp_status(neighbors, expected=None):
+    """Summarize parsed BGP neighbors as "ok" or "fail".
+
+    Args:
+        neighbors: Dict from parse_bgp_summary() or parse_bgp_neighbors()
+        expected: Optional iterable of neighbor IPs to check. When given, only
+                  these neighbors are considered and each must be present.
+
+    Returns:
+        str: "ok" if at least one neighbor is checked and every checked
+             neighbor is Established; otherwise "fail"
+    """
+    if expected is not None:
+        expected = list(expected)
+        if any(ip not in neighbors for ip in expected):
+            return "fail"
+        checked = [neighbors[ip] for ip in expected]
+    else:
+        checked = list(neighbors.values())
+    if not checked or any(n["state"] != "Established" for n in checked):
+        return "fail"
+    return "ok"
+
+
+def ipsec_status(sas, expected_count=1):
+    """Summarize parsed IPsec SAs as "ok" or "fail".
+
+    Args:
+        sas: Dict from parse_ipsec_sa()
+        expected_count: Minimum number of SAs that must be up
+
+    Returns:
+        str: "ok" if no SA is down and at least expected_count are up
+    """
+    up = sum(1 for sa in sas.values() if sa["state"] == "up")
+    if up < max(expected_count, 1) or up != len(sas):
+        return "fail"
+    return "ok"
+
+
+def parse_ping(text):
+    """Parse the summary of a (quiet) ping run.
+
+    Understands iputils output ("rtt min/avg/max/mdev = ...") and the busybox
+    variant ("round-trip min/avg/max = ..."), which has no mdev.
+
+    Args:
+        text: Output of `ping -q -c N <target>`
+
+    Returns:
+        dict: transmitted, received (int), loss_pct (float), and rtt_min,
+              rtt_avg, rtt_max, jitter in ms (float, None if unavailable)
+    """
+    stats = {
+        "transmitted": 0,
+        "received": 0,
+        "loss_pct": 100.0,
+        "rtt_min": None,
+        "rtt_avg": None,
+        "rtt_max": None,
+        "jitter": None,
+    }
+    for line in text.splitlines():
+        m = re.match(r"\s*(\d+) packets transmitted, (\d+) (?:packets )?received", line)
+        if m:
+            stats["transmitted"] = int(m.group(1))
+            stats["received"] = int(m.group(2))
+            loss = re.search(r"([\d.]+)% packet loss", line)
+            if loss:
+                stats["loss_pct"] = float(loss.group(1))
+            continue
+        m = re.match(r"\s*(?:rtt|round-trip) min/avg/max(/mdev)? = ([\d./]+)", line)
+        if m:
+            values = [float(v) for v in m.group(2).split("/")]
+            stats["rtt_min"], stats["rtt_avg"], stats["rtt_max"] = values[:3]
+            # mdev is the mean deviation of RTT, used as jitter
+            if m.group(1) and len(values) > 3:
+                stats["jitter"] = values[3]
+    return stats
+
+
+def parse_iperf3(text):
+    """Parse the JSON report of an iperf3 client run (`iperf3 -c ... -J`).
+
+    Args:
+        text: iperf3 JSON output for a TCP or UDP test
+
+    Returns:
+        dict: For TCP: protocol, gbps_sent, gbps_received, retransmits.
+              For UDP: protocol, gbps, pps, loss_pct, jitter_ms.
+              Contains only an error key if the run failed or is not JSON.
+    """
+    data = _load_json(text)
+    if data is None:
+        return {"error": text.strip()[-200:] or "no output"}
+    if data.get("error"):
+        return {"error": data["error"]}
+
+    end = data.get("end", {})
+    protocol = data.get("start", {}).get("test_start", {}).get("protocol", "TCP")
+    if protocol == "UDP":
+        total = end.get("sum", {})
+        seconds = total.get("seconds") or 0
+        return {
+            "protocol": "UDP",
+            "gbps": round(total.get("bits_per_second", 0) / 1e9, 3),
+            "pps": round(total.get("packets", 0) / seconds) if seconds else 0,
+            "loss_pct": total.get("lost_percent", 0.0),
+            "jitter_ms": total.get("jitter_ms", 0.0),
+        }
+    sent = end.get("sum_sent", {})
+    received = end.get("sum_received", {})
+    return {
+        "protocol": "TCP",
+        "gbps_sent": round(sent.get("bits_per_second", 0) / 1e9, 3),
+        "gbps_received": round(received.get("bits_per_second", 0) / 1e9, 3),
+        "retransmits": sent.get("retransmits", 0),
+    }
@@ -11,6 +11,12 @@ locals {
   # VPN Pre-Shared Key - use provided value or generated one
   vpn_psk = coalesce(var.vpn_psk, try(random_password.vpn_psk[0].result, null))
 
+  # TRACE_EXPORT of the phase Lambdas (see lambda/tracing.py)
+  trace_export = var.trace_export == "s3" ? "s3://${var.report_s3_bucket}/traces" : var.trace_export
+
+  # OUTPUT_STORE of the phase Lambdas (see lambda/output_store.py)
+  output_store = var.report_s3_bucket == "" ? "none" : "s3"
+
   # Common tags applied to all resources
   common_tags = {
     Project     = var.project_name
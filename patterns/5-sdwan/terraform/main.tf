@@ -2,7 +2,7 @@
 # Terraform Configuration
 
 terraform {
-  required_version = ">= 1.0"
+  required_version = ">= 1.9"
 
   required_providers {
     aws = {
@@ -1,7 +1,7 @@
 # =============================================================================
 # SD-WAN Orchestration - Lambda Functions and Step Functions
 # Deploys Phase1-4 Lambda functions and the Step Functions state machine
-# Orchestrates: Phase1 → Wait → Phase2 → Wait → Phase3 → Wait → Phase4
+# Orchestrates: Phase1 → Converge → Phase2 → Converge → Phase3 → Converge → Phase4
 # =============================================================================
 
 # -----------------------------------------------------------------------------
@@ -56,7 +56,7 @@ resource "aws_iam_role_policy" "sdwan_lambda_policy" {
 
   policy = jsonencode({
     Version = "2012-10-17"
-    Statement = [
+    Statement = concat([
       {
         Sid    = "SSMSendCommand"
         Effect = "Allow"
@@ -75,9 +75,16 @@ resource "aws_iam_role_policy" "sdwan_lambda_policy" {
         Action = [
           "ssm:GetCommandInvocation",
           "ssm:DescribeInstanceInformation",
+          "ssm:CancelCommand",
         ]
         Resource = "*"
       },
+      {
+        Sid      = "EC2DescribeInstances"
+        Effect   = "Allow"
+        Action   = "ec2:DescribeInstances"
+        Resource = "*"
+      },
       {
         Sid      = "SSMGetParameter"
         Effect   = "Allow"
@@ -109,7 +116,18 @@ resource "aws_iam_role_policy" "sdwan_lambda_policy" {
         ]
         Resource = "arn:aws:logs:*:${data.aws_caller_identity.current.account_id}:*"
       },
-    ]
+      ], var.report_s3_bucket == "" ? [] : [
+      {
+        # GetObject: output_store reads stored results back (only_failed)
+        Sid    = "ReportS3ReadWrite"
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject",
+        ]
+        Resource = "arn:aws:s3:::${var.report_s3_bucket}/*"
+      },
+    ])
   })
 }
 
@@ -132,6 +150,10 @@ resource "aws_lambda_function" "sdwan_phase1" {
   environment {
     variables = {
       SSM_PARAM_PREFIX = "/sdwan/"
+      TRACE_EXPORT     = local.trace_export
+      OUTPUT_STORE     = local.output_store
+      OUTPUT_S3_BUCKET = var.report_s3_bucket
+      FAIL_FAST        = var.fail_fast
     }
   }
 
@@ -156,6 +178,11 @@ resource "aws_lambda_function" "sdwan_phase2" {
   environment {
     variables = {
       SSM_PARAM_PREFIX = "/sdwan/"
+      TRACE_EXPORT     = local.trace_export
+      OUTPUT_STORE     = local.output_store
+      OUTPUT_S3_BUCKET = var.report_s3_bucket
+      FAIL_FAST        = var.fail_fast
+      ROLLOUT          = var.rollout
     }
   }
 
@@ -180,6 +207,11 @@ resource "aws_lambda_function" "sdwan_phase3" {
   environment {
     variables = {
       SSM_PARAM_PREFIX = "/sdwan/"
+      TRACE_EXPORT     = local.trace_export
+      OUTPUT_STORE     = local.output_store
+      OUTPUT_S3_BUCKET = var.report_s3_bucket
+      FAIL_FAST        = var.fail_fast
+      ROLLOUT          = var.rollout
     }
   }
 
@@ -204,6 +236,11 @@ resource "aws_lambda_function" "sdwan_phase4" {
   environment {
     variables = {
       SSM_PARAM_PREFIX = "/sdwan/"
+      TRACE_EXPORT     = local.trace_export
+      OUTPUT_STORE     = local.output_store
+      OUTPUT_S3_BUCKET = var.report_s3_bucket
+      REPORT_SINK      = var.report_sink
+      REPORT_S3_BUCKET = var.report_s3_bucket
     }
   }
 
@@ -213,6 +250,61 @@ resource "aws_lambda_function" "sdwan_phase4" {
   }
 }
 
+resource "aws_lambda_function" "sdwan_convergence" {
+  provider         = aws.virginia
+  function_name    = "sdwan-convergence"
+  description      = "SD-WAN convergence check - waits for IPsec/BGP to settle between phases"
+  role             = aws_iam_role.sdwan_lambda_execution_role.arn
+  handler          = "convergence_handler.handler"
+  runtime          = "python3.12"
+  timeout          = 900
+  memory_size      = 256
+  filename         = data.archive_file.lambda_package.output_path
+  source_code_hash = data.archive_file.lambda_package.output_base64sha256
+
+  environment {
+    variables = {
+      SSM_PARAM_PREFIX    = "/sdwan/"
+      TRACE_EXPORT        = local.trace_export
+      CONVERGENCE_TIMEOUT = tostring(var.convergence_timeout_seconds)
+    }
+  }
+
+  tags = {
+    Name  = "sdwan-convergence"
+    Phase = "convergence"
+  }
+}
+
+resource "aws_lambda_function" "sdwan_benchmark" {
+  provider         = aws.virginia
+  function_name    = "sdwan-benchmark"
+  description      = "SD-WAN optional benchmark - iperf3 throughput over tunnels and Cloud WAN"
+  role             = aws_iam_role.sdwan_lambda_execution_role.arn
+  handler          = "benchmark_handler.handler"
+  runtime          = "python3.12"
+  timeout          = 900
+  memory_size      = 256
+  filename         = data.archive_file.lambda_package.output_path
+  source_code_hash = data.archive_file.lambda_package.output_base64sha256
+
+  environment {
+    variables = {
+      SSM_PARAM_PREFIX = "/sdwan/"
+      TRACE_EXPORT     = local.trace_export
+      OUTPUT_STORE     = local.output_store
+      OUTPUT_S3_BUCKET = var.report_s3_bucket
+      REPORT_SINK      = var.report_sink
+      REPORT_S3_BUCKET = var.report_s3_bucket
+    }
+  }
+
+  tags = {
+    Name  = "sdwan-benchmark"
+    Phase = "5-benchmark"
+  }
+}
+
 # -----------------------------------------------------------------------------
 # IAM Role for Step Functions Execution
 # -----------------------------------------------------------------------------
@@ -256,6 +348,8 @@ resource "aws_iam_role_policy" "sdwan_stepfunctions_policy" {
           aws_lambda_function.sdwan_phase2.arn,
           aws_lambda_function.sdwan_phase3.arn,
           aws_lambda_function.sdwan_phase4.arn,
+          aws_lambda_function.sdwan_convergence.arn,
+          aws_lambda_function.sdwan_benchmark.arn,
         ]
       },
       {
@@ -302,8 +396,18 @@ resource "aws_sfn_state_machine" "sdwan_orchestration" {
 
   definition = jsonencode({
     Comment = "SD-WAN Configuration Orchestration"
-    StartAt = "Phase1_BaseSetup"
+    StartAt = "Init_Run"
     States = {
+      Init_Run = {
+        Type = "Pass"
+        Parameters = {
+          "run_id.$"   = "$$.Execution.Name"
+          "trace_id.$" = "$$.Execution.Name"
+        }
+        ResultPath = "$.run"
+        Next       = "Phase1_BaseSetup"
+      }
+
       Phase1_BaseSetup = {
         Type     = "Task"
         Resource = aws_lambda_function.sdwan_phase1.arn
@@ -323,13 +427,39 @@ resource "aws_sfn_state_machine" "sdwan_orchestration" {
           }
         ]
         ResultPath = "$.phase1_result"
-        Next       = "Wait_After_Phase1"
+        Next       = "Converge_After_Phase1"
       }
 
-      Wait_After_Phase1 = {
-        Type    = "Wait"
-        Seconds = var.phase1_wait_seconds
-        Next    = "Phase2_VpnBgpConfig"
+      Converge_After_Phase1 = {
+        Type     = "Task"
+        Resource = aws_lambda_function.sdwan_convergence.arn
+        Parameters = {
+          after_phase      = "phase1"
+          "run.$"          = "$.run"
+          "phase_result.$" = "$.phase1_result"
+        }
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 30
+            MaxAttempts     = 2
+            BackoffRate     = 2.0
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["ConvergenceError"]
+            Next        = "Phase4_Verify"
+            ResultPath  = "$.run.convergence_error"
+          },
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "FailureState"
+            ResultPath  = "$.error"
+          },
+        ]
+        ResultPath = "$.phase1_convergence"
+        Next       = "Phase2_VpnBgpConfig"
       }
 
       Phase2_VpnBgpConfig = {
@@ -351,13 +481,39 @@ resource "aws_sfn_state_machine" "sdwan_orchestration" {
           }
         ]
         ResultPath = "$.phase2_result"
-        Next       = "Wait_After_Phase2"
+        Next       = "Converge_After_Phase2"
       }
 
-      Wait_After_Phase2 = {
-        Type    = "Wait"
-        Seconds = var.phase2_wait_seconds
-        Next    = "Phase3_CloudWanBgp"
+      Converge_After_Phase2 = {
+        Type     = "Task"
+        Resource = aws_lambda_function.sdwan_convergence.arn
+        Parameters = {
+          after_phase      = "phase2"
+          "run.$"          = "$.run"
+          "phase_result.$" = "$.phase2_result"
+        }
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 30
+            MaxAttempts     = 2
+            BackoffRate     = 2.0
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["ConvergenceError"]
+            Next        = "Phase4_Verify"
+            ResultPath  = "$.run.convergence_error"
+          },
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "FailureState"
+            ResultPath  = "$.error"
+          },
+        ]
+        ResultPath = "$.phase2_convergence"
+        Next       = "Phase3_CloudWanBgp"
       }
 
       Phase3_CloudWanBgp = {
@@ -379,13 +535,39 @@ resource "aws_sfn_state_machine" "sdwan_orchestration" {
           }
         ]
         ResultPath = "$.phase3_result"
-        Next       = "Wait_After_Phase3"
+        Next       = "Converge_After_Phase3"
       }
 
-      Wait_After_Phase3 = {
-        Type    = "Wait"
-        Seconds = 30
-        Next    = "Phase4_Verify"
+      Converge_After_Phase3 = {
+        Type     = "Task"
+        Resource = aws_lambda_function.sdwan_convergence.arn
+        Parameters = {
+          after_phase      = "phase3"
+          "run.$"          = "$.run"
+          "phase_result.$" = "$.phase3_result"
+        }
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 30
+            MaxAttempts     = 2
+            BackoffRate     = 2.0
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["ConvergenceError"]
+            Next        = "Phase4_Verify"
+            ResultPath  = "$.run.convergence_error"
+          },
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "FailureState"
+            ResultPath  = "$.error"
+          },
+        ]
+        ResultPath = "$.phase3_convergence"
+        Next       = "Phase4_Verify"
       }
 
       Phase4_Verify = {
@@ -407,6 +589,54 @@ resource "aws_sfn_state_machine" "sdwan_orchestration" {
           }
         ]
         ResultPath = "$.phase4_result"
+        Next       = "Convergence_Reached"
+      }
+
+      Convergence_Reached = {
+        Type = "Choice"
+        Choices = [
+          {
+            Variable  = "$.run.convergence_error"
+            IsPresent = true
+            Next      = "ConvergenceFailureState"
+          }
+        ]
+        Default = "Benchmark_Requested"
+      }
+
+      Benchmark_Requested = {
+        Type = "Choice"
+        Choices = [
+          {
+            And = [
+              { Variable = "$.run_benchmark", IsPresent = true },
+              { Variable = "$.run_benchmark", BooleanEquals = true },
+            ]
+            Next = "Phase5_Benchmark"
+          }
+        ]
+        Default = "SuccessState"
+      }
+
+      Phase5_Benchmark = {
+        Type     = "Task"
+        Resource = aws_lambda_function.sdwan_benchmark.arn
+        Retry = [
+          {
+            ErrorEquals     = ["Lambda.ServiceException", "Lambda.AWSLambdaException", "Lambda.SdkClientException"]
+            IntervalSeconds = 30
+            MaxAttempts     = 2
+            BackoffRate     = 2.0
+          }
+        ]
+        Catch = [
+          {
+            ErrorEquals = ["States.ALL"]
+            Next        = "FailureState"
+            ResultPath  = "$.error"
+          }
+        ]
+        ResultPath = "$.benchmark_result"
         Next       = "SuccessState"
       }
 
@@ -419,6 +649,12 @@ resource "aws_sfn_state_machine" "sdwan_orchestration" {
         Cause = "Phase execution failed"
         Error = "PhaseExecutionError"
       }
+
+      ConvergenceFailureState = {
+        Type  = "Fail"
+        Cause = "Routers did not converge; see phase4_result for the verification report"
+        Error = "ConvergenceError"
+      }
     }
   })
 
@@ -203,3 +203,13 @@ output "start_orchestration_command" {
   description = "CLI command to start the SD-WAN orchestration state machine"
   value       = "aws stepfunctions start-execution --state-machine-arn ${aws_sfn_state_machine.sdwan_orchestration.arn} --region us-east-1"
 }
+
+output "deprecated_variables" {
+  description = "Deprecated variables that are set but no longer have any effect"
+  value = [
+    for name, value in {
+      phase1_wait_seconds = var.phase1_wait_seconds
+      phase2_wait_seconds = var.phase2_wait_seconds
+    } : "${name} is deprecated and ignored; use convergence_timeout_seconds" if value != null
+  ]
+}
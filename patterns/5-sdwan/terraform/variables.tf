@@ -137,16 +137,77 @@ variable "lambda_source_dir" {
   default     = "lambda"
 }
 
+variable "convergence_timeout_seconds" {
+  description = "Max time to wait for IPsec/BGP to converge after each phase (seconds)"
+  type        = number
+  default     = 600
+}
+
 variable "phase1_wait_seconds" {
-  description = "Wait time after Phase1 before starting Phase2 (seconds)"
+  description = "Deprecated and ignored: the state machine now runs a convergence check after each phase (see convergence_timeout_seconds)"
   type        = number
-  default     = 60
+  default     = null
 }
 
 variable "phase2_wait_seconds" {
-  description = "Wait time after Phase2 before starting Phase3 (seconds)"
+  description = "Deprecated and ignored: the state machine now runs a convergence check after each phase (see convergence_timeout_seconds)"
   type        = number
-  default     = 90
+  default     = null
+}
+
+variable "report_sink" {
+  description = "Where verification/benchmark reports are written: ssm, ssm-sharded or s3"
+  type        = string
+  default     = "ssm"
+
+  validation {
+    condition     = contains(["ssm", "ssm-sharded", "s3"], var.report_sink)
+    error_message = "report_sink must be one of ssm, ssm-sharded, s3."
+  }
+}
+
+variable "report_s3_bucket" {
+  description = "S3 bucket for reports when report_sink is s3, trace spans and full command output"
+  type        = string
+  default     = ""
+}
+
+variable "trace_export" {
+  description = "Where the phase Lambdas export trace spans: off, stdout or s3 (traces/ in report_s3_bucket)"
+  type        = string
+  default     = "off"
+
+  validation {
+    condition     = contains(["off", "stdout", "s3"], var.trace_export)
+    error_message = "trace_export must be one of off, stdout, s3."
+  }
+
+  validation {
+    condition     = var.trace_export != "s3" || var.report_s3_bucket != ""
+    error_message = "trace_export s3 needs report_s3_bucket."
+  }
+}
+
+variable "fail_fast" {
+  description = "Stop Phases 1-3 early after failures: off, first, a count (3) or a percentage of routers (10%)"
+  type        = string
+  default     = "off"
+
+  validation {
+    condition     = can(regex("^(off|first|[0-9]+|[0-9]+(\\.[0-9]+)?%)$", var.fail_fast))
+    error_message = "fail_fast must be off, first, a count or a percentage."
+  }
+}
+
+variable "rollout" {
+  description = "Configure Phases 2-3 in health-gated waves: off, on, or settings such as canary=2,growth=4"
+  type        = string
+  default     = "off"
+
+  validation {
+    condition     = can(regex("^(off|on|(canary|growth|max_wave|gate_timeout)=[0-9]+(,(canary|growth|max_wave|gate_timeout)=[0-9]+)*)$", var.rollout))
+    error_message = "rollout must be off, on, or comma-separated canary/growth/max_wave/gate_timeout=N settings."
+  }
 }
 
 # Cloud WAN Variables
@@ -0,0 +1,1213 @@
+"""
+In-memory fakes of the AWS APIs used by the Lambda handlers, for offline runs.
+
+FakeCloudFormation simulates stack operations that take a configurable
+amount of (virtual) time and can be made to fail; FakeS3 serves templates;
+FakeLambda records asynchronous self-invocations. FakeSSM runs RunShellScript
+commands with configurable runtimes, failure rates and output, reports SSM
+agent status (agents can be taken offline) and serves Parameter Store;
+FakeEC2 lists the simulated instances. Every fake can add
+per-call latency and throttle calls like the real service, retrying the way
+botocore does. FakeClock replaces the time module so multi-hour operations
+run instantly.
+
+use() points ssm_utils and the handlers at a FakeAws, so any handler can run
+against a simulated fleet of 4 to several thousand routers:
+
+    aws = FakeAws(ssm_options={"runtime": runtime_profile()})
+    aws.add_fleet(500)
+    with use(aws):
+        results = ssm_utils.run_commands(targets)
+
+run_custom_resource() drives cross_region_stack.handler through all of its
+re-invocations and returns the response that would be sent to CloudFormation:
+
+    python tests/fake_aws.py
+    python tests/fake_aws.py fleet 5000
+
+The fakes live outside the Lambda source directory so they are not part of
+the deployment package; importing this module puts cloudformation/lambda on
+sys.path.
+"""
+
+import contextlib
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+
+from botocore.exceptions import ClientError
+
+LAMBDA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "cloudformation", "lambda"))
+if LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, LAMBDA_DIR)
+
+import instrumentation  # noqa: E402
+import ssm_utils  # noqa: E402
+
+
+def _client_error(operation, message, code="ValidationError"):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class _Exceptions:
+    ClientError = ClientError
+
+
+class InvocationDoesNotExist(ClientError):
+    """Modeled SSM error raised for unknown or not yet visible invocations."""
+
+
+class ParameterAlreadyExists(ClientError):
+    """Modeled SSM error raised by put_parameter without Overwrite."""
+
+
+class _SsmExceptions(_Exceptions):
+    InvocationDoesNotExist = InvocationDoesNotExist
+    ParameterAlreadyExists = ParameterAlreadyExists
+
+
+class _FakeService:
+    """Call recording, latency and throttling shared by the fakes.
+
+    Args:
+        clock: FakeClock shared with the code under test
+        latency: Seconds added to every call
+        rate_limits: Calls per second allowed per API (snake_case name); a
+                     call over the limit is retried with backoff and raises
+                     ThrottlingException once max_attempts are used up
+        max_attempts: Attempts per call, as botocore's standard retry mode
+        seed: Seed for the random choices of this fake
+    """
+
+    exceptions = _Exceptions
+    service = None
+
+    def __init__(self, clock, latency=0.0, rate_limits=None, max_attempts=3, seed=0):
+        self.clock = clock
+        self.latency = latency
+        self.rate_limits = dict(rate_limits or {})
+        self.max_attempts = max_attempts
+        self.rng = random.Random(seed)
+        self.calls = []
+        self.throttled = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _admit(self, name):
+        """Take a token from the API's bucket; False if the call is throttled."""
+        rate = self.rate_limits.get(name)
+        if not rate:
+            return True
+        with self._lock:
+            now = self.clock.time()
+            tokens, last = self._buckets.get(name, (rate, now))
+            tokens = min(rate, tokens + (now - last) * rate)
+            if tokens < 1:
+                self._buckets[name] = (tokens, now)
+                return False
+            self._buckets[name] = (tokens - 1, now)
+            return True
+
+    def _api(self, name, *args):
+        """Record a call and apply throttling and latency to it."""
+        self.calls.append((name,) + args)
+        self.clock.touch()
+        operation = "".join(word.title() for word in name.split("_"))
+        start = self.clock.time()
+        attempt = 1
+        while not self._admit(name):
+            self.throttled += 1
+            instrumentation.record(self.service, operation, throttled=1)
+            if attempt >= self.max_attempts:
+                instrumentation.record(self.service, operation,
+                                       (self.clock.time() - start) * 1000,
+                                       retries=attempt - 1, error="ThrottlingException")
+                raise _client_error(name, "Rate exceeded", "ThrottlingException")
+            # Full-jitter exponential backoff, capped like botocore
+            self.clock.sleep(self.rng.random() * min(20, 2 ** attempt))
+            attempt += 1
+        if self.latency:
+            self.clock.sleep(self.latency)
+        instrumentation.record(self.service, operation, (self.clock.time() - start) * 1000,
+                               retries=attempt - 1)
+
+    def api_counts(self):
+        """Return the number of calls per API."""
+        counts = {}
+        for call in list(self.calls):
+            counts[call[0]] = counts.get(call[0], 0) + 1
+        return counts
+
+    def get_paginator(self, operation):
+        method = getattr(self, operation)
+
+        class _Paginator:
+            def paginate(self, **kwargs):
+                token = None
+                while True:
+                    page = method(NextToken=token, **kwargs) if token else method(**kwargs)
+                    yield page
+                    token = page.get("NextToken")
+                    if not token:
+                        return
+
+        return _Paginator()
+
+
+class FakeClock:
+    """Virtual clock with the time()/sleep()/monotonic() subset of the time module.
+
+    By default sleep() just moves the clock forward, which is only correct
+    when one thread uses it. With threads=True, sleep() blocks until every
+    other thread is sleeping too (no clock activity for `quiet` real
+    seconds) and then jumps to the earliest wake-up, so work spread over a
+    thread pool overlaps in virtual time the way it would in real time.
+
+    Args:
+        start: Initial epoch seconds
+        threads: Coordinate sleeps across threads
+        quiet: Real seconds without activity after which all threads are
+               assumed to be asleep (threads=True only)
+    """
+
+    def __init__(self, start=1_700_000_000.0, threads=False, quiet=0.02):
+        self.now = start
+        self.threads = threads
+        self.quiet = quiet
+        self._cond = threading.Condition()
+        self._wakeups = []
+        self._activity = 0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def touch(self):
+        """Record activity so sleeping threads do not advance the clock yet."""
+        if self.threads:
+            with self._cond:
+                self._activity += 1
+
+    def sleep(self, seconds):
+        if not self.threads:
+            self.now += seconds
+            return
+        with self._cond:
+            wake = self.now + seconds
+            self._wakeups.append(wake)
+            self._activity += 1
+            self._cond.notify_all()
+            while self.now < wake:
+                seen = self._activity
+                if self._cond.wait(self.quiet) or seen != self._activity:
+                    continue
+                # Nothing else is running: jump to the next wake-up
+                self.now = max(self.now, min(self._wakeups))
+                self._activity += 1
+                self._cond.notify_all()
+            self._wakeups.remove(wake)
+
+    def __getattr__(self, name):
+        # strftime, gmtime, ... fall through to the real time module
+        import time
+        return getattr(time, name)
+
+
+class FakeContext:
+    """Lambda context whose remaining time follows a FakeClock."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, clock, timeout=900,
+                 function_arn="arn:aws:lambda:us-east-1:123456789012:function:fake"):
+        self.clock = clock
+        self.deadline = clock.time() + timeout
+        self.invoked_function_arn = function_arn
+        self.aws_request_id = f"fake-request-{next(self._ids)}"
+        self.log_stream_name = f"fake/[$LATEST]{self.aws_request_id}"
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - self.clock.time()) * 1000))
+
+
+class FakeCloudFormation(_FakeService):
+    """CloudFormation stacks whose operations complete after a virtual delay.
+
+    Args:
+        clock: FakeClock shared with the code under test
+        region: Region of this endpoint
+        durations: Seconds per operation, keyed by CREATE/UPDATE/DELETE/ROLLBACK
+        failures: Resource failure to inject per operation, keyed by
+                  CREATE/UPDATE/DELETE. Each value is (logical_id, reason) or
+                  a dict with logical_id, reason, optional at (seconds into
+                  the operation, default its full duration) and optional
+                  nested (logical ID of a nested stack the resource lives in)
+        outputs: Outputs to return for created stacks
+        changes: ResourceChange dicts reported by change sets that contain
+                 changes (default: one in-place Modify)
+        s3: FakeS3 that TemplateURL arguments are read from
+        **options: latency, rate_limits, max_attempts and seed (see _FakeService)
+    """
+
+    service = "cloudformation"
+
+    def __init__(self, clock, region="eu-central-1", durations=None, failures=None,
+                 outputs=None, changes=None, s3=None, **options):
+        super().__init__(clock, **options)
+        self.s3 = s3
+        self.region = region
+        self.durations = {
+            "CREATE": 600, "UPDATE": 300, "DELETE": 300, "ROLLBACK": 120, "CHANGE_SET": 5,
+            **(durations or {}),
+        }
+        self.failures = {
+            op: f if isinstance(f, dict) else {"logical_id": f[0], "reason": f[1]}
+            for op, f in (failures or {}).items()
+        }
+        self.outputs = dict(outputs or {})
+        self.changes = list(changes or [{
+            "Action": "Modify",
+            "LogicalResourceId": "SdwanInstance",
+            "ResourceType": "AWS::EC2::Instance",
+            "Replacement": "False",
+        }])
+        self.stacks = {}
+        self.change_sets = {}
+        self._event_ids = itertools.count(1)
+
+    # -- helpers -------------------------------------------------------
+
+    def _find(self, name_or_id, operation):
+        stack = self.stacks.get(name_or_id)
+        if stack is None:
+            live = [s for s in self.stacks.values()
+                    if s["StackName"] == name_or_id and s["StackStatus"] != "DELETE_COMPLETE"]
+            stack = live[-1] if live else None
+        if stack is None:
+            raise _client_error(operation, f"Stack with id {name_or_id} does not exist")
+        # Nested stack events are produced by the parent's timeline
+        self._advance(self.stacks.get(stack.get("ParentId"), stack))
+        self._advance(stack)
+        return stack
+
+    def _template(self, operation, kwargs):
+        """Return the template body of a call, enforcing the TemplateBody limit."""
+        if kwargs.get("TemplateURL"):
+            bucket, _, key = kwargs["TemplateURL"].split("://", 1)[1].partition("/")
+            return self.s3.objects[(bucket.split(".s3.")[0], key)].decode("utf-8")
+        body = kwargs.get("TemplateBody")
+        if body and len(body.encode("utf-8")) > 51200:
+            raise _client_error(operation, "1 validation error detected: Value at "
+                                "'templateBody' failed to satisfy constraint: Member must "
+                                "have length less than or equal to 51200")
+        return body
+
+    def _new_stack(self, name, **kwargs):
+        stack_id = (f"arn:aws:cloudformation:{self.region}:123456789012:"
+                    f"stack/{name}/{len(self.stacks) + 1:08d}")
+        stack = {
+            "StackId": stack_id,
+            "StackName": name,
+            "Parameters": kwargs.get("Parameters", []),
+            "Tags": kwargs.get("Tags", []),
+            "TemplateBody": kwargs.get("TemplateBody"),
+            "Outputs": [],
+            "CreationTime": self.clock.time(),
+            "_events": [],
+        }
+        self.stacks[stack_id] = stack
+        return stack
+
+    def _event(self, stack, status, reason="", logical_id=None, physical_id=None,
+               resource_type="AWS::EC2::VPC"):
+        if logical_id is None:
+            logical_id, physical_id = stack["StackName"], stack["StackId"]
+            resource_type = "AWS::CloudFormation::Stack"
+        stack["_events"].insert(0, {
+            "EventId": f"{stack['StackName']}-{next(self._event_ids)}",
+            "StackId": stack["StackId"],
+            "StackName": stack["StackName"],
+            "LogicalResourceId": logical_id,
+            "PhysicalResourceId": physical_id or "",
+            "ResourceType": resource_type,
+            "ResourceStatus": status,
+            "ResourceStatusReason": reason,
+            "Timestamp": self.clock.time(),
+        })
+
+    def _begin(self, stack, operation, status=None):
+        stack["StackStatus"] = status or f"{operation}_IN_PROGRESS"
+        stack["_operation"] = operation
+        stack["_started_at"] = self.clock.time()
+        stack["_done_at"] = self.clock.time() + self.durations[operation]
+        stack["_failed"] = False
+        if operation in ("UPDATE", "ROLLBACK"):
+            stack["LastUpdatedTime"] = self.clock.time()
+        self._event(stack, stack["StackStatus"])
+
+        failure = self.failures.get(operation)
+        if failure and failure.get("nested") and operation in ("CREATE", "UPDATE"):
+            child = stack.get("_nested", {}).get(failure["nested"])
+            if child is None:
+                child = self._new_stack(f"{stack['StackName']}-{failure['nested']}-FAKE")
+                child["ParentId"] = stack["StackId"]
+                stack.setdefault("_nested", {})[failure["nested"]] = child
+            self._event(stack, f"{operation}_IN_PROGRESS", logical_id=failure["nested"],
+                        physical_id=child["StackId"],
+                        resource_type="AWS::CloudFormation::Stack")
+            self._event(child, f"{operation}_IN_PROGRESS")
+
+    def _advance(self, stack):
+        operation = stack.get("_operation")
+        if not operation:
+            return
+        now = self.clock.time()
+
+        failure = self.failures.get(operation)
+        if failure and not stack["_failed"] and \
+                now >= stack["_started_at"] + failure.get("at", self.durations[operation]):
+            stack["_failed"] = True
+            child = stack.get("_nested", {}).get(failure.get("nested"))
+            target = child or stack
+            self._event(target, f"{operation}_FAILED", failure["reason"],
+                        logical_id=failure["logical_id"])
+            if child is not None:
+                self._event(child, f"{operation}_FAILED", "Resource failed")
+                self._event(stack, f"{operation}_FAILED",
+                            f"Embedded stack {child['StackId']} was not successfully created",
+                            logical_id=failure["nested"], physical_id=child["StackId"],
+                            resource_type="AWS::CloudFormation::Stack")
+
+        if now < stack["_done_at"]:
+            return
+        stack["_operation"] = None
+        if operation == "ROLLBACK":
+            final = "UPDATE_ROLLBACK_COMPLETE"
+        elif stack["_failed"]:
+            final = {
+                "CREATE": "CREATE_FAILED",
+                "UPDATE": "UPDATE_ROLLBACK_COMPLETE",
+                "DELETE": "DELETE_FAILED",
+            }[operation]
+        else:
+            final = f"{operation}_COMPLETE"
+            if operation != "DELETE":
+                stack["Outputs"] = [
+                    {"OutputKey": k, "OutputValue": v} for k, v in self.outputs.items()
+                ]
+        stack["StackStatus"] = final
+        self._event(stack, final)
+
+    # -- API -----------------------------------------------------------
+
+    def create_stack(self, StackName, **kwargs):
+        self._api("create_stack", StackName)
+        if any(s["StackName"] == StackName and s["StackStatus"] != "DELETE_COMPLETE"
+               for s in self.stacks.values()):
+            raise _client_error("CreateStack", f"Stack [{StackName}] already exists",
+                                "AlreadyExistsException")
+        kwargs["TemplateBody"] = self._template("CreateStack", kwargs)
+        stack = self._new_stack(StackName, **kwargs)
+        self._begin(stack, "CREATE")
+        return {"StackId": stack["StackId"]}
+
+    def update_stack(self, StackName, **kwargs):
+        self._api("update_stack", StackName)
+        stack = self._find(StackName, "UpdateStack")
+        if stack["StackStatus"].endswith("_IN_PROGRESS"):
+            raise _client_error("UpdateStack", f"Stack {StackName} is in "
+                                f"{stack['StackStatus']} state and can not be updated.")
+        kwargs["TemplateBody"] = self._template("UpdateStack", kwargs)
+        unchanged = all(
+            kwargs.get(k) == stack[k] for k in ("TemplateBody", "Parameters", "Tags")
+        )
+        if unchanged:
+            raise _client_error("UpdateStack", "No updates are to be performed.")
+        stack.update({k: kwargs.get(k) for k in ("TemplateBody", "Parameters", "Tags")})
+        self._begin(stack, "UPDATE")
+        return {"StackId": stack["StackId"]}
+
+    def create_change_set(self, StackName, ChangeSetName, ChangeSetType="UPDATE", **kwargs):
+        self._api("create_change_set", StackName)
+        stack = self._find(StackName, "CreateChangeSet")
+        if stack["StackStatus"].endswith("_IN_PROGRESS"):
+            raise _client_error("CreateChangeSet", f"Stack {StackName} is in "
+                                f"{stack['StackStatus']} state and can not be updated.")
+        change_set_id = f"{stack['StackId']}:changeSet/{ChangeSetName}/{len(self.change_sets) + 1}"
+        kwargs["TemplateBody"] = self._template("CreateChangeSet", kwargs)
+        unchanged = all(
+            kwargs.get(k) == stack[k] for k in ("TemplateBody", "Parameters", "Tags")
+        )
+        self.change_sets[change_set_id] = {
+            "stack": stack,
+            "ready_at": self.clock.time() + self.durations["CHANGE_SET"],
+            "unchanged": unchanged,
+            "update": {k: kwargs.get(k) for k in ("TemplateBody", "Parameters", "Tags")},
+        }
+        return {"Id": change_set_id, "StackId": stack["StackId"]}
+
+    def describe_change_set(self, ChangeSetName, NextToken=None, **kwargs):
+        self._api("describe_change_set", ChangeSetName)
+        change_set = self.change_sets.get(ChangeSetName)
+        if change_set is None:
+            raise _client_error("DescribeChangeSet", f"ChangeSet [{ChangeSetName}] does not exist",
+                                "ChangeSetNotFound")
+        desc = {"ChangeSetId": ChangeSetName, "StackId": change_set["stack"]["StackId"],
+                "Changes": []}
+        if self.clock.time() < change_set["ready_at"]:
+            desc["Status"] = "CREATE_IN_PROGRESS"
+        elif change_set["unchanged"]:
+            desc["Status"] = "FAILED"
+            desc["StatusReason"] = ("The submitted information didn't contain changes. "
+                                    "Submit different information to create a change set.")
+        else:
+            desc["Status"] = "CREATE_COMPLETE"
+            desc["Changes"] = [{"Type": "Resource", "ResourceChange": dict(c)}
+                               for c in self.changes]
+        return desc
+
+    def execute_change_set(self, ChangeSetName, **kwargs):
+        self._api("execute_change_set", ChangeSetName)
+        change_set = self.change_sets.pop(ChangeSetName)
+        stack = change_set["stack"]
+        self._advance(stack)
+        stack.update(change_set["update"])
+        self._begin(stack, "UPDATE")
+        return {}
+
+    def delete_change_set(self, ChangeSetName, **kwargs):
+        self._api("delete_change_set", ChangeSetName)
+        self.change_sets.pop(ChangeSetName, None)
+        return {}
+
+    def cancel_update_stack(self, StackName, **kwargs):
+        self._api("cancel_update_stack", StackName)
+        stack = self._find(StackName, "CancelUpdateStack")
+        if stack["StackStatus"] != "UPDATE_IN_PROGRESS":
+            raise _client_error("CancelUpdateStack", "CancelUpdateStack cannot be called "
+                                f"from current stack status {stack['StackStatus']}")
+        self._begin(stack, "ROLLBACK", status="UPDATE_ROLLBACK_IN_PROGRESS")
+        return {}
+
+    def delete_stack(self, StackName, **kwargs):
+        self._api("delete_stack", StackName)
+        try:
+            stack = self._find(StackName, "DeleteStack")
+        except ClientError:
+            return {}
+        if stack["StackStatus"] not in ("DELETE_IN_PROGRESS", "DELETE_COMPLETE"):
+            self._begin(stack, "DELETE")
+        return {}
+
+    def describe_stacks(self, StackName):
+        self._api("describe_stacks", StackName)
+        stack = self._find(StackName, "DescribeStacks")
+        public = {k: v for k, v in stack.items() if not k.startswith("_")}
+        return {"Stacks": [json.loads(json.dumps(public))]}
+
+    def get_template(self, StackName, TemplateStage="Original"):
+        self._api("get_template", StackName)
+        return {"TemplateBody": self._find(StackName, "GetTemplate")["TemplateBody"]}
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        self._api("describe_stack_events", StackName)
+        events = self._find(StackName, "DescribeStackEvents")["_events"]
+        start = int(NextToken or 0)
+        page = {"StackEvents": [dict(e) for e in events[start:start + 100]]}
+        if start + 100 < len(events):
+            page["NextToken"] = str(start + 100)
+        return page
+
+
+class FakeS3(_FakeService):
+    """S3 objects held in memory, keyed by (bucket, key).
+
+    Args:
+        clock: FakeClock shared with the code under test (default: a new one)
+        objects: Initial objects, bytes keyed by (bucket, key)
+        **options: latency, rate_limits, max_attempts and seed (see _FakeService)
+    """
+
+    service = "s3"
+
+    def __init__(self, clock=None, objects=None, **options):
+        super().__init__(clock or FakeClock(), **options)
+        self.objects = dict(objects or {})
+        self.buckets = {bucket for bucket, _ in self.objects}
+
+    def head_bucket(self, Bucket):
+        self._api("head_bucket", Bucket)
+        if Bucket not in self.buckets:
+            raise _client_error("HeadBucket", "Not Found", "404")
+        return {}
+
+    def create_bucket(self, Bucket, **kwargs):
+        self._api("create_bucket", Bucket)
+        self.buckets.add(Bucket)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        self._api("head_object", Bucket, Key)
+        if (Bucket, Key) not in self.objects:
+            raise _client_error("HeadObject", "Not Found", "404")
+        return {"ETag": self._etag(Bucket, Key)}
+
+    def _etag(self, Bucket, Key):
+        return '"%s"' % hashlib.md5(self.objects[(Bucket, Key)]).hexdigest()
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self._api("get_object", Bucket, Key)
+        if (Bucket, Key) not in self.objects:
+            raise _client_error("GetObject", "The specified key does not exist.", "NoSuchKey")
+        etag = self._etag(Bucket, Key)
+        if IfNoneMatch == etag:
+            raise _client_error("GetObject", "Not Modified", "304")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)]), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._api("put_object", Bucket, Key)
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        self.buckets.add(Bucket)
+        return {}
+
+
+# Runtime ranges (seconds) of the phase scripts on a t3.medium, matched by a
+# marker in the command text; see runtime_profile()
+PHASE_RUNTIMES = (
+    ("apt-get install", (240, 420)),        # Phase 1: packages, LXD, VyOS image
+    ("vyos-vpn.sh", (20, 45)),              # Phase 2: IPsec/BGP commit
+    ("vyos-cloudwan-bgp.sh", (10, 25)),     # Phase 3: Cloud WAN BGP commit
+    ("=== Verifying", (4, 12)),             # Phase 4 / convergence checks
+)
+
+# Output limits of GetCommandInvocation and ListCommandInvocations
+INVOCATION_OUTPUT_LIMIT = 24000
+LIST_OUTPUT_LIMIT = 2500
+
+# Parameter Store value limits per tier
+PARAMETER_LIMITS = {"Standard": 4096, "Advanced": 8192, "Intelligent-Tiering": 8192}
+
+
+def runtime_profile(profile=PHASE_RUNTIMES, default=(1, 5)):
+    """Return a FakeSSM runtime callable that replays a timing profile.
+
+    Args:
+        profile: (marker, (low, high)) pairs; the first marker found in the
+                 command text picks the range a runtime is drawn from
+        default: Range for commands that match no marker
+
+    Returns:
+        Callable(instance_id, commands, rng) -> seconds
+    """
+    def runtime(instance_id, commands, rng):
+        text = "\n".join(commands)
+        for marker, (low, high) in profile:
+            if marker in text:
+                return rng.uniform(low, high)
+        return rng.uniform(*default)
+    return runtime
+
+
+class FakeSSM(_FakeService):
+    """SSM Run Command and Parameter Store for simulated instances.
+
+    Commands go Pending for `delivery` seconds, InProgress for their runtime,
+    then Success, Failed or TimedOut (or Cancelled by cancel_command).
+    Outputs are truncated to the limits of the real APIs.
+
+    Args:
+        clock: FakeClock shared with the code under test
+        region: Region of this endpoint
+        runtime: Command runtime in seconds: a number, a (low, high) range or
+                 a Callable(instance_id, commands, rng) (see runtime_profile())
+        delivery: Seconds before a sent command starts
+        visibility: Seconds before get_command_invocation knows a command
+                    (it raises InvocationDoesNotExist until then)
+        failure_rate: Probability that an invocation fails
+        failing: Instance IDs whose invocations always fail
+        output: Callable(instance_id, commands) -> stdout of successful
+                invocations (default: empty)
+        offline: Instance IDs whose SSM agent is ConnectionLost, as a dict of
+                 instance_id -> epoch seconds when it reconnects (None: never)
+                 or an iterable (never); their commands stay Pending until
+                 the agent is back or the command times out
+        **options: latency, rate_limits, max_attempts and seed (see _FakeService)
+    """
+
+    exceptions = _SsmExceptions
+    service = "ssm"
+
+    def __init__(self, clock, region="us-east-1", runtime=30, delivery=1, visibility=0,
+                 failure_rate=0.0, failing=None, output=None, offline=None, **options):
+        super().__init__(clock, **options)
+        self.region = region
+        self.runtime = runtime
+        self.delivery = delivery
+        self.visibility = visibility
+        self.failure_rate = failure_rate
+        self.failing = set(failing or ())
+        self.output = output
+        if not isinstance(offline, dict):
+            offline = dict.fromkeys(offline or ())
+        self.offline = {i: float("inf") if t is None else t for i, t in offline.items()}
+        self.instances = set()
+        self.parameters = {}
+        self.invocations = {}
+        self.bytes_sent = 0
+        self._command_ids = itertools.count(1)
+
+    # -- helpers -------------------------------------------------------
+
+    def _runtime(self, instance_id, commands):
+        if callable(self.runtime):
+            return self.runtime(instance_id, commands, self.rng)
+        if isinstance(self.runtime, (tuple, list)):
+            return self.rng.uniform(*self.runtime)
+        return self.runtime
+
+    def _online_at(self, instance_id):
+        return self.offline.get(instance_id, 0)
+
+    def _status(self, invocation):
+        now = self.clock.time()
+        if now < invocation["started_at"]:
+            return "Pending"
+        if now < invocation["done_at"]:
+            return "InProgress"
+        return invocation["final"]
+
+    def _output(self, invocation, limit):
+        status = self._status(invocation)
+        if status not in ("Success", "Failed", "TimedOut"):
+            return "", ""
+        return invocation["stdout"][:limit], invocation["stderr"][:limit]
+
+    def _get(self, command_id, instance_id, operation):
+        invocation = self.invocations.get((command_id, instance_id))
+        if invocation is None or self.clock.time() < invocation["sent_at"] + self.visibility:
+            raise InvocationDoesNotExist(
+                {"Error": {"Code": "InvocationDoesNotExist", "Message": ""}}, operation
+            )
+        return invocation
+
+    # -- Run Command ---------------------------------------------------
+
+    def send_command(self, InstanceIds, DocumentName, Parameters=None, TimeoutSeconds=3600,
+                     **kwargs):
+        self._api("send_command", tuple(InstanceIds))
+        unknown = [i for i in InstanceIds if i not in self.instances]
+        if unknown:
+            raise _client_error("SendCommand", f"Instances {unknown} not in a valid state "
+                                "for account 123456789012", "InvalidInstanceId")
+        commands = list((Parameters or {}).get("commands", []))
+        self.bytes_sent += len(json.dumps(Parameters or {}).encode("utf-8"))
+
+        n = next(self._command_ids)
+        command_id = f"{n:08x}-0000-4000-8000-{self.rng.getrandbits(48):012x}"
+        now = self.clock.time()
+        for instance_id in InstanceIds:
+            runtime = self._runtime(instance_id, commands)
+            failed = instance_id in self.failing or self.rng.random() < self.failure_rate
+            # Delivery waits for an offline agent; the timeout runs from sending
+            started_at = max(now + self.delivery, self._online_at(instance_id))
+            done_at = min(started_at + runtime, now + TimeoutSeconds)
+            invocation = {
+                "command_id": command_id,
+                "instance_id": instance_id,
+                "document": DocumentName,
+                "sent_at": now,
+                "started_at": min(started_at, done_at),
+                "done_at": done_at,
+                "final": "TimedOut" if started_at + runtime > now + TimeoutSeconds
+                else "Failed" if failed else "Success",
+                "stdout": "",
+                "stderr": "",
+            }
+            if invocation["final"] == "Success" and self.output:
+                invocation["stdout"] = self.output(instance_id, commands)
+            elif invocation["final"] == "Failed":
+                invocation["stderr"] = "failed to run commands: exit status 1"
+            self.invocations[(command_id, instance_id)] = invocation
+        return {"Command": {
+            "CommandId": command_id,
+            "DocumentName": DocumentName,
+            "InstanceIds": list(InstanceIds),
+            "Status": "Pending",
+            "TimeoutSeconds": TimeoutSeconds,
+        }}
+
+    def get_command_invocation(self, CommandId, InstanceId, PluginName=None):
+        self._api("get_command_invocation", CommandId, InstanceId)
+        invocation = self._get(CommandId, InstanceId, "GetCommandInvocation")
+        status = self._status(invocation)
+        stdout, stderr = self._output(invocation, INVOCATION_OUTPUT_LIMIT)
+        return {
+            "CommandId": CommandId,
+            "InstanceId": InstanceId,
+            "DocumentName": invocation["document"],
+            "Status": status,
+            "StatusDetails": status,
+            "ResponseCode": {"Success": 0, "Failed": 1}.get(status, -1),
+            "StandardOutputContent": stdout,
+            "StandardErrorContent": stderr,
+        }
+
+    def list_command_invocations(self, CommandId=None, InstanceId=None, Details=False,
+                                 MaxResults=50, NextToken=None, **kwargs):
+        self._api("list_command_invocations", CommandId, InstanceId)
+        matches = [
+            inv for inv in list(self.invocations.values())
+            if CommandId in (None, inv["command_id"])
+            and InstanceId in (None, inv["instance_id"])
+        ]
+        start = int(NextToken or 0)
+        page = []
+        for invocation in matches[start:start + MaxResults]:
+            status = self._status(invocation)
+            item = {
+                "CommandId": invocation["command_id"],
+                "InstanceId": invocation["instance_id"],
+                "DocumentName": invocation["document"],
+                "Status": status,
+                "StatusDetails": status,
+            }
+            if Details:
+                stdout, _ = self._output(invocation, LIST_OUTPUT_LIMIT)
+                item["CommandPlugins"] = [{
+                    "Name": "aws:runShellScript",
+                    "Status": status,
+                    "Output": stdout,
+                }]
+            page.append(item)
+        response = {"CommandInvocations": page}
+        if start + MaxResults < len(matches):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+    def cancel_command(self, CommandId, InstanceIds=None, **kwargs):
+        self._api("cancel_command", CommandId)
+        now = self.clock.time()
+        for (command_id, instance_id), invocation in list(self.invocations.items()):
+            if command_id != CommandId or (InstanceIds and instance_id not in InstanceIds):
+                continue
+            if self._status(invocation) in ("Pending", "InProgress"):
+                invocation.update(done_at=now, final="Cancelled", stdout="", stderr="")
+                invocation["started_at"] = min(invocation["started_at"], now)
+        return {}
+
+    def describe_instance_information(self, Filters=None, MaxResults=50, NextToken=None,
+                                      **kwargs):
+        self._api("describe_instance_information", NextToken)
+        if not 5 <= MaxResults <= 50:
+            raise _client_error("DescribeInstanceInformation",
+                                "MaxResults must be between 5 and 50", "ValidationException")
+        wanted = None
+        for flt in Filters or ():
+            if flt["Key"] == "InstanceIds":
+                wanted = set(flt["Values"])
+        matches = sorted(i for i in self.instances if wanted is None or i in wanted)
+        start = int(NextToken or 0)
+        now = self.clock.time()
+        response = {"InstanceInformationList": [{
+            "InstanceId": instance_id,
+            "PingStatus": "Online" if now >= self._online_at(instance_id) else "ConnectionLost",
+            "PlatformType": "Linux",
+            "ResourceType": "EC2Instance",
+        } for instance_id in matches[start:start + MaxResults]]}
+        if start + MaxResults < len(matches):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+    # -- Parameter Store -----------------------------------------------
+
+    def put_parameter(self, Name, Value, Type="String", Overwrite=False, Tier="Standard",
+                      **kwargs):
+        self._api("put_parameter", Name)
+        limit = PARAMETER_LIMITS.get(Tier, PARAMETER_LIMITS["Standard"])
+        if len(Value) > limit:
+            raise _client_error("PutParameter", f"{Tier} tier parameters support a maximum "
+                                f"parameter value of {limit} characters.",
+                                "ValidationException")
+        current = self.parameters.get(Name)
+        if current is not None and not Overwrite:
+            raise ParameterAlreadyExists(
+                {"Error": {"Code": "ParameterAlreadyExists", "Message": ""}}, "PutParameter"
+            )
+        version = current["Version"] + 1 if current else 1
+        self.parameters[Name] = {
+            "Name": Name,
+            "Type": Type,
+            "Value": Value,
+            "Version": version,
+            "Tier": Tier,
+            "LastModifiedDate": self.clock.time(),
+        }
+        return {"Version": version, "Tier": Tier}
+
+    def get_parameters_by_path(self, Path, Recursive=False, WithDecryption=False,
+                               MaxResults=10, NextToken=None, **kwargs):
+        self._api("get_parameters_by_path", Path, NextToken)
+        prefix = Path.rstrip("/") + "/"
+        names = sorted(
+            name for name in list(self.parameters)
+            if name.startswith(prefix) and (Recursive or "/" not in name[len(prefix):])
+        )
+        start = int(NextToken or 0)
+        response = {"Parameters": [
+            {k: v for k, v in self.parameters[name].items() if k != "Tier"}
+            for name in names[start:start + MaxResults]
+        ]}
+        if start + MaxResults < len(names):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+
+class FakeEC2(_FakeService):
+    """EC2 instances registered by FakeAws.add_router(), for describe_instances.
+
+    Args:
+        clock: FakeClock shared with the code under test
+        region: Region of this endpoint
+        **options: latency, rate_limits, max_attempts and seed (see _FakeService)
+    """
+
+    service = "ec2"
+
+    def __init__(self, clock, region="us-east-1", **options):
+        super().__init__(clock, **options)
+        self.region = region
+        self.instances = {}
+
+    @staticmethod
+    def _matches(instance, flt):
+        name, values = flt["Name"], flt["Values"]
+        if name.startswith("tag:"):
+            tags = {t["Key"]: t["Value"] for t in instance["Tags"]}
+            return tags.get(name[4:]) in values
+        if name == "tag-key":
+            return any(t["Key"] in values for t in instance["Tags"])
+        if name == "instance-state-name":
+            return instance["State"]["Name"] in values
+        if name == "instance-id":
+            return instance["InstanceId"] in values
+        raise _client_error("DescribeInstances", f"The filter '{name}' is invalid",
+                            "InvalidParameterValue")
+
+    def describe_instances(self, InstanceIds=None, Filters=None, MaxResults=1000,
+                           NextToken=None, **kwargs):
+        self._api("describe_instances", NextToken)
+        matches = [
+            instance for instance in list(self.instances.values())
+            if (not InstanceIds or instance["InstanceId"] in InstanceIds)
+            and all(self._matches(instance, f) for f in Filters or [])
+        ]
+        start = int(NextToken or 0)
+        response = {"Reservations": [
+            {"ReservationId": f"r-{instance['InstanceId'][2:]}",
+             "Instances": [json.loads(json.dumps(instance))]}
+            for instance in matches[start:start + MaxResults]
+        ]}
+        if start + MaxResults < len(matches):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+
+class FakeLambda:
+    """Records asynchronous invocations instead of running them."""
+
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b"{}"):
+        self.invocations.append(json.loads(Payload))
+        return {"StatusCode": 202}
+
+
+class FakeAws:
+    """Client factory for ssm_utils.set_client_factory() backed by the fakes.
+
+    Args:
+        clock: FakeClock (default: a new one)
+        region: Region of clients created without one
+        region_options: FakeCloudFormation options per region, overriding
+                        cfn_options (e.g. a failure in one region only)
+        ssm_options: FakeSSM options for every region
+        ec2_options: FakeEC2 options for every region
+        **cfn_options: FakeCloudFormation options for every region
+    """
+
+    def __init__(self, clock=None, region="us-east-1", region_options=None,
+                 ssm_options=None, ec2_options=None, **cfn_options):
+        self.clock = clock or FakeClock()
+        self.region = region
+        self.cfn_options = cfn_options
+        self.region_options = dict(region_options or {})
+        self.ssm_options = dict(ssm_options or {})
+        self.ec2_options = dict(ec2_options or {})
+        self.clients = {}
+        self.caches = {}
+        self.s3 = FakeS3(self.clock)
+        self.awslambda = FakeLambda()
+
+    def cloudformation(self, region):
+        key = ("cloudformation", region)
+        if key not in self.clients:
+            options = {"s3": self.s3, **self.cfn_options, **self.region_options.get(region, {})}
+            self.clients[key] = FakeCloudFormation(self.clock, region, **options)
+        return self.clients[key]
+
+    def ssm(self, region=None):
+        key = ("ssm", region or self.region)
+        if key not in self.clients:
+            self.clients[key] = FakeSSM(self.clock, key[1], **self.ssm_options)
+        return self.clients[key]
+
+    def ec2(self, region=None):
+        key = ("ec2", region or self.region)
+        if key not in self.clients:
+            self.clients[key] = FakeEC2(self.clock, key[1], **self.ec2_options)
+        return self.clients[key]
+
+    def add_router(self, name, region, **params):
+        """Register an instance, tagged sdwan:router=<name>, and its /sdwan/<name>/... parameters.
+
+        Args:
+            name: Router name
+            region: Region of the instance and its parameters
+            **params: Extra parameters by type, e.g. cloudwan_peer_ip1="10.0.0.1"
+
+        Returns:
+            str: The instance ID
+        """
+        ec2, ssm = self.ec2(region), self.ssm(region)
+        n = len(ec2.instances) + 1
+        instance_id = "i-" + hashlib.md5(f"{region}/{name}".encode("utf-8")).hexdigest()[:17]
+        private_ip = f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}"
+        public_ip = f"198.18.{n // 256 % 256}.{n % 256}"
+        ec2.instances[instance_id] = {
+            "InstanceId": instance_id,
+            "State": {"Name": "running"},
+            "PrivateIpAddress": private_ip,
+            "PublicIpAddress": public_ip,
+            "Placement": {"AvailabilityZone": f"{region}a"},
+            "NetworkInterfaces": [{
+                "Attachment": {"DeviceIndex": 1},
+                "PrivateIpAddress": private_ip,
+                "Association": {"PublicIp": public_ip},
+            }],
+            "Tags": [{"Key": "Name", "Value": name}, {"Key": "sdwan:router", "Value": name}],
+        }
+        ssm.instances.add(instance_id)
+        values = {
+            "instance-id": instance_id,
+            "outside-eip": public_ip,
+            "outside-private-ip": private_ip,
+            **{k.replace("_", "-"): v for k, v in params.items()},
+        }
+        for param_type, value in values.items():
+            ssm.parameters[f"/sdwan/{name}/{param_type}"] = {
+                "Name": f"/sdwan/{name}/{param_type}",
+                "Type": "String",
+                "Value": value,
+                "Version": 1,
+                "Tier": "Standard",
+                "LastModifiedDate": self.clock.time(),
+            }
+        return instance_id
+
+    def add_fleet(self, count, regions=("us-east-1", "eu-central-1"), prefix="router"):
+        """Register count routers spread round-robin over regions.
+
+        Returns:
+            dict: Router name -> {"instance_id", "region"}
+        """
+        fleet = {}
+        for i in range(count):
+            region = regions[i % len(regions)]
+            name = f"{prefix}{i + 1:04d}"
+            fleet[name] = {"instance_id": self.add_router(name, region), "region": region}
+        return fleet
+
+    def api_counts(self):
+        """Return the number of calls per service and API across all clients."""
+        counts = {}
+        for (service, _), client in sorted(self.clients.items()):
+            for api, n in client.api_counts().items():
+                counts[f"{service}.{api}"] = counts.get(f"{service}.{api}", 0) + n
+        for api, n in self.s3.api_counts().items():
+            counts[f"s3.{api}"] = n
+        return counts
+
+    def __call__(self, service, region_name=None):
+        if service == "cloudformation":
+            return self.cloudformation(region_name)
+        if service == "ssm":
+            return self.ssm(region_name)
+        if service == "ec2":
+            return self.ec2(region_name)
+        if service == "s3":
+            return self.s3
+        if service == "lambda":
+            return self.awslambda
+        raise NotImplementedError(f"No fake for {service}")
+
+
+# Modules whose `time` use() replaces with the fake clock
+CLOCKED_MODULES = ("ssm_utils", "convergence_handler", "sdwan_orchestrator", "rollout",
+                   "cross_region_stack", "tracing")
+
+
+@contextlib.contextmanager
+def use(aws):
+    """Point ssm_utils clients and the handlers' clocks at a FakeAws.
+
+    Modules in CLOCKED_MODULES that are not in this package are skipped.
+    """
+    patched = []
+    for name in CLOCKED_MODULES:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        patched.append((module, module.time))
+        module.time = aws.clock
+    ssm_utils.set_client_factory(aws)
+    try:
+        yield aws
+    finally:
+        for module, original in patched:
+            module.time = original
+        ssm_utils.set_client_factory()
+
+
+def run_custom_resource(event, aws, timeout=900, max_invocations=50, cold=False):
+    """Run cross_region_stack.handler against fakes until it responds.
+
+    Follows the handler's asynchronous self-invocations, giving each one a
+    fresh context with the given Lambda timeout. The handler's warm caches
+    belong to the FakeAws instance, as if it were one Lambda container.
+
+    Args:
+        event: Custom resource event
+        aws: FakeAws instance
+        timeout: Lambda timeout in seconds for each invocation
+        max_invocations: Safety limit on re-invocations
+        cold: Clear the warm caches first, as after a cold start
+
+    Returns:
+        dict: The response body sent to CloudFormation, plus Invocations
+    """
+    import cross_region_stack
+
+    responses = []
+
+    def capture(event, context, status, data=None, reason=None):
+        responses.append({
+            "Status": status,
+            "Reason": reason,
+            "PhysicalResourceId": cross_region_stack.physical_resource_id(event, data),
+            "Data": data or {},
+        })
+
+    if cold:
+        aws.caches.clear()
+    saved = (cross_region_stack.send_response, cross_region_stack._TEMPLATE_CACHE,
+             cross_region_stack._DEPLOYED, cross_region_stack._STAGED)
+    cross_region_stack.send_response = capture
+    cross_region_stack._TEMPLATE_CACHE = aws.caches.setdefault("templates", {})
+    cross_region_stack._DEPLOYED = aws.caches.setdefault("deployed", {})
+    cross_region_stack._STAGED = aws.caches.setdefault("staged", set())
+    try:
+        with use(aws):
+            pending = [event]
+            invocations = 0
+            while pending and not responses:
+                invocations += 1
+                if invocations > max_invocations:
+                    raise RuntimeError(f"No response after {max_invocations} invocations")
+                cross_region_stack.handler(pending.pop(0), FakeContext(aws.clock, timeout))
+                pending.extend(aws.awslambda.invocations)
+                aws.awslambda.invocations.clear()
+    finally:
+        (cross_region_stack.send_response, cross_region_stack._TEMPLATE_CACHE,
+         cross_region_stack._DEPLOYED, cross_region_stack._STAGED) = saved
+
+    if len(responses) != 1:
+        raise RuntimeError(f"Expected one response, got {len(responses)}")
+    return dict(responses[0], Invocations=invocations)
+
+
+def _demo():
+    event = {
+        "RequestType": "Create",
+        "ResponseURL": "https://example.invalid/response",
+        "StackId": "arn:aws:cloudformation:us-east-1:123456789012:stack/parent/1",
+        "RequestId": "req-1",
+        "LogicalResourceId": "FrankfurtStack",
+        "ResourceProperties": {
+            "Region": "eu-central-1",
+            "StackName": "sdwan-frankfurt",
+            "TemplateURL": "https://bucket.s3.amazonaws.com/frankfurt-stack.yaml",
+        },
+    }
+    aws = FakeAws(durations={"CREATE": 2400}, outputs={"FraSdwanVpcArn": "arn:vpc"})
+    aws.s3.objects[("bucket", "frankfurt-stack.yaml")] = b"Resources: {}"
+
+    cfn = aws.cloudformation("eu-central-1")
+    steps = (
+        ("Create", "dev", False),
+        ("Update", "prod", False),
+        ("Update", "prod", False),
+        ("Update", "prod", True),
+        ("Delete", "prod", False),
+    )
+    for request_type, environment, cold in steps:
+        props = dict(event["ResourceProperties"],
+                     Parameters={"ProjectName": "sdwan", "Environment": environment})
+        event = dict(event, RequestType=request_type, ResourceProperties=props)
+        start, calls = aws.clock.time(), len(cfn.calls)
+        response = run_custom_resource(event, aws, cold=cold)
+        api = ", ".join(sorted({c[0] for c in cfn.calls[calls:]}))
+        print(f"{request_type}{' (cold)' if cold else ''}: {response['Status']} after "
+              f"{aws.clock.time() - start:.0f}s in {response['Invocations']} invocation(s) "
+              f"[{api}]")
+        event["PhysicalResourceId"] = response["PhysicalResourceId"]
+
+
+def _demo_fleet(count):
+    import phase1_handler
+
+    commands = phase1_handler.build_phase1_commands()
+    for label, concurrent in (("send_and_wait loop", False), ("run_commands", True)):
+        aws = FakeAws(ssm_options={"runtime": runtime_profile(), "latency": 0.05})
+        fleet = aws.add_fleet(count)
+        start = aws.clock.time()
+        with use(aws):
+            if concurrent:
+                results = ssm_utils.run_commands(
+                    {name: dict(router, commands=commands) for name, router in fleet.items()}
+                )
+            else:
+                results = {
+                    name: ssm_utils.send_and_wait(router["instance_id"], router["region"], commands)
+                    for name, router in fleet.items()
+                }
+        ok = sum(r["status"] == "Success" for r in results.values())
+        calls = sum(aws.api_counts().values())
+        print(f"{label}: {ok}/{count} routers in {aws.clock.time() - start:.0f}s "
+              f"(virtual), {calls} API calls")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["fleet"]:
+        _demo_fleet(int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+    else:
+        _demo()
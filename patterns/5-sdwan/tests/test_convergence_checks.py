@@ -0,0 +1,60 @@
+"""
+Table-driven tests of the per-router convergence checks (convergence_handler.py).
+"""
+
+import pytest
+
+import fake_aws  # noqa: F401  (puts cloudformation/lambda on sys.path)
+from convergence_handler import get_pending_checks
+from phase4_handler import parse_verify_output
+
+
+PEERS = {"nv-sdwan": {"cloudwan_peer_ip1": "169.254.200.1",
+                      "cloudwan_peer_ip2": "169.254.200.2"}}
+
+UP = "Established"
+
+
+def verify_output(cloudwan, extra=""):
+    """Build phase 4 verification stdout with the VPN checks up.
+
+    Args:
+        cloudwan: Dict of Cloud WAN peer IP -> BGP state
+        extra: Lines appended to the output
+    """
+    sections = [
+        "--- IPsec SA Status ---",
+        "Connection  State  Uptime  Bytes In/Out  Packets In/Out  Remote address",
+        "nv-branch1-tunnel  up  1h  1K/1K  10/10  192.0.2.10",
+        "--- BGP Summary ---",
+        "Neighbor  V  AS  MsgRcvd  MsgSent  TblVer  InQ  OutQ  Up/Down  State/PfxRcd",
+        "169.254.100.2  4  65002  10  10  0  0  0  01:00:00  3",
+        "--- Interfaces ---",
+    ]
+    for ip, state in cloudwan.items():
+        sections += [f"--- Cloud WAN BGP Neighbor {ip} ---",
+                     f"BGP neighbor is {ip}, remote AS 64512, local AS 65001",
+                     f"  BGP state = {state}"]
+    return "\n".join(sections) + "\n" + extra
+
+
+@pytest.mark.parametrize("cloudwan, extra, expected", [
+    ({"169.254.200.1": UP, "169.254.200.2": UP}, "", []),
+    ({"169.254.200.1": UP, "169.254.200.2": "Active"}, "",
+     ["cloudwan bgp 169.254.200.2 Active"]),
+    ({"169.254.200.1": UP}, "", ["cloudwan bgp 169.254.200.2 missing"]),
+    ({}, "", ["cloudwan bgp 169.254.200.1 missing", "cloudwan bgp 169.254.200.2 missing"]),
+    ({"169.254.200.1": UP, "169.254.200.2": UP}, "CLOUDWAN_BGP_CHECK_FAILED\n",
+     ["cloudwan bgp check failed"]),
+])
+def test_cloudwan_pending_checks(cloudwan, extra, expected):
+    details = parse_verify_output(verify_output(cloudwan, extra), "nv-sdwan", configs=PEERS)
+
+    assert get_pending_checks("nv-sdwan", details, "phase2") == []
+    assert get_pending_checks("nv-sdwan", details, "phase3") == expected
+
+
+def test_cloudwan_without_configured_peers_is_pending():
+    details = parse_verify_output(verify_output({}), "nv-sdwan")
+
+    assert get_pending_checks("nv-sdwan", details, "phase3") == ["cloudwan bgp no peers"]
@@ -0,0 +1,219 @@
+"""
+Offline tests of the cross-region stack custom resource (cross_region_stack.py).
+
+Each test drives the handler through all of its re-invocations with
+fake_aws.run_custom_resource(), against FakeCloudFormation stacks whose
+operations take virtual time.
+"""
+
+import pytest
+
+from fake_aws import FakeAws, run_custom_resource
+
+import cross_region_stack
+
+
+TEMPLATE_URL = "https://bucket.s3.amazonaws.com/stack.yaml"
+
+
+def make_aws(**options):
+    aws = FakeAws(outputs={"VpcId": "vpc-1"}, **options)
+    aws.s3.objects[("bucket", "stack.yaml")] = b"Resources: {}"
+    return aws
+
+
+def make_event(request_type, props, old_props=None, physical_id=None):
+    event = {
+        "RequestType": request_type,
+        "ResponseURL": "https://example.invalid/response",
+        "StackId": "arn:aws:cloudformation:us-east-1:123456789012:stack/parent/1",
+        "RequestId": "req-1",
+        "LogicalResourceId": "RemoteStack",
+        "ResourceProperties": props,
+    }
+    if old_props is not None:
+        event["OldResourceProperties"] = old_props
+    if physical_id:
+        event["PhysicalResourceId"] = physical_id
+    return event
+
+
+def single(**params):
+    return {"Region": "eu-central-1", "StackName": "remote", "TemplateURL": TEMPLATE_URL,
+            "Parameters": params}
+
+
+def multi(*regions, **extra):
+    return {"StackName": "remote", "TemplateURL": TEMPLATE_URL,
+            "Targets": [{"Region": r} for r in regions], **extra}
+
+
+def statuses(aws, region):
+    return [s["StackStatus"] for s in aws.cloudformation(region).stacks.values()]
+
+
+def calls(aws, region, name):
+    return [c for c in aws.cloudformation(region).calls if c[0] == name]
+
+
+def test_create_returns_outputs_across_reinvocations():
+    aws = make_aws(durations={"CREATE": 2400})
+    response = run_custom_resource(make_event("Create", single(Environment="dev")), aws)
+
+    assert response["Status"] == "SUCCESS"
+    assert response["Invocations"] > 1
+    assert response["Data"]["VpcId"] == "vpc-1"
+    assert response["PhysicalResourceId"] == response["Data"]["StackId"]
+    assert statuses(aws, "eu-central-1") == ["CREATE_COMPLETE"]
+
+
+def test_failed_create_is_deleted_and_reported():
+    aws = make_aws(failures={"CREATE": ("Vpc", "CIDR conflicts with another subnet")})
+    response = run_custom_resource(make_event("Create", single()), aws)
+
+    assert response["Status"] == "FAILED"
+    assert "Vpc: CIDR conflicts" in response["Reason"]
+    assert response["PhysicalResourceId"] == "remote-eu-central-1"
+    assert statuses(aws, "eu-central-1") == ["DELETE_IN_PROGRESS"]
+
+
+def test_unchanged_update_skips_the_change_set():
+    aws = make_aws()
+    created = run_custom_resource(make_event("Create", single(Environment="dev")), aws)
+    props = single(Environment="dev")
+    response = run_custom_resource(
+        make_event("Update", props, props, created["PhysicalResourceId"]), aws)
+
+    assert response["Status"] == "SUCCESS"
+    assert response["Data"]["ChangeSummary"] == "No changes"
+    assert not calls(aws, "eu-central-1", "create_change_set")
+
+
+def test_update_executes_change_set():
+    aws = make_aws()
+    created = run_custom_resource(make_event("Create", single(Environment="dev")), aws)
+    response = run_custom_resource(make_event(
+        "Update", single(Environment="prod"), single(Environment="dev"),
+        created["PhysicalResourceId"]), aws)
+
+    assert response["Status"] == "SUCCESS"
+    assert response["Data"]["ChangeSummary"].startswith("0 to add")
+    assert len(calls(aws, "eu-central-1", "execute_change_set")) == 1
+    assert statuses(aws, "eu-central-1") == ["UPDATE_COMPLETE"]
+
+
+def test_failed_update_is_cancelled_and_rolled_back():
+    aws = make_aws(failures={"UPDATE": {"logical_id": "Instance", "reason": "Quota exceeded",
+                                        "at": 60}})
+    created = run_custom_resource(make_event("Create", single(Environment="dev")), aws)
+    response = run_custom_resource(make_event(
+        "Update", single(Environment="prod"), single(Environment="dev"),
+        created["PhysicalResourceId"]), aws)
+
+    assert response["Status"] == "FAILED"
+    assert "Instance: Quota exceeded" in response["Reason"]
+    assert calls(aws, "eu-central-1", "cancel_update_stack")
+    assert statuses(aws, "eu-central-1") == ["UPDATE_ROLLBACK_COMPLETE"]
+
+
+def test_update_after_out_of_band_change_is_not_skipped():
+    aws = make_aws()
+    props = single(Environment="dev")
+    created = run_custom_resource(make_event("Create", props), aws)
+    aws.cloudformation("eu-central-1").update_stack(
+        StackName="remote", TemplateBody="Resources: {Changed: {}}",
+        Parameters=[{"ParameterKey": "Environment", "ParameterValue": "dev"}], Tags=[])
+    aws.clock.sleep(600)
+
+    response = run_custom_resource(
+        make_event("Update", props, props, created["PhysicalResourceId"]), aws)
+
+    assert response["Status"] == "SUCCESS"
+    assert response["Data"]["ChangeSummary"] != "No changes"
+
+
+def test_delete_and_delete_of_missing_stack():
+    aws = make_aws()
+    created = run_custom_resource(make_event("Create", single()), aws)
+    event = make_event("Delete", single(), physical_id=created["PhysicalResourceId"])
+
+    assert run_custom_resource(event, aws)["Status"] == "SUCCESS"
+    assert statuses(aws, "eu-central-1") == ["DELETE_COMPLETE"]
+    assert run_custom_resource(event, aws)["Status"] == "SUCCESS"
+
+
+def test_multi_target_create_has_a_stable_physical_id():
+    first = run_custom_resource(make_event("Create", multi("us-west-2", "eu-central-1")),
+                                make_aws())
+    second = run_custom_resource(make_event("Create", multi("eu-central-1", "us-west-2")),
+                                 make_aws())
+
+    assert first["Status"] == second["Status"] == "SUCCESS"
+    assert first["PhysicalResourceId"] == second["PhysicalResourceId"] == \
+        "remote-eu-central-1-us-west-2"
+    assert first["Data"]["us-west-2.VpcId"] == "vpc-1"
+
+
+def test_update_creates_added_target():
+    aws = make_aws()
+    old = multi("eu-central-1")
+    created = run_custom_resource(make_event("Create", old), aws)
+    response = run_custom_resource(make_event(
+        "Update", multi("eu-central-1", "us-west-2"), old, created["PhysicalResourceId"]), aws)
+
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert response["PhysicalResourceId"] == created["PhysicalResourceId"]
+    assert statuses(aws, "us-west-2") == ["CREATE_COMPLETE"]
+    assert "us-west-2.StackId" in response["Data"]
+
+
+@pytest.mark.parametrize("policy, expected", [
+    ({}, ["DELETE_COMPLETE"]),
+    ({"RemovedTargets": "Retain"}, ["CREATE_COMPLETE"]),
+])
+def test_update_handles_removed_target(policy, expected):
+    aws = make_aws()
+    old = multi("eu-central-1", "us-west-2")
+    created = run_custom_resource(make_event("Create", old), aws)
+    response = run_custom_resource(make_event(
+        "Update", multi("eu-central-1", **policy), old, created["PhysicalResourceId"]), aws)
+
+    assert response["Status"] == "SUCCESS"
+    assert statuses(aws, "us-west-2") == expected
+
+
+def test_fail_fast_deletes_the_other_targets():
+    aws = make_aws(region_options={"us-west-2": {"failures": {"CREATE": ("Vpc", "Limit")}}})
+    response = run_custom_resource(make_event("Create", multi("eu-central-1", "us-west-2")), aws)
+
+    assert response["Status"] == "FAILED"
+    assert response["Reason"].startswith("us-west-2:")
+    assert statuses(aws, "eu-central-1") == ["DELETE_IN_PROGRESS"]
+    assert statuses(aws, "us-west-2") == ["DELETE_IN_PROGRESS"]
+
+
+def test_invalid_staging_bucket_name_is_rejected():
+    template = {"body": "x" * (cross_region_stack.TEMPLATE_BODY_LIMIT + 1), "sha256": "0" * 64}
+
+    with pytest.raises(ValueError, match="Invalid staging bucket name"):
+        cross_region_stack.stage_template(template, "eu-central-1", bucket="Sdwan-{region}")
+
+
+def test_single_stack_rename_leaves_old_stack_to_cleanup_delete():
+    aws = make_aws()
+    old = single(Environment="dev")
+    created = run_custom_resource(make_event("Create", old), aws)
+    renamed = dict(old, StackName="remote-v2")
+    response = run_custom_resource(make_event(
+        "Update", renamed, old, created["PhysicalResourceId"]), aws)
+
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert response["PhysicalResourceId"] != created["PhysicalResourceId"]
+    assert sorted(statuses(aws, "eu-central-1")) == ["CREATE_COMPLETE", "CREATE_COMPLETE"]
+    assert not calls(aws, "eu-central-1", "delete_stack")
+
+    cleanup = make_event("Delete", old, physical_id=created["PhysicalResourceId"])
+    assert run_custom_resource(cleanup, aws)["Status"] == "SUCCESS"
+    stacks = aws.cloudformation("eu-central-1").stacks.values()
+    assert {s["StackName"]: s["StackStatus"] for s in stacks} == {
+        "remote": "DELETE_COMPLETE", "remote-v2": "CREATE_COMPLETE"}
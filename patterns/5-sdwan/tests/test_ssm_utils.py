@@ -0,0 +1,101 @@
+"""
+Offline tests of the SSM dispatch helpers (ssm_utils.py) against FakeSSM.
+"""
+
+import pytest
+
+from fake_aws import FakeAws, use
+
+import ssm_utils
+
+
+@pytest.fixture
+def aws():
+    aws = FakeAws(ssm_options={"runtime": 30})
+    ssm_utils._AGENTS.clear()
+    with use(aws):
+        yield aws
+    ssm_utils._AGENTS.clear()
+
+
+def make_fleet(aws, count, offline=()):
+    fleet = aws.add_fleet(count)
+    for name in offline:
+        aws.ssm(fleet[name]["region"]).offline[fleet[name]["instance_id"]] = float("inf")
+    return ssm_utils.get_instance_configs(refresh=True)
+
+
+def test_agent_check_covers_only_the_selected_routers(aws):
+    configs = make_fleet(aws, 120, offline=["router0002"])
+    selected = ["router0001", "router0002", "router0003"]
+
+    checked = list(ssm_utils.iter_reachable(configs, selected))
+
+    assert checked == [("router0001", None), ("router0003", None),
+                       ("router0002", "ConnectionLost")]
+    assert sorted(ssm_utils._AGENTS) == sorted(configs[n]["instance_id"] for n in selected)
+
+
+def test_agent_snapshot_lists_a_bounded_number_of_offline_agents(aws):
+    names = [f"router{i:04d}" for i in range(1, 61)]
+    configs = make_fleet(aws, 60, offline=names)
+    ssm_utils.check_agents(configs)
+
+    snapshot = ssm_utils.agent_snapshot()
+
+    assert snapshot["checked"] == 60
+    assert snapshot["offline_count"] == 60
+    assert len(snapshot["offline"]) == ssm_utils.AGENT_SNAPSHOT_LIMIT
+
+
+@pytest.mark.parametrize("offline, selected, seeded", [
+    # Whole fleet checked, every offline agent listed: nothing to re-check
+    (["router0002"], None, 10),
+    # Only a selection was checked: the rest is checked again
+    (["router0002"], ["router0001", "router0002"], 1),
+    # Offline list truncated: only the listed agents are known
+    ([f"router{i:04d}" for i in range(1, 11)], None, 3),
+])
+def test_seed_agents_trusts_only_what_the_snapshot_covers(aws, monkeypatch, offline,
+                                                          selected, seeded):
+    monkeypatch.setattr(ssm_utils, "AGENT_SNAPSHOT_LIMIT", 3)
+    configs = make_fleet(aws, 10, offline=offline)
+    ssm_utils.check_agents(configs, selected)
+    ids = None if selected is None else [configs[n]["instance_id"] for n in selected]
+    snapshot = ssm_utils.agent_snapshot(ids)
+    ssm_utils._AGENTS.clear()
+
+    ssm_utils.seed_agents({"phase1_result": {"agents": snapshot}}, configs)
+
+    assert len(ssm_utils._AGENTS) == seeded
+    for instance_id, status in snapshot["offline"].items():
+        assert ssm_utils._AGENTS[instance_id][0] == status == "ConnectionLost"
+
+
+def test_fail_fast_cancels_the_running_siblings(aws):
+    configs = make_fleet(aws, 4)
+    bad = configs["router0001"]["instance_id"]
+    aws.ssm(configs["router0001"]["region"]).failing.add(bad)
+    for region in ("us-east-1", "eu-central-1"):
+        aws.ssm(region).runtime = lambda instance_id, commands, rng: 30 if instance_id == bad else 600
+    started = aws.clock.time()
+
+    phase = ssm_utils.run_phase(configs, sorted(configs), lambda name, configs: "true",
+                                timeout=900, fail_fast="first")
+
+    assert phase["aborted"] == "fail-fast: 1 of 4 failed (limit 1)"
+    assert {n: r["status"] for n, r in phase["results"].items()} == {
+        "router0001": "Failed", "router0002": "Cancelled",
+        "router0003": "Cancelled", "router0004": "Cancelled"}
+    assert all(r["command_id"] for r in phase["results"].values())
+    assert aws.api_counts()["ssm.cancel_command"] == 3
+    assert aws.clock.time() - started < 600
+
+
+def test_discovered_router_without_topology_is_rejected(aws):
+    configs = make_fleet(aws, 2)
+    topology = {"router0001"}
+
+    assert ssm_utils.discovered_routers(configs, "phase1") == list(configs)
+    with pytest.raises(ValueError, match="phase2: no topology for discovered router.*router0002"):
+        ssm_utils.discovered_routers(configs, "phase2", topology=topology)
@@ -0,0 +1,188 @@
+"""
+Table-driven tests of the verification output parsers (verify_parsers.py).
+"""
+
+import json
+
+import pytest
+
+import fake_aws  # noqa: F401  (puts cloudformation/lambda on sys.path)
+import verify_parsers
+
+
+IPSEC_HEADER = """\
+Connection             State    Uptime    Bytes In/Out    Packets In/Out    Remote address    Remote ID    Proposal
+---------------------  -------  --------  --------------  ----------------  ----------------  -----------  ----------
+"""
+
+
+@pytest.mark.parametrize("rows, expected", [
+    ("peer-a-tunnel-1  up  2h3m  1.2K/552B  12/7  203.0.113.1  203.0.113.1  AES256/SHA256\n",
+     {"peer-a-tunnel-1": {"state": "up", "uptime": "2h3m", "bytes_in": 1228, "bytes_out": 552,
+                          "packets_in": 12, "packets_out": 7,
+                          "remote_address": "203.0.113.1"}}),
+    ("peer-a-tunnel-1  down  N/A  N/A  N/A  N/A  N/A  N/A\n",
+     {"peer-a-tunnel-1": {"state": "down", "uptime": "N/A", "bytes_in": 0, "bytes_out": 0,
+                          "packets_in": 0, "packets_out": 0, "remote_address": "N/A"}}),
+    ("peer-a-tunnel-1  connecting  N/A  N/A  N/A  203.0.113.1\n",
+     {"peer-a-tunnel-1": {"state": "connecting", "uptime": "N/A", "bytes_in": 0,
+                          "bytes_out": 0, "packets_in": 0, "packets_out": 0,
+                          "remote_address": "203.0.113.1"}}),
+    ("peer-a-tunnel-1  down\n",
+     {"peer-a-tunnel-1": {"state": "down", "uptime": "N/A", "bytes_in": 0, "bytes_out": 0,
+                          "packets_in": 0, "packets_out": 0, "remote_address": "N/A"}}),
+    ("", {}),
+])
+def test_parse_ipsec_sa(rows, expected):
+    assert verify_parsers.parse_ipsec_sa(IPSEC_HEADER + rows) == expected
+
+
+@pytest.mark.parametrize("rows, expected_count, status", [
+    ("a  up  1m  1K/1K  1/1  192.0.2.1\n", 1, "ok"),
+    ("a  up  1m  1K/1K  1/1  192.0.2.1\nb  down  N/A  N/A  N/A  N/A\n", 1, "fail"),
+    ("a  connecting  N/A  N/A  N/A  192.0.2.1\n", 1, "fail"),
+    ("a  up  1m  1K/1K  1/1  192.0.2.1\n", 2, "fail"),
+    ("", 1, "fail"),
+])
+def test_ipsec_status_sees_down_rows(rows, expected_count, status):
+    sas = verify_parsers.parse_ipsec_sa(IPSEC_HEADER + rows)
+    assert verify_parsers.ipsec_status(sas, expected_count) == status
+
+
+BGP_SUMMARY_TEXT = """\
+IPv4 Unicast Summary:
+BGP router identifier 10.0.0.1, local AS number 65001 vrf-id 0
+
+Neighbor        V         AS   MsgRcvd   MsgSent   TblVer  InQ OutQ  Up/Down State/PfxRcd
+169.254.0.1     4      64512       120       118        0    0    0 01:55:10            4
+169.254.0.5     4      64512         0         0        0    0    0    never       Active
+10.0.0.2        4      65002         3         2        0    0    0 00:00:12  Idle (Admin)
+
+Total number of neighbors 3
+"""
+
+BGP_SUMMARY_JSON = json.dumps({"ipv4Unicast": {"peers": {
+    "169.254.0.1": {"remoteAs": 64512, "state": "Established", "peerUptime": "01:55:10",
+                    "pfxRcd": 4},
+    "169.254.0.5": {"remoteAs": 64512, "state": "Active", "peerUptime": "never"},
+}}})
+
+
+@pytest.mark.parametrize("text, expected", [
+    (BGP_SUMMARY_TEXT, {
+        "169.254.0.1": {"remote_as": 64512, "state": "Established", "uptime": "01:55:10",
+                        "prefixes_received": 4},
+        "169.254.0.5": {"remote_as": 64512, "state": "Active", "uptime": "never",
+                        "prefixes_received": 0},
+        "10.0.0.2": {"remote_as": 65002, "state": "Idle", "uptime": "00:00:12",
+                     "prefixes_received": 0},
+    }),
+    (BGP_SUMMARY_JSON, {
+        "169.254.0.1": {"remote_as": 64512, "state": "Established", "uptime": "01:55:10",
+                        "prefixes_received": 4},
+        "169.254.0.5": {"remote_as": 64512, "state": "Active", "uptime": "never",
+                        "prefixes_received": 0},
+    }),
+    ("% BGP instance not found\n", {}),
+])
+def test_parse_bgp_summary(text, expected):
+    assert verify_parsers.parse_bgp_summary(text) == expected
+
+
+BGP_NEIGHBORS_TEXT = """\
+BGP neighbor is 169.254.0.1, remote AS 64512, local AS 65001, external link
+  BGP version 4, remote router ID 169.254.0.1, local router ID 10.0.0.1
+  BGP state = Established, up for 01:55:10
+  For address family: IPv4 Unicast
+    4 accepted prefixes
+BGP neighbor is 169.254.0.5, remote AS 64512, local AS 65001, external link
+  BGP state = Active
+"""
+
+BGP_NEIGHBORS_JSON = json.dumps({
+    "169.254.0.1": {"remoteAs": 64512, "bgpState": "Established",
+                    "bgpTimerUpString": "01:55:10",
+                    "addressFamilyInfo": {"ipv4Unicast": {"acceptedPrefixCounter": 4}}},
+    "169.254.0.5": {"remoteAs": 64512, "bgpState": "Connect", "bgpTimerUpString": "00:00:01"},
+})
+
+
+@pytest.mark.parametrize("text, expected", [
+    (BGP_NEIGHBORS_TEXT, {
+        "169.254.0.1": {"remote_as": 64512, "state": "Established", "uptime": "01:55:10",
+                        "prefixes_accepted": 4},
+        "169.254.0.5": {"remote_as": 64512, "state": "Active", "uptime": "",
+                        "prefixes_accepted": 0},
+    }),
+    (BGP_NEIGHBORS_JSON, {
+        "169.254.0.1": {"remote_as": 64512, "state": "Established", "uptime": "01:55:10",
+                        "prefixes_accepted": 4},
+        "169.254.0.5": {"remote_as": 64512, "state": "Connect", "uptime": "",
+                        "prefixes_accepted": 0},
+    }),
+    ("", {}),
+])
+def test_parse_bgp_neighbors(text, expected):
+    assert verify_parsers.parse_bgp_neighbors(text) == expected
+
+
+@pytest.mark.parametrize("neighbors, expected, status", [
+    ({"a": {"state": "Established"}}, None, "ok"),
+    ({"a": {"state": "Established"}, "b": {"state": "Active"}}, None, "fail"),
+    ({"a": {"state": "Established"}, "b": {"state": "Active"}}, ["a"], "ok"),
+    ({"a": {"state": "Established"}}, ["a", "b"], "fail"),
+    ({}, None, "fail"),
+])
+def test_bgp_status(neighbors, expected, status):
+    assert verify_parsers.bgp_status(neighbors, expected) == status
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("""\
+--- 10.1.0.1 ping statistics ---
+5 packets transmitted, 5 received, 0% packet loss, time 4006ms
+rtt min/avg/max/mdev = 0.412/0.501/0.633/0.081 ms
+""", {"transmitted": 5, "received": 5, "loss_pct": 0.0, "rtt_min": 0.412, "rtt_avg": 0.501,
+      "rtt_max": 0.633, "jitter": 0.081}),
+    ("""\
+--- 10.1.0.1 ping statistics ---
+5 packets transmitted, 4 packets received, 20% packet loss
+round-trip min/avg/max = 0.4/0.5/0.6 ms
+""", {"transmitted": 5, "received": 4, "loss_pct": 20.0, "rtt_min": 0.4, "rtt_avg": 0.5,
+      "rtt_max": 0.6, "jitter": None}),
+    ("""\
+--- 10.1.0.1 ping statistics ---
+5 packets transmitted, 0 received, 100% packet loss, time 4093ms
+""", {"transmitted": 5, "received": 0, "loss_pct": 100.0, "rtt_min": None, "rtt_avg": None,
+      "rtt_max": None, "jitter": None}),
+    ("ping: connect: Network is unreachable\n",
+     {"transmitted": 0, "received": 0, "loss_pct": 100.0, "rtt_min": None, "rtt_avg": None,
+      "rtt_max": None, "jitter": None}),
+])
+def test_parse_ping(text, expected):
+    assert verify_parsers.parse_ping(text) == expected
+
+
+@pytest.mark.parametrize("report, expected", [
+    ({"start": {"test_start": {"protocol": "TCP"}},
+      "end": {"sum_sent": {"bits_per_second": 4.2e9, "retransmits": 3},
+              "sum_received": {"bits_per_second": 4.1e9}}},
+     {"protocol": "TCP", "gbps_sent": 4.2, "gbps_received": 4.1, "retransmits": 3}),
+    ({"start": {"test_start": {"protocol": "UDP"}},
+      "end": {"sum": {"bits_per_second": 1e9, "seconds": 10, "packets": 850000,
+                      "lost_percent": 0.5, "jitter_ms": 0.02}}},
+     {"protocol": "UDP", "gbps": 1.0, "pps": 85000, "loss_pct": 0.5, "jitter_ms": 0.02}),
+    ({"start": {}, "end": {}, "error": "unable to connect to server: Connection refused"},
+     {"error": "unable to connect to server: Connection refused"}),
+])
+def test_parse_iperf3(report, expected):
+    assert verify_parsers.parse_iperf3(json.dumps(report)) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("iperf3: error - unable to connect to server\n",
+     {"error": "iperf3: error - unable to connect to server"}),
+    ("", {"error": "no output"}),
+])
+def test_parse_iperf3_without_json(text, expected):
+    assert verify_parsers.parse_iperf3(text) == expected